@@ -0,0 +1,1260 @@
+import asyncio
+import collections
+import concurrent.futures
+import errno
+import fnmatch
+import hashlib
+import itertools
+import json
+import mmap
+import os
+import re
+import shutil
+import sqlite3
+import struct
+import sys
+import threading
+import zlib
+
+from lzutil import lzutil
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None  # Windows
+
+# Readers for the archive formats handled by the extractors in this
+# repository. Each reader parses the table of contents of an archive into a
+# list of Members, and gives access to member data without extracting the
+# archive to disk.
+#
+#   with archiveutil.AfsArchive('BGM.AFS') as archive:
+#     for member in archive:
+#       print(member.path, member.size)
+#     data = archive.open('bgm_001.bin')  # memoryview into the archive
+#
+# Parsed catalogs can be kept in an ArchiveIndex, so that later runs on the
+# same unchanged archive do not walk its table of contents again.
+
+# One file stored in an archive.
+#   name: Name of the member as stored in the archive.
+#   path: Relative output path of the member ('/'-separated). Used for lookups.
+#   offset: Absolute offset of the member data in the archive file.
+#   size: Number of bytes stored in the archive.
+#   compressed: Whether the stored bytes need to be decompressed.
+#   uncompressed_size: Size of the member after decompression.
+Member = collections.namedtuple(
+    'Member',
+    ['name', 'path', 'offset', 'size', 'compressed', 'uncompressed_size'])
+
+DEFAULT_CHUNK_SIZE = 0x100000
+# Largest gap between members that are read together by Archive.extract with
+# coalesce_size. Reading over it is cheaper than seeking past it.
+COALESCE_GAP = 0x10000
+
+# Errors that mean a zero-copy method is not supported for a pair of files,
+# rather than an I/O failure.
+_UNSUPPORTED_COPY_ERRNOS = {
+    errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EBADF,
+    getattr(errno, 'EOPNOTSUPP', errno.EINVAL),
+    getattr(errno, 'ENOTSUP', errno.EINVAL)
+}
+
+
+class ArchiveError(Exception):
+  pass
+
+
+def _getstring(buf, offs, maxsize):
+  end_offs = min(offs + maxsize, len(buf))
+  null_offs = bytes(buf[offs:end_offs]).find(b'\0')
+  if null_offs >= 0:
+    end_offs = offs + null_offs
+  return bytes(buf[offs:end_offs]).decode('ascii', errors='replace')
+
+
+# Decodes a fixed-size, null-terminated string field.
+def _cstring(raw):
+  return raw.split(b'\0', 1)[0].decode('ascii', errors='replace')
+
+
+# Yields the entries of a table of entry (a struct.Struct) starting at offs,
+# for tables whose end is marked by an entry rather than a count. Entries are
+# unpacked from the buffer as they are iterated, without copying it.
+def _iter_table(buf, offs, entry):
+  count = max(0, len(buf) - offs) // entry.size
+  return entry.iter_unpack(memoryview(buf)[offs:offs + count * entry.size])
+
+
+def _normpath(name):
+  path = name.replace('\\', '/')
+  while path.startswith('../') or path.startswith('./'):
+    path = path[path.index('/') + 1:]
+  return path
+
+
+def default_index_path():
+  cache_dir = os.environ.get('XDG_CACHE_HOME')
+  if not cache_dir and os.name == 'nt':
+    cache_dir = os.environ.get('LOCALAPPDATA')
+  if not cache_dir:
+    cache_dir = os.path.join(os.path.expanduser('~'), '.cache')
+  return os.path.join(cache_dir, 'miscresearch', 'archiveutil.sqlite')
+
+
+# Persistent cache of parsed catalogs, stored in an SQLite database. A cached
+# catalog is used only while the size, modification time and header hash of
+# the archive are unchanged, otherwise the archive is parsed and its entry
+# replaced.
+class ArchiveIndex:
+  SCHEMA_VERSION = 1
+  HEADER_HASH_SIZE = 0x10000
+
+  def __init__(self, dbpath=None):
+    self.dbpath = dbpath or default_index_path()
+    os.makedirs(os.path.dirname(os.path.abspath(self.dbpath)), exist_ok=True)
+    self.db = sqlite3.connect(self.dbpath, timeout=30)
+    version = self.db.execute('PRAGMA user_version').fetchone()[0]
+    if version != self.SCHEMA_VERSION:
+      # Exclusive, as several processes may open a new index at once.
+      self.db.executescript(f'''
+          BEGIN IMMEDIATE;
+          DROP TABLE IF EXISTS members;
+          DROP TABLE IF EXISTS archives;
+          CREATE TABLE archives (
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL,
+            format TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            header_hash BLOB NOT NULL,
+            UNIQUE (path, format));
+          CREATE TABLE members (
+            archive_id INTEGER NOT NULL REFERENCES archives(id) ON DELETE CASCADE,
+            idx INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            path TEXT NOT NULL,
+            offset INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            compressed INTEGER NOT NULL,
+            uncompressed_size INTEGER NOT NULL,
+            PRIMARY KEY (archive_id, idx));
+          PRAGMA user_version = {self.SCHEMA_VERSION};
+          COMMIT;
+          ''')
+    self.db.execute('PRAGMA foreign_keys = ON')
+
+  def close(self):
+    self.db.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *_):
+    self.close()
+
+  def _key(self, archive):
+    stat = os.stat(archive.file.fileno())
+    header = archive.buf[:self.HEADER_HASH_SIZE] if archive.buf else b''
+    return (os.path.realpath(archive.filepath), type(archive).__name__,
+            stat.st_size, stat.st_mtime_ns,
+            hashlib.blake2b(header, digest_size=16).digest())
+
+  # Returns the cached members of archive, or None if the archive is not
+  # indexed or has changed since.
+  def load(self, archive):
+    path, fmt, size, mtime_ns, header_hash = self._key(archive)
+    try:
+      row = self.db.execute(
+          'SELECT id, size, mtime_ns, header_hash FROM archives '
+          'WHERE path = ? AND format = ?', (path, fmt)).fetchone()
+      if row is None or row[1:] != (size, mtime_ns, header_hash):
+        return None
+      return [
+          Member(name, member_path, offs, member_size, bool(compressed),
+                 uncompressed_size)
+          for name, member_path, offs, member_size, compressed,
+          uncompressed_size in self.db.execute(
+              'SELECT name, path, offset, size, compressed, uncompressed_size '
+              'FROM members WHERE archive_id = ? ORDER BY idx', (row[0],))
+      ]
+    except sqlite3.Error:
+      return None
+
+  def store(self, archive, members):
+    path, fmt, size, mtime_ns, header_hash = self._key(archive)
+    try:
+      with self.db:
+        self.db.execute('DELETE FROM archives WHERE path = ? AND format = ?',
+                        (path, fmt))
+        archive_id = self.db.execute(
+            'INSERT INTO archives (path, format, size, mtime_ns, header_hash) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (path, fmt, size, mtime_ns, header_hash)).lastrowid
+        self.db.executemany(
+            'INSERT INTO members VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            ((archive_id, i, m.name, m.path, m.offset, m.size,
+              int(m.compressed), m.uncompressed_size)
+             for i, m in enumerate(members)))
+    except sqlite3.Error as e:
+      print(f'Could not update archive index {self.dbpath}: {e}')
+
+
+# Returns the default ArchiveIndex, or None if it cannot be opened (e.g. on a
+# read-only home directory).
+def open_index(dbpath=None):
+  try:
+    return ArchiveIndex(dbpath)
+  except (OSError, sqlite3.Error) as e:
+    print(f'Archive index unavailable: {e}')
+    return None
+
+
+def file_crc32(path, chunk_size=DEFAULT_CHUNK_SIZE):
+  crc = 0
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+      crc = zlib.crc32(chunk, crc)
+  return crc
+
+
+# Record of the files extracted to an output directory, used to skip members
+# that were already extracted correctly. Every extracted member is appended to
+# the manifest as soon as it is written, so an interrupted extraction resumes
+# where it stopped. The manifest is rewritten without superseded entries when
+# closed.
+class Manifest:
+  FILENAME = '.manifest.jsonl'
+
+  def __init__(self, outdir):
+    self.outdir = outdir
+    self.path = os.path.join(outdir, self.FILENAME)
+    # {output path relative to outdir -> entry}
+    self.entries = dict()
+    self.lock = threading.Lock()
+    os.makedirs(outdir, exist_ok=True)
+    try:
+      with open(self.path, 'r', encoding='utf-8') as f:
+        for line in f:
+          try:
+            entry = json.loads(line)
+            self.entries[entry['path']] = entry
+          except (ValueError, KeyError, TypeError):
+            pass  # Partially written line
+    except FileNotFoundError:
+      pass
+    self.file = open(self.path, 'a', encoding='utf-8')
+
+  def close(self):
+    self.file.close()
+    tmppath = self.path + '.tmp'
+    with open(tmppath, 'w', encoding='utf-8') as f:
+      for entry in self.entries.values():
+        f.write(json.dumps(entry) + '\n')
+    os.replace(tmppath, self.path)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *_):
+    self.close()
+
+  def _relpath(self, outpath):
+    return os.path.relpath(outpath, self.outdir).replace(os.sep, '/')
+
+  # Returns whether member was already extracted to outpath. Outputs that are
+  # unchanged since they were recorded are trusted, others (or all of them
+  # with verify) are checked against the recorded CRC32.
+  def is_extracted(self, member, outpath, verify=False):
+    entry = self.entries.get(self._relpath(outpath))
+    if entry is None or (entry['name'], entry['offset'], entry['size'],
+                         entry['uncompressed_size']) != (
+                             member.name, member.offset, member.size,
+                             member.uncompressed_size):
+      return False
+    try:
+      stat = os.stat(outpath)
+    except OSError:
+      return False
+    if stat.st_size != (member.uncompressed_size
+                        if member.compressed else member.size):
+      return False  # Truncated
+    if not verify and stat.st_mtime_ns == entry['mtime_ns']:
+      return True
+    return file_crc32(outpath) == entry['crc32']
+
+  # Returns the members and matching outpaths that still need to be extracted.
+  def pending(self, members, outpaths, verify=False):
+    pending_members = []
+    pending_outpaths = []
+    for member, outpath in zip(members, outpaths):
+      if not self.is_extracted(member, outpath, verify):
+        pending_members.append(member)
+        pending_outpaths.append(outpath)
+    return pending_members, pending_outpaths
+
+  # Records that member was written to outpath, with the given CRC32 of its
+  # contents.
+  def add(self, member, outpath, crc):
+    entry = {
+        'path': self._relpath(outpath),
+        'name': member.name,
+        'offset': member.offset,
+        'size': member.size,
+        'uncompressed_size': member.uncompressed_size,
+        'crc32': crc,
+        'mtime_ns': os.stat(outpath).st_mtime_ns,
+    }
+    with self.lock:
+      self.entries[entry['path']] = entry
+      self.file.write(json.dumps(entry) + '\n')
+      self.file.flush()
+
+
+# Content-addressed store of extracted files. Every distinct payload is
+# written once to objects/ in the store, keyed by its BLAKE2b hash, and the
+# requested output paths are created as links to it (hardlinks, or reflinks
+# on filesystems that support them). Falls back to copies where links cannot
+# be created.
+class DedupeStore:
+  LINK_MODES = ('hardlink', 'reflink')
+  FICLONE = 0x40049409  # Linux ioctl to share the extents of a file
+
+  def __init__(self, storedir, link_mode='hardlink'):
+    if link_mode not in self.LINK_MODES:
+      raise ValueError(f'Unknown link mode {link_mode}')
+    self.storedir = storedir
+    self.link_mode = link_mode
+    self.lock = threading.Lock()
+    self.file_count = 0
+    self.total_bytes = 0
+    self.written_bytes = 0
+    # {digest -> size} of the payloads used by this run
+    self.payloads = dict()
+    os.makedirs(os.path.join(storedir, 'tmp'), exist_ok=True)
+
+  def object_path(self, digest):
+    return os.path.join(self.storedir, 'objects', digest[:2], digest)
+
+  # Extracts member of archive to outpath through the store. Returns the
+  # CRC32 of its contents and (digest, size, whether the payload was new to
+  # the store), to be passed to record().
+  def extract(self, archive, member, outpath, chunk_size=DEFAULT_CHUNK_SIZE):
+    member = archive._member(member)
+    hasher = hashlib.blake2b(digest_size=20)
+    tmppath = os.path.join(self.storedir, 'tmp',
+                           f'{os.getpid()}-{threading.get_ident()}')
+    size = 0
+    crc = 0
+    # Keep the output while hashing rather than reading the member twice, and
+    # drop it if the store already has the payload.
+    with open(tmppath, 'wb') as f:
+      for chunk in archive.stream(member, chunk_size):
+        hasher.update(chunk)
+        crc = zlib.crc32(chunk, crc)
+        f.write(chunk)
+        size += len(chunk)
+    digest = hasher.hexdigest()
+    objpath = self.object_path(digest)
+    is_new = not os.path.exists(objpath)
+    if is_new:
+      os.makedirs(os.path.dirname(objpath), exist_ok=True)
+      os.replace(tmppath, objpath)
+    else:
+      os.remove(tmppath)
+    self._link(objpath, outpath)
+    return crc, (digest, size, is_new)
+
+  def _link(self, objpath, outpath):
+    if os.path.lexists(outpath):
+      os.remove(outpath)
+    try:
+      if self.link_mode == 'hardlink':
+        os.link(objpath, outpath)
+        return
+      if fcntl is not None:
+        with open(objpath, 'rb') as fsrc, open(outpath, 'wb') as fdst:
+          fcntl.ioctl(fdst.fileno(), self.FICLONE, fsrc.fileno())
+        return
+    except OSError:
+      pass
+    shutil.copyfile(objpath, outpath)
+
+  # Adds the result of extract() to the statistics of the report.
+  def record(self, digest, size, is_new):
+    with self.lock:
+      self.file_count += 1
+      self.total_bytes += size
+      self.payloads[digest] = size
+      if is_new:
+        self.written_bytes += size
+
+  # Statistics of the report, to be combined across processes with
+  # add_stats().
+  def stats(self):
+    return (self.file_count, self.total_bytes, self.written_bytes,
+            self.payloads)
+
+  def add_stats(self, stats):
+    file_count, total_bytes, written_bytes, payloads = stats
+    with self.lock:
+      self.file_count += file_count
+      self.total_bytes += total_bytes
+      self.written_bytes += written_bytes
+      self.payloads.update(payloads)
+
+  def report(self):
+    unique_bytes = sum(self.payloads.values())
+    saved = 1 - unique_bytes / self.total_bytes if self.total_bytes else 0
+    return (f'Deduplicated {self.file_count} files ({self.total_bytes} bytes) '
+            f'into {len(self.payloads)} unique payloads ({unique_bytes} bytes, '
+            f'{saved:.1%} saved). Wrote {self.written_bytes} new bytes to '
+            f'{self.storedir}.')
+
+
+# Adds the options of the deduplicated output mode shared by the extractors.
+def add_dedupe_args(parser):
+  parser.add_argument('--dedupe', metavar='STORE',
+                      help='Write each distinct file once to the STORE '
+                      'directory and link the extracted files to it')
+  parser.add_argument('--dedupe-link', choices=DedupeStore.LINK_MODES,
+                      default='hardlink',
+                      help='How extracted files are linked to the store '
+                      '(default: %(default)s)')
+
+
+# Returns the DedupeStore requested by the options of add_dedupe_args, or None.
+def open_dedupe_store(args):
+  if not args.dedupe:
+    return None
+  return DedupeStore(args.dedupe, args.dedupe_link)
+
+
+# Adds the member selection and listing options shared by the extractors.
+def add_selection_args(parser):
+  parser.add_argument('--list', action='store_true',
+                      help='List the selected files instead of extracting them')
+  parser.add_argument('--json', action='store_true',
+                      help='Print the catalog of the selected files as JSON '
+                      'instead of extracting them')
+  parser.add_argument('--include', action='append', metavar='PATTERN',
+                      help='Only select files whose path matches PATTERN '
+                      '(can be repeated)')
+  parser.add_argument('--exclude', action='append', metavar='PATTERN',
+                      help='Skip files whose path matches PATTERN (can be '
+                      'repeated)')
+  parser.add_argument('--regex', action='store_true',
+                      help='Treat --include/--exclude patterns as regular '
+                      'expressions instead of globs')
+
+
+def _compile_patterns(patterns, regex):
+  if regex:
+    return [re.compile(pattern, re.IGNORECASE) for pattern in patterns or []]
+  return [
+      re.compile(r'\A' + fnmatch.translate(pattern), re.IGNORECASE)
+      for pattern in patterns or []
+  ]
+
+
+# Returns the members whose paths match any of the include patterns (or all
+# members without include patterns) and none of the exclude patterns. Globs
+# must match the whole path, regular expressions any part of it. Only the
+# catalog is used, no member data is read.
+def select_members(members, include=None, exclude=None, regex=False):
+  include = _compile_patterns(include, regex)
+  exclude = _compile_patterns(exclude, regex)
+  return [
+      member for member in members
+      if (not include or any(p.search(member.path) for p in include)) and
+      not any(p.search(member.path) for p in exclude)
+  ]
+
+
+# Selects members from an archive as requested by the options of
+# add_selection_args. Returns None after printing the selection if listing
+# was requested.
+def select_from_args(archive, args):
+  members = select_members(archive, args.include, args.exclude, args.regex)
+  if args.json:
+    json.dump([member._asdict() for member in members], sys.stdout, indent=2)
+    print()
+    return None
+  if args.list:
+    for member in members:
+      print(f'{member.offset:#010x} {member.size:>10} {member.path}')
+    print(f'{len(members)} of {len(archive)} files')
+    return None
+  return members
+
+
+class Archive:
+  OUTPUT_DIR_SUFFIX = ''
+
+  # If index is given, the catalog is read from and saved to it. rebuild_index
+  # ignores any cached catalog. If members is given, it is used as the catalog
+  # instead.
+  def __init__(self, filepath, index=None, rebuild_index=False, members=None):
+    self.filepath = filepath
+    self.file = open(filepath, 'rb')
+    self.filesize = os.path.getsize(filepath)
+    self.buf = None
+    if self.filesize > 0:
+      self.buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    self.members = members
+    try:
+      if self.members is None and index is not None and not rebuild_index:
+        self.members = index.load(self)
+      if self.members is None:
+        self.members = self.read_catalog()
+        if index is not None:
+          index.store(self, self.members)
+    except Exception:
+      self.close()
+      raise
+    # {path -> member}, built on first lookup by path.
+    self.member_map = None
+
+  # Parses the table of contents. Implemented by each format.
+  def read_catalog(self):
+    raise NotImplementedError
+
+  # Returns the directory the extractors write the members of the archive at
+  # filepath to: a directory named after the archive, next to it.
+  @classmethod
+  def output_dir(cls, filepath):
+    basename = os.path.splitext(os.path.basename(filepath))[0]
+    outdir = os.path.join(os.path.dirname(filepath),
+                          basename + cls.OUTPUT_DIR_SUFFIX)
+    if os.path.isfile(outdir):
+      outdir += '_out'
+    return outdir
+
+  # Returns the path member is extracted to under outdir.
+  @staticmethod
+  def output_path(outdir, member):
+    return os.path.join(outdir, *member.path.split('/'))
+
+  def close(self):
+    if self.buf is not None:
+      try:
+        self.buf.close()
+      except BufferError:
+        pass  # Unmapped once the last memoryview into it is released.
+      self.buf = None
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *_):
+    self.close()
+
+  def __iter__(self):
+    return iter(self.members)
+
+  def __len__(self):
+    return len(self.members)
+
+  # Returns a member by index or by path.
+  def __getitem__(self, key):
+    if isinstance(key, int):
+      return self.members[key]
+    member = self.find(key)
+    if member is None:
+      raise KeyError(key)
+    return member
+
+  def find(self, path):
+    if self.member_map is None:
+      self.member_map = {member.path: member for member in self.members}
+    return self.member_map.get(_normpath(path))
+
+  def _member(self, member):
+    return member if isinstance(member, Member) else self[member]
+
+  def _check_bounds(self, offs, size):
+    if offs < 0 or size < 0 or offs + size > self.filesize:
+      raise ArchiveError(
+          f'Data at {hex(offs)} ({size} bytes) is outside of {self.filepath}')
+
+  # Returns the stored bytes of a member as a memoryview into the archive.
+  def read_raw(self, member):
+    member = self._member(member)
+    self._check_bounds(member.offset, member.size)
+    return memoryview(self.buf)[member.offset:member.offset + member.size]
+
+  # Returns the contents of a member. Uncompressed members are returned as a
+  # memoryview into the archive without copying.
+  def open(self, member):
+    member = self._member(member)
+    raw = self.read_raw(member)
+    if not member.compressed:
+      return raw
+    return memoryview(self.decompress(raw, member))
+
+  # Returns the contents of a member in a buffer of its own. Unlike open(),
+  # uncompressed members are read through a separate file handle, so the
+  # reads happen in the calling thread and the result stays valid after the
+  # archive is closed.
+  def read(self, member):
+    member = self._member(member)
+    if member.compressed:
+      return self.open(member)
+    self._check_bounds(member.offset, member.size)
+    view = memoryview(bytearray(member.size))
+    self._read_into(member.offset, view)
+    return view
+
+  # Fills view with the archive data at offs, read through a separate file
+  # handle.
+  def _read_into(self, offs, view):
+    with open(self.filepath, 'rb', buffering=0) as f:
+      f.seek(offs)
+      pos = 0
+      while pos < len(view):
+        read_size = f.readinto(view[pos:])
+        if not read_size:
+          raise ArchiveError(f'Unexpected end of {self.filepath}')
+        pos += read_size
+
+  # Yields the contents of a member in chunks of at most chunk_size bytes.
+  # Uncompressed members are read into a single reused buffer, so each chunk
+  # is only valid until the next one is requested.
+  def stream(self, member, chunk_size=DEFAULT_CHUNK_SIZE):
+    member = self._member(member)
+    if member.compressed:
+      self._check_bounds(member.offset, member.size)
+      # Like _read_chunks, read the stored bytes through a separate file
+      # handle rather than the mmap.
+      with open(self.filepath, 'rb') as f:
+
+        def read(offs, size):
+          f.seek(member.offset + offs)
+          return f.read(max(0, min(size, member.size - offs)))
+
+        for data in self.decompress_iter(read, member):
+          for offs in range(0, len(data), chunk_size):
+            yield data[offs:offs + chunk_size]
+      return
+    self._check_bounds(member.offset, member.size)
+    yield from self._read_chunks(member.offset, member.size, chunk_size)
+
+  # Reads the archive through a separate file handle rather than the mmap,
+  # so that memory use does not grow with the amount of data read.
+  def _read_chunks(self, offs, size, chunk_size):
+    end_offs = offs + size
+    view = memoryview(bytearray(min(chunk_size, size)))
+    with open(self.filepath, 'rb', buffering=0) as f:
+      f.seek(offs)
+      while offs < end_offs:
+        read_size = f.readinto(view[:min(chunk_size, end_offs - offs)])
+        if not read_size:
+          raise ArchiveError(f'Unexpected end of {self.filepath}')
+        offs += read_size
+        yield view[:read_size]
+
+  # Decompresses the stored bytes of a member. Implemented by formats that
+  # support compression.
+  def decompress(self, raw, member):
+    raise ArchiveError(f'{member.path} cannot be decompressed')
+
+  # Yields the decompressed contents of a member in chunks, reading its stored
+  # bytes with read(offs, size). Formats that can decompress incrementally
+  # override this to keep memory use bounded.
+  def decompress_iter(self, read, member):
+    yield self.decompress(read(0, member.size), member)
+
+  # Writes the contents of a member to outpath. Uncompressed members are
+  # copied by the kernel where possible (copy_file_range, then sendfile),
+  # without passing through Python buffers. Otherwise they are copied in
+  # chunks of chunk_size bytes. Compressed members are written as they are
+  # decompressed. Returns the CRC32 of the contents.
+  def extract_member(self, member, outpath, chunk_size=DEFAULT_CHUNK_SIZE):
+    member = self._member(member)
+    # Replace rather than overwrite existing files, which may be hardlinks
+    # into a DedupeStore.
+    if os.path.lexists(outpath):
+      os.remove(outpath)
+    with open(outpath, 'wb') as fout:
+      if member.compressed:
+        crc = 0
+        for chunk in self.stream(member, chunk_size):
+          crc = zlib.crc32(chunk, crc)
+          fout.write(chunk)
+        return crc
+      self._check_bounds(member.offset, member.size)
+      return self._copy_range(member.offset, member.size, fout.fileno(),
+                              chunk_size)
+
+  # Returns the CRC32 of the copied range. That of the part copied by the
+  # kernel is computed over the mmap, that of the rest over the chunks as they
+  # are written.
+  def _copy_range(self, offs, size, out_fd, chunk_size):
+    in_fd = self.file.fileno()
+    start_offs = offs
+    end_offs = offs + size
+    # Source offsets are always passed explicitly, so the archive file can be
+    # shared by several threads.
+    if hasattr(os, 'copy_file_range'):
+      try:
+        while offs < end_offs:
+          copied = os.copy_file_range(in_fd, out_fd, end_offs - offs, offs)
+          if copied == 0:
+            break
+          offs += copied
+      except OSError as e:
+        if e.errno not in _UNSUPPORTED_COPY_ERRNOS:
+          raise
+    if offs < end_offs and hasattr(os, 'sendfile'):
+      try:
+        while offs < end_offs:
+          copied = os.sendfile(out_fd, in_fd, offs, end_offs - offs)
+          if copied == 0:
+            break
+          offs += copied
+      except OSError as e:
+        if e.errno not in _UNSUPPORTED_COPY_ERRNOS:
+          raise
+    crc = 0
+    if offs > start_offs:
+      with memoryview(self.buf) as view, view[start_offs:offs] as copied:
+        crc = zlib.crc32(copied)
+    if offs < end_offs:
+      for chunk in self._read_chunks(offs, end_offs - offs, chunk_size):
+        crc = zlib.crc32(chunk, crc)
+        while chunk:
+          chunk = chunk[os.write(out_fd, chunk):]
+    return crc
+
+  # Extracts members to the matching paths of outpaths using a pool of
+  # threads. Output directories are created up front. on_extract(member,
+  # outpath) is called from the worker threads before each member is written.
+  #
+  # Members are extracted in the order of their data in the archive rather
+  # than in the given order, so that the archive is read front to back. With
+  # coalesce_size, members whose data are next to each other are extracted
+  # together with a single read of up to coalesce_size bytes, rather than
+  # one read each. This is not used with dedupe.
+  #
+  # With use_processes, members are extracted by a pool of processes instead,
+  # each with its own mapping of the archive. This is faster for compressed
+  # members, whose decompression holds the GIL. on_extract is then called
+  # from this process, in archive order, once each member is written.
+  # Scripts using processes must guard their entry point with
+  # `if __name__ == '__main__'`.
+  #
+  # If manifest is given, every member is recorded in it once written. If
+  # dedupe is given (a DedupeStore), members are written through the store.
+  def extract(self,
+              members,
+              outpaths,
+              max_workers=None,
+              on_extract=None,
+              chunk_size=DEFAULT_CHUNK_SIZE,
+              use_processes=False,
+              manifest=None,
+              dedupe=None,
+              coalesce_size=0):
+    members = [self._member(member) for member in members]
+    outpaths = list(outpaths)
+    for dirpath in sorted({os.path.dirname(path) for path in outpaths}):
+      if dirpath:
+        os.makedirs(dirpath, exist_ok=True)
+    runs = _coalesce(
+        sorted(zip(members, outpaths), key=lambda job: job[0].offset),
+        coalesce_size if dedupe is None else 0)
+
+    if use_processes:
+      max_workers = max_workers or os.cpu_count() or 1
+      with concurrent.futures.ProcessPoolExecutor(
+          max_workers,
+          initializer=_init_worker,
+          initargs=(type(self), self.filepath)) as executor:
+        chunksize = max(1, len(runs) // (max_workers * 4))
+        dedupe_args = None
+        if dedupe is not None:
+          dedupe_args = (dedupe.storedir, dedupe.link_mode)
+        results = executor.map(_extract_in_worker,
+                               runs,
+                               itertools.repeat(chunk_size),
+                               itertools.repeat(dedupe_args),
+                               chunksize=chunksize)
+        for run, run_results in zip(runs, results):
+          for (member, outpath), (crc, stored) in zip(run, run_results):
+            if dedupe is not None:
+              dedupe.record(*stored)
+            if manifest is not None:
+              manifest.add(member, outpath, crc)
+            if on_extract:
+              on_extract(member, outpath)
+      return
+
+    def extract_run(run):
+      run_results = self._extract_run(run, chunk_size, dedupe, on_extract)
+      for (member, outpath), (crc, stored) in zip(run, run_results):
+        if dedupe is not None:
+          dedupe.record(*stored)
+        if manifest is not None:
+          manifest.add(member, outpath, crc)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+      # Consume results to raise the first error, if any.
+      for _ in executor.map(extract_run, runs):
+        pass
+
+  # Writes a run of [(member, outpath)] from _coalesce. Returns (CRC32 of the
+  # contents, result of DedupeStore.extract if dedupe is given) for each
+  # member. With dedupe, members are extracted one at a time, as the store
+  # reads them itself.
+  def _extract_run(self, run, chunk_size, dedupe=None, on_extract=None):
+    if len(run) == 1 or dedupe is not None:
+      return [
+          self._extract_one(member, outpath, chunk_size, dedupe, on_extract)
+          for member, outpath in run
+      ]
+
+    start = run[0][0].offset
+    end = max(member.offset + member.size for member, _ in run)
+    self._check_bounds(start, end - start)
+    span = memoryview(bytearray(end - start))
+    self._read_into(start, span)
+    results = []
+    for member, outpath in run:
+      if on_extract:
+        on_extract(member, outpath)
+      raw = span[member.offset - start:member.offset - start + member.size]
+      if os.path.lexists(outpath):
+        os.remove(outpath)
+      with open(outpath, 'wb') as fout:
+        if member.compressed:
+          crc = 0
+          for chunk in self.decompress_iter(
+              lambda offs, size: raw[offs:offs + size], member):
+            crc = zlib.crc32(chunk, crc)
+            fout.write(chunk)
+        else:
+          crc = zlib.crc32(raw)
+          fout.write(raw)
+      results.append((crc, None))
+    return results
+
+  def _extract_one(self, member, outpath, chunk_size, dedupe, on_extract):
+    if on_extract:
+      on_extract(member, outpath)
+    if dedupe is not None:
+      return dedupe.extract(self, member, outpath, chunk_size)
+    return self.extract_member(member, outpath, chunk_size), None
+
+  # Extracts members (by default, all of them) to outdir (by default, the
+  # output directory of the format) the way the extractors do: output paths
+  # follow member paths, with suffix appended, and members that the manifest
+  # of outdir shows are already extracted are skipped. The other arguments
+  # are passed to extract(). Returns the extracted members and the number of
+  # skipped members.
+  def extract_all(self,
+                  members=None,
+                  outdir=None,
+                  max_workers=None,
+                  on_extract=None,
+                  chunk_size=DEFAULT_CHUNK_SIZE,
+                  use_processes=False,
+                  verify=False,
+                  dedupe=None,
+                  suffix='',
+                  coalesce_size=0):
+    if members is None:
+      members = self.members
+    members = [self._member(member) for member in members]
+    if outdir is None:
+      outdir = self.output_dir(self.filepath)
+    with Manifest(outdir) as manifest:
+      pending, outpaths = manifest.pending(
+          members, [self.output_path(outdir, m) + suffix for m in members],
+          verify)
+      self.extract(pending, outpaths, max_workers, on_extract, chunk_size,
+                   use_processes, manifest, dedupe, coalesce_size)
+    return pending, len(members) - len(pending)
+
+
+# Yields (path, contents) of members of archive (by default, all of them) in
+# order, as memoryviews that stay valid after the archive is closed. Up to
+# concurrency members are read and decompressed ahead in threads, so that
+# consumers can process each member while the next ones are being read.
+#
+#   async for path, data in archiveutil.iter_members_async(archive):
+#     ...
+async def iter_members_async(archive, members=None, concurrency=4):
+  if members is None:
+    members = archive.members
+  members = iter([archive._member(member) for member in members])
+  loop = asyncio.get_running_loop()
+  executor = concurrent.futures.ThreadPoolExecutor(concurrency)
+  # [(member, future of its contents)] in member order
+  pending = collections.deque()
+
+  def submit(member):
+    pending.append(
+        (member, loop.run_in_executor(executor, archive.read, member)))
+
+  try:
+    for member in itertools.islice(members, concurrency):
+      submit(member)
+    while pending:
+      member, future = pending.popleft()
+      data = await future
+      next_member = next(members, None)
+      if next_member is not None:
+        submit(next_member)
+      yield member.path, data
+  finally:
+    for _, future in pending:
+      future.cancel()
+    executor.shutdown(wait=False)
+
+
+# Archive opened by each worker process of Archive.extract. Members are
+# passed with every job, so the catalog is not read again.
+_worker_archive = None
+# {(store directory, link mode) -> DedupeStore} of the worker process.
+_worker_stores = dict()
+
+
+def _init_worker(archive_cls, filepath):
+  global _worker_archive
+  _worker_archive = archive_cls(filepath, members=[])
+
+
+# Extracts a run of [(member, outpath)] from _coalesce. Returns the CRC32 of
+# each output and the result of DedupeStore.extract (if dedupe_args are
+# given).
+def _extract_in_worker(run, chunk_size, dedupe_args):
+  dedupe = None
+  if dedupe_args is not None:
+    if dedupe_args not in _worker_stores:
+      _worker_stores[dedupe_args] = DedupeStore(*dedupe_args)
+    dedupe = _worker_stores[dedupe_args]
+  return _worker_archive._extract_run(run, chunk_size, dedupe)
+
+
+# Groups [(member, outpath)] sorted by member offset into runs of members
+# whose data are at most COALESCE_GAP bytes apart and span at most max_size
+# bytes. Without max_size, every member is a run of its own.
+def _coalesce(jobs, max_size):
+  if max_size <= 0:
+    return [[job] for job in jobs]
+  runs = []
+  run_start = run_end = 0
+  for job in jobs:
+    member = job[0]
+    member_end = member.offset + member.size
+    if (runs and member.offset - run_end <= COALESCE_GAP and
+        max(run_end, member_end) - run_start <= max_size):
+      runs[-1].append(job)
+      run_end = max(run_end, member_end)
+    else:
+      runs.append([job])
+      run_start = member.offset
+      run_end = member_end
+  return runs
+
+
+# Silent Hill 3 .AFS archives. The file name table is referenced at 0x7FFF8.
+class AfsArchive(Archive):
+  NAME_TABLE_PTR_OFFS = 0x7FFF8
+  OUTPUT_DIR_SUFFIX = '_afs'
+
+  def read_catalog(self):
+    buf = self.buf
+    if self.filesize < 0x8 or bytes(buf[:3]) != b'AFS':
+      raise ArchiveError(f'{self.filepath} is not an AFS archive')
+    num_files = struct.unpack_from('<I', buf, 0x4)[0]
+    if 0x8 + num_files * 0x8 > self.filesize:
+      raise ArchiveError(f'Invalid file count {num_files}')
+    entries = struct.unpack_from(f'<{num_files * 2}I', buf, 0x8)
+    filename_table_offs = struct.unpack_from('<I', buf,
+                                             self.NAME_TABLE_PTR_OFFS)[0]
+    members = []
+    for i in range(num_files):
+      name = _getstring(buf, filename_table_offs + i * 0x30, 0x20)
+      offs, size = entries[i * 2], entries[i * 2 + 1]
+      members.append(Member(name, _normpath(name), offs, size, False, size))
+    return members
+
+
+# Silent Hill 3 .MFA archives, made of chained blocks that each start with a
+# file table.
+class MfaArchive(Archive):
+  def read_catalog(self):
+    buf = self.buf
+    if self.filesize < 0xD8:
+      raise ArchiveError(f'{self.filepath} is not an MFA archive')
+    # First block in the MFA archive starts with a Python script used in Team Silent's toolchain?
+    offs = 0xB8 if buf[0x60] == 0x4E else 0xD8
+
+    members = []
+    block_index = -1
+    block_offs = 0
+    while offs < self.filesize:
+      block_index += 1
+      num_files, total_bytesize = struct.unpack_from('<iI', buf, offs)
+      if num_files < 0:
+        raise ArchiveError(
+            f'Unexpected start of block, expected file count at {hex(offs)}')
+
+      for i, (name_offs, data_offs, _, data_size) in enumerate(
+          struct.iter_unpack('<4I', buf[offs + 0x8:offs + 0x8 +
+                                        num_files * 0x10])):
+        name_offs += block_offs
+        data_offs += block_offs + 0x800
+        name_end_offs = buf.find(b'\0', name_offs)
+        if name_end_offs < 0:
+          name_end_offs = self.filesize
+        name = bytes(buf[name_offs:name_end_offs]).decode(
+            encoding='ascii', errors='replace').strip()
+        if len(name) == 0:
+          name = f'_unnamed_{i}_{block_index}.bin'
+        members.append(
+            Member(name, _normpath(name), data_offs, data_size, False,
+                   data_size))
+
+      block_offs += total_bytesize + 0x800
+      offs = block_offs + 0x8
+    return members
+
+
+# Rule of Rose RTPK archives. Tables are parsed once when the archive is
+# opened, then members are looked up by index or name in constant time, e.g.
+# archive.open(1) for the model of an .MDL file.
+class RpkArchive(Archive):
+  def read_catalog(self):
+    buf = self.buf
+    if self.filesize < 0x20 or bytes(buf[:4]) != b'RTPK':
+      raise ArchiveError(f'{self.filepath} is not an RTPK archive')
+    total_size = struct.unpack_from('<I', buf, 0x4)[0]
+    flags = buf[0xA]
+    num_files = struct.unpack_from('<H', buf, 0xE)[0]
+    nametable_size = struct.unpack_from('<I', buf, 0x10)[0]
+
+    offs = 0x20
+    if flags & 0x3 == 0x2:  # Offset table only
+      file_offsets = struct.unpack_from(f'<{num_files}I', buf, offs)
+      offs += num_files * 0x4
+      file_sizes = [
+          end - start
+          for start, end in zip(file_offsets, file_offsets[1:] +
+                                (total_size,))
+      ]
+    elif flags & 0x3 == 0x3:  # Size and offset tables
+      file_sizes = struct.unpack_from(f'<{num_files}I', buf, offs)
+      offs += num_files * 0x4
+      file_offsets = struct.unpack_from(f'<{num_files}I', buf, offs)
+      offs += num_files * 0x4
+    else:
+      raise ArchiveError(f'Unknown RPK format {hex(flags)}')
+
+    if flags & 0x10:
+      # Unknown index table (0, 1, 2, 3...)?
+      offs += num_files * 0x2
+
+    if nametable_size > 0:
+      names = [
+          name.decode('ascii', errors='replace')
+          for name in bytes(buf[offs:offs + nametable_size]).split(b'\0')
+      ][:num_files]
+    else:
+      names = [f'unnamed_{i}.bin' for i in range(num_files)]
+
+    return [
+        Member(name, _normpath(name), offs, size, False, size)
+        for name, offs, size in zip(names, file_offsets, file_sizes)
+    ]
+
+
+# Gitaroo Man XGM archives. Each entry header is directly followed by the
+# member data.
+class XgmArchive(Archive):
+  @classmethod
+  def output_dir(cls, filepath):
+    return f'{filepath}.out'
+
+  def read_catalog(self):
+    buf = self.buf
+    if self.filesize < 0x8:
+      raise ArchiveError(f'{self.filepath} is not an XGM archive')
+    texture_count, model_count = struct.unpack_from('<II', buf, 0)
+    offs = 0x8
+    members = []
+    for _ in range(texture_count + model_count):
+      if offs + 0x118 > self.filesize:
+        break
+      filepath = bytes(buf[offs:offs + 0x100]).rstrip(b'\0')
+      if not filepath:
+        break
+      name = _getstring(buf, offs + 0x100, 0x10)
+      size = struct.unpack_from('<I', buf, offs + 0x114)[0]
+      offs += 0x118
+      if '.IMX' in name:
+        offs += 0x18
+      else:
+        anim_count = struct.unpack_from('<I', buf, offs)[0]
+        offs += anim_count * 0x20 + 0x8
+      members.append(Member(name, _normpath(name), offs, size, False, size))
+      offs += size
+    return members
+
+
+# Musashi: Samurai Legend TLD table inside the game ISO. Files whose name
+# does not start with 'G' are stored raw (movies). Other files are groups of
+# resources, which hold CD members that may be compressed. Group members are
+# named '<file>/<resource id>/<member>'.
+class TldArchive(Archive):
+  SECTOR_SIZE = 0x800
+
+  # SLUS_209.83
+  TLD_OFFSET = 0x6BC1B380
+  TLD_FILE_COUNT = 0x15
+  TLD_NAME_TABLE_OFFSET = 0x6BCEE248
+
+  # Members are extracted to a directory shared by the whole disc.
+  @classmethod
+  def output_dir(cls, filepath):
+    return os.path.join(os.path.dirname(filepath), 'extract-all')
+
+  # Static name, file sector, last file sector, sector size...
+  TLD_ENTRY = struct.Struct('<8I')
+  # Resource id, sector offset, sector size, unknown. Ends with a zero size.
+  GROUP_ENTRY = struct.Struct('<4I')
+  # Name, uncompressed size, sector size, sector offset, flags, unknown. Ends
+  # with an empty name.
+  CDM_ENTRY = struct.Struct('<16sI12x4I')
+
+  # Returns [(name, sector, sector size)] of the TLD files of the disc image of
+  # filesize bytes read through read(offs, size), or None if the image does
+  # not hold a valid TLD table where SLUS_209.83 has it.
+  @classmethod
+  def read_tld_table(cls, read, filesize):
+    names_end = cls.TLD_NAME_TABLE_OFFSET + cls.TLD_FILE_COUNT * 0x8
+    entries_end = cls.TLD_OFFSET + cls.TLD_FILE_COUNT * cls.TLD_ENTRY.size
+    if filesize < max(names_end, entries_end):
+      return None
+    names = [
+        _cstring(name) for name, in struct.iter_unpack(
+            '8s', read(cls.TLD_NAME_TABLE_OFFSET, names_end -
+                       cls.TLD_NAME_TABLE_OFFSET))
+    ]
+    files = [(sector, sector_size)
+             for _, _, sector, _, _, _, sector_size, _ in
+             cls.TLD_ENTRY.iter_unpack(
+                 read(cls.TLD_OFFSET, entries_end - cls.TLD_OFFSET))]
+    for name, (sector, sector_size) in zip(names, files):
+      if not name or not name.isascii() or not name.isprintable():
+        return None
+      if (sector + sector_size) * cls.SECTOR_SIZE > filesize:
+        return None
+    return [(name, sector, sector_size)
+            for name, (sector, sector_size) in zip(names, files)]
+
+  # Tables are decoded in bulk with Struct.iter_unpack, rather than with a
+  # call per field.
+  def read_catalog(self):
+    buf = self.buf
+    tld_table = self.read_tld_table(lambda offs, size: buf[offs:offs + size],
+                                    self.filesize)
+    if tld_table is None:
+      raise ArchiveError(f'{self.filepath} is not a supported ISO')
+
+    members = []
+    for filename, sector, sector_size in tld_table:
+      if filename[:1] != 'G':
+        # Raw file (movie)
+        size = sector_size * self.SECTOR_SIZE
+        members.append(
+            Member(filename, filename, sector * self.SECTOR_SIZE, size, False,
+                   size))
+        continue
+
+      # Data group
+      group_entries = []
+      for rsrc_id, g_sector_offs, g_sector_size, _ in _iter_table(
+          buf, sector * self.SECTOR_SIZE, self.GROUP_ENTRY):
+        if g_sector_size == 0:
+          break
+        group_entries.append((rsrc_id, g_sector_offs))
+
+      for rsrc_id, g_sector_offs in group_entries:
+        rsrc_sector = sector + g_sector_offs
+        for (cdm_name, cdm_size_uncompressed, cdm_sector_size,
+             cdm_sector_offs, flags, _) in _iter_table(
+                 buf, rsrc_sector * self.SECTOR_SIZE, self.CDM_ENTRY):
+          cdm_name = _cstring(cdm_name)
+          if not cdm_name:
+            break
+          members.append(
+              Member(cdm_name, f'{filename}/{rsrc_id}/{cdm_name}',
+                     (rsrc_sector + cdm_sector_offs) * self.SECTOR_SIZE,
+                     cdm_sector_size * self.SECTOR_SIZE, flags > 0,
+                     cdm_size_uncompressed))
+    return members
+
+  def decompress(self, raw, member):
+    try:
+      return lzutil.decompress(raw, member.uncompressed_size)
+    except lzutil.LzError as e:
+      raise ArchiveError(f'{member.path}: {e}')
+
+  def decompress_iter(self, read, member):
+    try:
+      yield from lzutil.decompress_read_iter(read, member.size,
+                                             member.uncompressed_size)
+    except lzutil.LzError as e:
+      raise ArchiveError(f'{member.path}: {e}')
+
+
+
+ISO_MAGIC_OFFS = 0x8001  # 'CD001' of the primary volume descriptor
+DETECT_SIZE = ISO_MAGIC_OFFS + 0x5
+
+
+def _looks_like_xgm(head):
+  if len(head) < 0x118:
+    return False
+  texture_count, model_count = struct.unpack_from('<II', head, 0)
+  if not 0 < texture_count + model_count < 0x10000:
+    return False
+  filepath = head[0x8:0x108].split(b'\0')[0]
+  name = head[0x108:0x118].split(b'\0')[0]
+  return bool(filepath and name) and all(
+      0x20 <= c < 0x7F for c in filepath + name)
+
+
+def _looks_like_tld(f):
+  filesize = os.fstat(f.fileno()).st_size
+
+  def read(offs, size):
+    f.seek(offs)
+    return f.read(size)
+
+  return TldArchive.read_tld_table(read, filesize) is not None
+
+
+# Returns the Archive subclass that reads the file at path, from the magic at
+# its start, or None if it is not a supported archive. MFA archives have no
+# magic, so they are recognized by extension. Disc images, with a volume
+# descriptor or an .iso extension, are only supported if they hold the TLD
+# table of Musashi: Samurai Legend.
+def detect_archive_class(path):
+  with open(path, 'rb') as f:
+    head = f.read(DETECT_SIZE)
+    if head[:4] == b'RTPK':
+      return RpkArchive
+    if head[:3] == b'AFS':
+      return AfsArchive
+    ext = os.path.splitext(path)[1].lower()
+    if head[ISO_MAGIC_OFFS:ISO_MAGIC_OFFS + 5] == b'CD001' or ext == '.iso':
+      return TldArchive if _looks_like_tld(f) else None
+  if _looks_like_xgm(head):
+    return XgmArchive
+  if ext == '.mfa':
+    return MfaArchive
+  return None
@@ -0,0 +1,177 @@
+# Extracts many archives at once, in any of the formats read by archiveutil,
+# with one archive per worker process.
+
+import argparse
+import concurrent.futures
+import glob
+import os
+import sys
+import time
+
+from archiveutil import archiveutil
+
+
+# Returns [(path, archive class)] of the archives found in inputs (files,
+# directories searched recursively, or glob patterns), and [(path, error)] of
+# the inputs that are not supported archives. Files found in directories that
+# are not archives are skipped silently.
+def find_archives(inputs):
+  archives = []
+  errors = []
+  seen = set()
+
+  def add(path, explicit):
+    realpath = os.path.realpath(path)
+    if realpath in seen:
+      return
+    seen.add(realpath)
+    try:
+      archive_cls = archiveutil.detect_archive_class(path)
+    except OSError as e:
+      errors.append((path, str(e)))
+      return
+    if archive_cls is not None:
+      archives.append((path, archive_cls))
+    elif explicit:
+      errors.append((path, 'Not a supported archive'))
+
+  for pattern in inputs:
+    if os.path.exists(pattern):
+      paths = [pattern]
+    else:
+      paths = sorted(glob.glob(pattern, recursive=True))
+      if not paths:
+        errors.append((pattern, 'No such file or directory'))
+    for path in paths:
+      if not os.path.isdir(path):
+        add(path, True)
+        continue
+      for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+          if not filename.startswith('.'):
+            add(os.path.join(dirpath, filename), False)
+  return archives, errors
+
+
+# Extracts the selected members of one archive the same way its extractor
+# does. Returns (extracted file count, skipped file count, extracted bytes,
+# dedupe store statistics or None).
+def extract_archive(path, archive_cls, args):
+  index = archiveutil.open_index()
+  try:
+    archive = archive_cls(path, index, args.rebuild_index)
+  finally:
+    if index is not None:
+      index.close()
+  with archive:
+    members = archiveutil.select_members(archive, args.include, args.exclude,
+                                         args.regex)
+    dedupe = archiveutil.open_dedupe_store(args)
+    extracted, skipped = archive.extract_all(members,
+                                             max_workers=args.threads,
+                                             chunk_size=args.chunk_size,
+                                             verify=args.verify,
+                                             dedupe=dedupe)
+  return (len(extracted), skipped,
+          sum(m.uncompressed_size for m in extracted),
+          dedupe.stats() if dedupe else None)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='''
+  Extracts all the AFS, MFA, RPK and XGM archives and Musashi: Samurai Legend
+  ISOs found in the given files, directories or glob patterns. The format of
+  each archive is detected from its contents, and files are extracted where
+  the extractor of the format would put them.
+  ''')
+  parser.add_argument('inputs', nargs='+', metavar='PATH',
+                      help='Archive, directory to search for archives, or '
+                      'glob pattern (e.g. "DATA/**/*.AFS")')
+  parser.add_argument('-j', '--jobs', type=int,
+                      help='Number of archives to extract concurrently '
+                      '(default: number of CPUs)')
+  parser.add_argument('--threads', type=int, default=1,
+                      help='Number of files to extract concurrently from each '
+                      'archive (default: %(default)s)')
+  parser.add_argument('--list', action='store_true',
+                      help='List the archives found and their format instead '
+                      'of extracting them')
+  parser.add_argument('--include', action='append', metavar='PATTERN',
+                      help='Only extract files whose path matches PATTERN '
+                      '(can be repeated)')
+  parser.add_argument('--exclude', action='append', metavar='PATTERN',
+                      help='Skip files whose path matches PATTERN (can be '
+                      'repeated)')
+  parser.add_argument('--regex', action='store_true',
+                      help='Treat --include/--exclude patterns as regular '
+                      'expressions instead of globs')
+  parser.add_argument('--rebuild-index', action='store_true',
+                      help='Parse the archives again instead of using the '
+                      'cached index')
+  parser.add_argument('--verify', action='store_true',
+                      help='Check the contents of previously extracted files '
+                      'even if they look unchanged')
+  parser.add_argument('--chunk-size', type=int,
+                      default=archiveutil.DEFAULT_CHUNK_SIZE,
+                      help='Size of the buffer used to copy files when the '
+                      'archive cannot be copied by the OS (default: %(default)s)')
+  archiveutil.add_dedupe_args(parser)
+  args = parser.parse_args()
+
+  archives, errors = find_archives(args.inputs)
+  if args.list:
+    for path, archive_cls in archives:
+      print(f'{archive_cls.__name__:<12} {path}')
+    print(f'{len(archives)} archives')
+  else:
+    # Start with the largest archives so that they do not run alone at the
+    # end.
+    archives.sort(key=lambda archive: os.path.getsize(archive[0]),
+                  reverse=True)
+    dedupe = archiveutil.open_dedupe_store(args)
+    extracted_count = 0
+    skipped_count = 0
+    extracted_bytes = 0
+    archive_count = 0
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(args.jobs) as executor:
+      futures = {
+          executor.submit(extract_archive, path, archive_cls, args): path
+          for path, archive_cls in archives
+      }
+      for i, future in enumerate(concurrent.futures.as_completed(futures)):
+        path = futures[future]
+        try:
+          extracted, skipped, size, stats = future.result()
+        except Exception as e:
+          errors.append((path, str(e)))
+          print(f'[{i + 1}/{len(archives)}] {path}: Error: {e}')
+          continue
+        archive_count += 1
+        extracted_count += extracted
+        skipped_count += skipped
+        extracted_bytes += size
+        if stats is not None:
+          dedupe.add_stats(stats)
+        print(f'[{i + 1}/{len(archives)}] {path}: {extracted} files '
+              f'({size / 0x100000:.1f} MiB), skipped {skipped}')
+    elapsed = max(time.perf_counter() - start, 1e-6)
+
+    print(f'Extracted {extracted_count} files ({extracted_bytes / 0x100000:.1f} '
+          f'MiB) from {archive_count} archives in {elapsed:.1f} s: '
+          f'{extracted_count / elapsed:.1f} files/s, '
+          f'{extracted_bytes / 0x100000 / elapsed:.1f} MiB/s. Skipped '
+          f'{skipped_count} existing files.')
+    if dedupe:
+      print(dedupe.report())
+
+  if errors:
+    print(f'{len(errors)} errors:')
+    for path, error in errors:
+      print(f'  {path}: {error}')
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
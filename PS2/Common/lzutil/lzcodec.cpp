@@ -0,0 +1,107 @@
+#include "lzcodec.h"
+
+#include <cstring>
+
+namespace {
+
+constexpr size_t kBlockSize = 0x1000;
+
+class BitReader {
+public:
+    BitReader(const uint8_t* src, size_t src_size, size_t offs)
+        : src_(src), src_size_(src_size), offs_(offs) {}
+
+    // Returns false if the end of the source was reached.
+    bool Read(int count, uint32_t* value) {
+        while (bit_count_ < count) {
+            if (offs_ >= src_size_) {
+                return false;
+            }
+            bits_ = (bits_ << 8) | src_[offs_++];
+            bit_count_ += 8;
+        }
+        bit_count_ -= count;
+        *value = (bits_ >> bit_count_) & ((1u << count) - 1);
+        return true;
+    }
+
+private:
+    const uint8_t* src_;
+    size_t src_size_;
+    size_t offs_;
+    uint32_t bits_ = 0;
+    int bit_count_ = 0;
+};
+
+// Decodes one block. Without kWrite, only the output size is computed and dst
+// is not accessed.
+template <bool kWrite>
+long long DecodeBlock(const char* src, size_t src_size, size_t block_offs, char* dst, size_t dst_size) {
+    BitReader reader(reinterpret_cast<const uint8_t*>(src), src_size, block_offs);
+    uint8_t* dst_bytes = reinterpret_cast<uint8_t*>(dst);
+    size_t dst_offs = 0;
+    // Every block starts with an empty dictionary.
+    uint8_t dict[0x100];
+    if (kWrite) {
+        memset(dict, 0, sizeof(dict));
+    }
+    uint8_t dict_offs = 1;
+    while (dst_offs < dst_size) {
+        uint32_t is_literal, value;
+        if (!reader.Read(1, &is_literal) || !reader.Read(8, &value)) {
+            return -1;
+        }
+        if (is_literal) {
+            if (kWrite) {
+                dict[dict_offs++] = value;
+                dst_bytes[dst_offs] = value;
+            }
+            dst_offs++;
+            continue;
+        }
+        if (value == 0) {
+            break;  // End of block
+        }
+        uint32_t count;
+        if (!reader.Read(4, &count)) {
+            return -1;
+        }
+        count += 2;
+        if (count > dst_size - dst_offs) {
+            count = dst_size - dst_offs;
+        }
+        if (kWrite) {
+            uint8_t copy_offs = value;
+            for (uint32_t i = 0; i < count; i++) {
+                uint8_t b = dict[copy_offs++];
+                dict[dict_offs++] = b;
+                dst_bytes[dst_offs + i] = b;
+            }
+        }
+        dst_offs += count;
+    }
+    return dst_offs;
+}
+
+}  // namespace
+
+long long Decompress(const char* src, size_t src_size, char* dst, size_t dst_size) {
+    size_t dst_offs = 0;
+    for (size_t block_offs = 0; block_offs < src_size && dst_offs < dst_size;
+         block_offs += kBlockSize) {
+        long long written = DecodeBlock<true>(src, src_size, block_offs, dst + dst_offs, dst_size - dst_offs);
+        if (written < 0) {
+            return -1;
+        }
+        dst_offs += written;
+    }
+    return dst_offs;
+}
+
+long long DecompressBlock(const char* src, size_t src_size, size_t block_offs, char* dst, size_t dst_size) {
+    return DecodeBlock<true>(src, src_size, block_offs, dst, dst_size);
+}
+
+long long ScanBlock(const char* src, size_t src_size, size_t block_offs, size_t max_size) {
+    return DecodeBlock<false>(src, src_size, block_offs, nullptr, max_size);
+}
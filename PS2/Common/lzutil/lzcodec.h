@@ -0,0 +1,21 @@
+#include <cstddef>
+#include <cstdint>
+
+// Codec for the LZ stream used by Musashi: Samurai Legend (PS2) TLD
+// resources. Compressed data is made of 0x1000-byte blocks that are decoded
+// independently of each other, so their output can be produced in parallel
+// once the output size of each block is known.
+
+// Decompresses src into dst. Returns the number of bytes written, which is less
+// than dst_size only if the stream ended early, or -1 if src is truncated.
+long long Decompress(const char* src, size_t src_size, char* dst, size_t dst_size);
+
+// Decompresses the block of src that starts at block_offs into dst, stopping
+// after dst_size bytes. Returns the number of bytes written or -1 if src is
+// truncated.
+long long DecompressBlock(const char* src, size_t src_size, size_t block_offs, char* dst, size_t dst_size);
+
+// Returns the number of bytes that DecompressBlock would write for the block
+// at block_offs with a dst_size of max_size, without writing them. Returns -1
+// if src is truncated.
+long long ScanBlock(const char* src, size_t src_size, size_t block_offs, size_t max_size);
@@ -0,0 +1,11 @@
+%module(threads="1") lzcodec
+
+%include "pybuffer.i"
+%pybuffer_binary(const char* src, size_t src_size);
+%pybuffer_mutable_binary(char* dst, size_t dst_size);
+
+%include "lzcodec.h"
+
+%{
+    #include "lzcodec.h"
+%}
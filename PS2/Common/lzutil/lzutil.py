@@ -0,0 +1,283 @@
+import concurrent.futures
+
+try:
+  from . import lzcodec
+except ImportError:
+  lzcodec = None
+
+# Codec for the LZ compression used by Musashi: Samurai Legend (PS2) TLD
+# resources.
+#
+# Compressed data is split into blocks of BLOCK_SIZE bytes, each starting with
+# an empty 256-byte dictionary. A block is a big-endian bit stream of tokens:
+#   1 <byte:8>               Literal byte.
+#   0 <offs:8> <count:4>     Copy count + 2 bytes from dictionary offset offs.
+#   0 <0:8>                  End of block.
+# Every output byte is also appended to the dictionary (a ring buffer whose
+# write position starts at 1).
+#
+# Blocks are independent apart from where their output starts, so with
+# parallel=True, a scan pass first computes the output size of each block and
+# the blocks are then decoded by a pool of threads into their slices of the
+# output.
+#
+# The native codec (lzcodec) is built together with gsutil by the CMake
+# project in PS2/Common. Without it, a pure-Python decoder is used, which
+# always decodes serially since it cannot run in parallel threads.
+
+BLOCK_SIZE = 0x1000
+MIN_COPY_SIZE = 2
+MAX_COPY_SIZE = 0xF + MIN_COPY_SIZE
+DICT_SIZE = 0x100
+
+
+class LzError(Exception):
+  pass
+
+
+def has_native():
+  return lzcodec is not None
+
+
+# Decompresses src into the writable buffer dst (e.g. a bytearray) and
+# returns the number of bytes written.
+def decompress_into(src, dst, parallel=False, max_workers=None):
+  if lzcodec is None:
+    return decompress_into_python(src, dst)
+  if parallel and len(src) > BLOCK_SIZE:
+    return _decompress_into_parallel(src, dst, max_workers)
+  return _check_size(lzcodec.Decompress(src, dst))
+
+
+# Returns a bytearray of size bytes decompressed from src.
+def decompress(src, size, parallel=False, max_workers=None):
+  dst = bytearray(size)
+  decompress_into(src, dst, parallel, max_workers)
+  return dst
+
+
+def _check_size(size):
+  if size < 0:
+    raise LzError('Compressed data is truncated')
+  return size
+
+
+def _decompress_into_parallel(src, dst, max_workers):
+  dst = memoryview(dst).cast('B')
+  dst_size = len(dst)
+  # [(block offset, output offset, output size)]
+  blocks = []
+  dstind = 0
+  for block_offs in range(0, len(src), BLOCK_SIZE):
+    if dstind >= dst_size:
+      break
+    size = _check_size(lzcodec.ScanBlock(src, block_offs, dst_size - dstind))
+    blocks.append((block_offs, dstind, size))
+    dstind += size
+
+  def decompress_block(block):
+    block_offs, start, size = block
+    _check_size(lzcodec.DecompressBlock(src, block_offs,
+                                        dst[start:start + size]))
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+    # Consume results to raise the first error, if any.
+    for _ in executor.map(decompress_block, blocks):
+      pass
+  return dstind
+
+
+def decompress_into_python(src, dst):
+  dst_size = len(dst)
+  dstind = 0
+  for block_offs in range(0, len(src), BLOCK_SIZE):
+    if dstind >= dst_size:
+      break
+    out = _decompress_block_python(src, block_offs, dst_size - dstind)
+    dst[dstind:dstind + len(out)] = out
+    dstind += len(out)
+  return dstind
+
+
+# Yields the output of src in chunks, one per compressed block, so memory use
+# does not depend on size. Chunks may be views into a buffer that is reused
+# for the next one. As with decompress(), output is padded with zeros up to
+# size bytes if the stream ends early.
+def decompress_iter(src, size):
+  return decompress_read_iter(lambda offs, count: src[offs:offs + count],
+                              len(src), size)
+
+
+# Same as decompress_iter, with the src_size bytes of compressed data read
+# through read(offs, count) (e.g. from a file) as they are needed.
+def decompress_read_iter(read, src_size, size):
+  dstind = 0
+  buf = bytearray()
+
+  def decompress_block(src, max_size):
+    nonlocal buf
+    if lzcodec is None:
+      return _decompress_block_python(src, 0, max_size)
+    block_size = _check_size(lzcodec.ScanBlock(src, 0, max_size))
+    if len(buf) < block_size:
+      buf = bytearray(block_size)
+    chunk = memoryview(buf)[:block_size]
+    _check_size(lzcodec.DecompressBlock(src, 0, chunk))
+    return chunk
+
+  for block_offs in range(0, src_size, BLOCK_SIZE):
+    if dstind >= size:
+      break
+    # Blocks normally end before the next one starts, but decoding is allowed
+    # to run past it.
+    src = read(block_offs, 2 * BLOCK_SIZE)
+    try:
+      chunk = decompress_block(src, size - dstind)
+    except LzError:
+      if block_offs + len(src) >= src_size:
+        raise
+      chunk = decompress_block(read(block_offs, src_size - block_offs),
+                               size - dstind)
+    dstind += len(chunk)
+    yield chunk
+  while dstind < size:
+    chunk_size = min(size - dstind, BLOCK_SIZE)
+    dstind += chunk_size
+    yield bytes(chunk_size)
+
+
+# Returns the output of the block at block_offs, at most max_size bytes.
+def _decompress_block_python(src, block_offs, max_size):
+  # Compressed bytes are copied from src a block at a time. Decoding may run
+  # past the end of the block until the end of block marker.
+  window = bytes(src[block_offs:block_offs + BLOCK_SIZE])
+  window_end = block_offs + len(window)
+  srcind = 0
+  # The dictionary always holds the last 256 bytes written, so copies are
+  # served from the block output itself, preceded by 256 zeros that stand in
+  # for the initially empty dictionary. Output byte n is at dictionary offset
+  # (n + 1) & 0xFF, i.e. out[n + DICT_SIZE].
+  out = bytearray(DICT_SIZE)
+  limit = DICT_SIZE + max_size
+  # Bits not consumed yet are the low bit_count bits of bits. Every token
+  # takes at most 13 bits, so four bytes are read at a time when fewer are
+  # left.
+  bits = 0
+  bit_count = 0
+  while len(out) < limit:
+    if bit_count < 13:
+      chunk = window[srcind:srcind + 4]
+      if len(chunk) < 4 and window_end < len(src):
+        window = window[srcind:] + bytes(
+            src[window_end:window_end + BLOCK_SIZE])
+        window_end = min(window_end + BLOCK_SIZE, len(src))
+        srcind = 0
+        chunk = window[:4]
+      srcind += len(chunk)
+      bits = (bits << (len(chunk) << 3)) | int.from_bytes(chunk, 'big')
+      bit_count += len(chunk) << 3
+    bit_count -= 9
+    if bit_count < 0:
+      raise LzError('Compressed data is truncated')
+    value = (bits >> bit_count) & 0xFF
+    if (bits >> (bit_count + 8)) & 1:
+      out.append(value)
+    elif value == 0:
+      break  # End of block
+    else:
+      bit_count -= 4
+      if bit_count < 0:
+        raise LzError('Compressed data is truncated')
+      count = ((bits >> bit_count) & 0xF) + MIN_COPY_SIZE
+      dist = ((len(out) + 1 - value) & 0xFF) or DICT_SIZE
+      start = len(out) - dist
+      if dist >= count:
+        out += out[start:start + count]
+      else:
+        # The copy overlaps the bytes it writes, repeating the last dist
+        # bytes.
+        out += (out[start:] * (count // dist + 1))[:count]
+    bits &= (1 << bit_count) - 1
+  return memoryview(out)[DICT_SIZE:min(len(out), limit)]
+
+
+class _BitWriter:
+  def __init__(self):
+    self.buf = bytearray()
+    self.bits = 0
+    self.bit_count = 0
+    self.size = 0  # Total bits written
+
+  def write(self, value, count):
+    self.bits = (self.bits << count) | value
+    self.bit_count += count
+    self.size += count
+    while self.bit_count >= 8:
+      self.bit_count -= 8
+      self.buf.append((self.bits >> self.bit_count) & 0xFF)
+    self.bits &= (1 << self.bit_count) - 1
+
+  def flush(self):
+    if self.bit_count > 0:
+      self.write(0, 8 - self.bit_count)
+    return self.buf
+
+
+# Compresses data into blocks that decompress() can read, using greedy
+# matching. Mostly useful to produce test data, the game does not need it.
+def compress(data):
+  data = bytes(data)
+  out = bytearray()
+  offs = 0
+  while offs < len(data):
+    block, offs = _compress_block(data, offs)
+    if offs < len(data):
+      block += bytes(BLOCK_SIZE - len(block))
+    out += block
+  return bytes(out)
+
+
+def _compress_block(data, start):
+  # Output position n of the block is stored at dictionary offset
+  # (n + 1) & 0xFF. Bytes before the block read as zeros, as the dictionary
+  # starts empty.
+  history = bytes(DICT_SIZE) + data[start:start + BLOCK_SIZE * 11]
+  writer = _BitWriter()
+  # {two bytes -> positions in history where they start}
+  candidates = dict()
+  for i in range(DICT_SIZE):
+    candidates.setdefault(history[i:i + 2], []).append(i)
+  pos = DICT_SIZE
+  # Leave room for a copy and the end of block marker.
+  max_bits = BLOCK_SIZE * 8 - 13 - 9
+  while pos < len(history) and writer.size <= max_bits:
+    n = pos - DICT_SIZE
+    best_size = 0
+    best_dist = 0
+    key = history[pos:pos + 2]
+    for cand in reversed(candidates.get(key, [])):
+      dist = pos - cand
+      if dist > DICT_SIZE:
+        break
+      if (n + 1 - dist) & 0xFF == 0:
+        continue  # Offset 0 marks the end of a block
+      size = 2
+      max_size = min(MAX_COPY_SIZE, len(history) - pos)
+      while size < max_size and history[cand + size] == history[pos + size]:
+        size += 1
+      if size > best_size:
+        best_size = size
+        best_dist = dist
+    if best_size >= MIN_COPY_SIZE:
+      writer.write(0, 1)
+      writer.write((n + 1 - best_dist) & 0xFF, 8)
+      writer.write(best_size - MIN_COPY_SIZE, 4)
+    else:
+      best_size = 1
+      writer.write(1, 1)
+      writer.write(history[pos], 8)
+    for i in range(pos, pos + best_size):
+      candidates.setdefault(history[i:i + 2], []).append(i)
+    pos += best_size
+  writer.write(0, 9)
+  return writer.flush(), start + pos - DICT_SIZE
@@ -0,0 +1,109 @@
+import concurrent.futures
+import itertools
+import mmap
+import multiprocessing
+import os
+import sys
+
+# Helpers for running format decode jobs in a pool of worker processes.
+#
+# Job functions are called as fn(buf, job), where buf is a read-only mmap of
+# the input file shared by all jobs that run in the same process. Job
+# functions and their arguments must be picklable and must not depend on
+# Blender, since worker processes run a plain Python interpreter. Blender 2.8x
+# reports its own binary as sys.executable, so its add-ons must pass the
+# interpreter bundled with Blender (bpy.app.binary_path_python).
+
+# Executed once in every worker before any job is unpickled. Blender add-on
+# packages import bpy in __init__.py, which is not available to workers, so
+# register an empty package instead that still allows its submodules (and
+# their relative imports) to be loaded.
+_WORKER_BOOTSTRAP = '''
+import sys
+import types
+if {name!r} not in sys.modules:
+  package = types.ModuleType({name!r})
+  package.__path__ = [{path!r}]
+  sys.modules[{name!r}] = package
+'''
+
+# {filepath -> mmap} for files opened by this process.
+_buffers = dict()
+
+
+def get_buffer(filepath):
+  buf = _buffers.get(filepath)
+  if buf is None:
+    with open(filepath, 'rb') as f:
+      buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    _buffers[filepath] = buf
+  return buf
+
+
+def release_buffer(filepath):
+  buf = _buffers.pop(filepath, None)
+  if buf is not None:
+    buf.close()
+
+
+def _call(fn, filepath, job):
+  return fn(get_buffer(filepath), job)
+
+
+def default_worker_count():
+  return os.cpu_count() or 1
+
+
+# Returns the spawn context that starts workers with the Python interpreter
+# executable (by default, sys.executable), or None if it is not one.
+def _spawn_context(executable=None):
+  executable = executable or sys.executable
+  if not executable or not os.path.basename(executable).lower().startswith(
+      'python'):
+    return None
+  context = multiprocessing.get_context('spawn')
+  context.set_executable(executable)
+  return context
+
+
+# Runs fn(buf, job) for every job and returns the results in order.
+#
+# package_name and package_dir identify the package that contains fn (use
+# __package__ and os.path.dirname(__file__) from the caller). executable is
+# the Python interpreter that runs the workers, if sys.executable is not one.
+# Jobs run in this process when there are fewer than two jobs or workers, or
+# when a process pool cannot be started.
+def run_jobs(fn,
+             jobs,
+             filepath,
+             package_name,
+             package_dir,
+             max_workers=None,
+             executable=None):
+  jobs = list(jobs)
+  max_workers = min(max_workers or default_worker_count(), len(jobs))
+  context = _spawn_context(executable) if max_workers > 1 else None
+  if context is not None:
+    try:
+      bootstrap = _WORKER_BOOTSTRAP.format(name=package_name,
+                                           path=package_dir)
+      with concurrent.futures.ProcessPoolExecutor(
+          max_workers=max_workers,
+          mp_context=context,
+          initializer=exec,
+          initargs=(bootstrap, {})) as executor:
+        chunksize = max(1, len(jobs) // (max_workers * 4))
+        return list(
+            executor.map(_call,
+                         itertools.repeat(fn),
+                         itertools.repeat(filepath),
+                         jobs,
+                         chunksize=chunksize))
+    except (concurrent.futures.process.BrokenProcessPool, ImportError,
+            OSError) as err:
+      print(f'Decoding in a single process ({err})')
+
+  try:
+    return [fn(get_buffer(filepath), job) for job in jobs]
+  finally:
+    release_buffer(filepath)
@@ -0,0 +1,228 @@
+# Checks that striputil builds the same triangles as the per-game strip loops
+# it replaced, on fixed synthetic strips for each format, and measures how
+# fast both are.
+
+import argparse
+import random
+import time
+
+import numpy as np
+
+from striputil import striputil
+
+parser = argparse.ArgumentParser(description='''
+Compares striputil with the previous triangle strip loops of the PS2 tools.
+''')
+parser.add_argument('--size', type=int, default=100000,
+                    help='Number of strip elements per format')
+parser.add_argument('--repeat', type=int, default=5,
+                    help='Number of runs, the fastest one is reported')
+parser.add_argument('--seed', type=int, default=0)
+args = parser.parse_args()
+
+
+# The previous loops, as they were in each tool. Those of SH3 maps, Rule of
+# Rose and Gitaroo Man kept degenerate triangles, which striputil drops, so
+# they are removed from the old output before comparing. The SH3 map and Rule
+# of Rose loops also built triangles ending at the first two elements of a
+# strip, from negative indices that wrapped around to its end. striputil never
+# emits those (see test_striputil.py), so they are removed as well.
+
+def drop_degenerate(tri, key=lambda t: t):
+  return [t for t in tri if len(set(key(t))) == 3]
+
+
+def drop_wrapped(tri, key=lambda t: t):
+  return [t for t in tri if min(key(t)) >= 0]
+
+
+# Silent Hill 3 models (import_mdl.py): strip commands hold a vertex address
+# and an ADC bit.
+def old_sh3_mdl(tri_cmds, vertex_data_start_addr):
+  def get_vtx_index(tri_cmd):
+    return ((tri_cmd & 0x7FFF) - vertex_data_start_addr) // 0x4
+
+  tri = []
+  reverse = True
+  for i, tri_cmd in enumerate(tri_cmds):
+    if i > 1 and (tri_cmd & 0x8000) == 0:
+      t1 = get_vtx_index(tri_cmd)
+      t2 = get_vtx_index(tri_cmds[i - 1])
+      t3 = get_vtx_index(tri_cmds[i - 2])
+      if t1 != t2 and t2 != t3 and t1 != t3:
+        if reverse:
+          tri.append((t3, t2, t1))
+        else:
+          tri.append((t1, t2, t3))
+    reverse = not reverse
+  return tri
+
+
+def new_sh3_mdl(tri_cmds, vertex_data_start_addr):
+  tri_cmds = np.asarray(tri_cmds, dtype=np.int64)
+  return striputil.triangulate_restart(
+      ((tri_cmds & 0x7FFF) - vertex_data_start_addr) // 0x4, tri_cmds & 0x8000)
+
+
+# Silent Hill 3 maps (import_map.py): bit 0 of the U coordinate of each vertex
+# is the restart flag.
+def old_sh3_map(flags):
+  tri = []
+  reverse = False
+  for i, flag in enumerate(flags):
+    if not flag:
+      if reverse:
+        tri.append((i, i - 1, i - 2))
+      else:
+        tri.append((i - 2, i - 1, i))
+    reverse = not reverse
+  return tri
+
+
+def new_sh3_map(flags):
+  return striputil.triangulate_restart(np.arange(len(flags)), flags)
+
+
+# Kingdom Hearts II models (import_mdlx.py): flags 0x20 and 0x30 give the
+# winding of each triangle, 0 emits both and 0x10 none.
+def old_kh2_mdlx(flags):
+  tri = []
+  for i, f in enumerate(flags):
+    if i < 2:
+      continue
+    if f == 0x20 or not f:
+      tri.append((i - 2, i - 1, i))
+    if f == 0x30 or not f:
+      tri.append((i, i - 1, i - 2))
+  return tri
+
+
+def new_kh2_mdlx(flags):
+  flags = np.asarray(flags)
+  return striputil.triangulate_winding(np.arange(len(flags)),
+                                       (flags == 0x20) | (flags == 0),
+                                       (flags == 0x30) | (flags == 0))
+
+
+# Rule of Rose models (mdl2obj.py): strip elements are (vertex index, ctrl, _,
+# reverse) and triangles pair each vertex index with its strip position.
+def old_ror(ind):
+  tri = []
+  for i in range(len(ind)):
+    _, ctrl, _, reverse = ind[i]
+    if ctrl == 0x80:
+      continue
+    if reverse:
+      tri.append([(ind[i-2][0], i-2), (ind[i-1][0], i-1), (ind[i][0], i)])
+    else:
+      tri.append([(ind[i][0], i), (ind[i-1][0], i-1), (ind[i-2][0], i-2)])
+  return tri
+
+
+def new_ror(ind):
+  ind = np.array(ind, dtype=np.int32).reshape(-1, 4)
+  emit = ind[:, 1] != 0x80
+  tri = striputil.triangulate_winding(np.arange(len(ind)),
+                                      emit & (ind[:, 3] != 0),
+                                      emit & (ind[:, 3] == 0))
+  tri = tri[~striputil.is_degenerate(ind[tri, 0])]
+  return np.stack((ind[tri, 0], tri), axis=2)
+
+
+# Gitaroo Man models (xg.py): back-to-back strips, the winding of the first
+# triangle of each one coming from its vertex normals.
+def old_gitaroo(strips, reverses):
+  triangles = []
+  for strip, reverse in zip(strips, reverses):
+    for k in range(len(strip) - 2):
+      s1 = strip[k]
+      s2 = strip[k+1]
+      s3 = strip[k+2]
+      if reverse:
+        triangles += [(s3, s2, s1)]
+      else:
+        triangles += [(s1, s2, s3)]
+      reverse = not reverse
+  return triangles
+
+
+def new_gitaroo(strips, reverses):
+  return striputil.triangulate_lengths(np.concatenate(strips),
+                                       [len(strip) for strip in strips],
+                                       reverses)
+
+
+# Strips are restarted every few elements, but not necessarily at their start.
+# Vertex indices are drawn from a small range so that degenerate triangles
+# occur.
+def make_restart_flags(size, rng):
+  starts = set()
+  i = rng.randint(0, 2)
+  while i < size:
+    starts.update((i, i + 1))
+    i += rng.randint(3, 40)
+  return [int(i in starts or rng.random() < 0.05) for i in range(size)]
+
+
+def make_inputs(size, rng):
+  vertex_count = 64
+  base = 0x10
+  restart = make_restart_flags(size, rng)
+  sh3_mdl = [(base + rng.randrange(vertex_count) * 4) | (flag << 15)
+             for flag in restart]
+  sh3_map = make_restart_flags(size, rng)
+  kh2 = [0x10 if flag else rng.choice((0x00, 0x20, 0x30))
+         for flag in make_restart_flags(size, rng)]
+  ror = [(rng.randrange(vertex_count), 0x80 if flag else 0, 0,
+          rng.randrange(2)) for flag in make_restart_flags(size, rng)]
+  strips = []
+  total = 0
+  while total < size:
+    strip_len = rng.randint(3, 16)
+    strips.append(np.array([rng.randrange(vertex_count)
+                            for _ in range(strip_len)], dtype=np.int32))
+    total += strip_len
+  reverses = [rng.random() < 0.5 for _ in strips]
+  return [
+      ('SH3 MDL', lambda f: f(sh3_mdl, base), old_sh3_mdl, new_sh3_mdl,
+       lambda tri: tri),
+      ('SH3 map', lambda f: f(sh3_map), old_sh3_map, new_sh3_map,
+       lambda tri: drop_degenerate(drop_wrapped(tri))),
+      ('KH2 MDLX', lambda f: f(kh2), old_kh2_mdlx, new_kh2_mdlx,
+       lambda tri: tri),
+      ('RoR', lambda f: f(ror), old_ror, new_ror,
+       lambda tri: drop_degenerate(drop_wrapped(tri, lambda t: [i for _, i in t]),
+                                   lambda t: [v for v, _ in t])),
+      ('Gitaroo', lambda f: f(strips, reverses), old_gitaroo, new_gitaroo,
+       drop_degenerate),
+  ]
+
+
+def bench(call, fn):
+  best = None
+  for _ in range(args.repeat):
+    start = time.perf_counter()
+    result = call(fn)
+    elapsed = time.perf_counter() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return result, best
+
+
+def as_tuples(tri):
+  return [tuple(tuple(v) if isinstance(v, list) else v for v in t)
+          for t in tri]
+
+
+errors = 0
+for name, call, old, new, expect in make_inputs(args.size,
+                                                random.Random(args.seed)):
+  old_tri, old_time = bench(call, old)
+  new_tri, new_time = bench(call, new)
+  expected = as_tuples(expect(old_tri))
+  if as_tuples(new_tri.tolist()) != expected:
+    print(f'Error: {name} triangles differ from the previous loop')
+    errors += 1
+  print(f'{name}: {len(expected)} triangles, loop {old_time * 1000:.1f} ms, '
+        f'striputil {new_time * 1000:.1f} ms ({old_time / new_time:.1f}x)')
+if errors:
+  raise SystemExit(1)
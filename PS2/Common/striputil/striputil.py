@@ -0,0 +1,95 @@
+import numpy as np
+
+# Helpers for converting triangle strips to triangle lists.
+#
+# Every triangle is built from three consecutive strip elements (i - 2, i - 1,
+# i). A triangle is "forward" when it is emitted in that order and "flipped"
+# when it is emitted as (i, i - 1, i - 2). All functions return an (N, 3)
+# int32 array of the values in `indices`.
+
+
+def _empty():
+  return np.empty((0, 3), dtype=np.int32)
+
+
+def _build(indices, forward, flipped, drop_degenerate):
+  # forward and flipped are boolean masks over triangles, where triangle k is
+  # the one that ends at strip element k + 2. A triangle with both flags set
+  # is emitted twice (once per winding), forward first.
+  tri = np.stack((indices[:-2], indices[1:-1], indices[2:]), axis=1)
+  if drop_degenerate:
+    valid = ~is_degenerate(tri)
+    forward = forward & valid
+    flipped = flipped & valid
+  order = np.concatenate((np.flatnonzero(forward), np.flatnonzero(flipped)))
+  result = np.concatenate((tri[forward], tri[flipped][:, ::-1]))
+  # Restore strip order so output matches a sequential walk over the strip.
+  return np.ascontiguousarray(result[np.argsort(order, kind='stable')],
+                              dtype=np.int32)
+
+
+def is_degenerate(tri):
+  tri = np.asarray(tri)
+  return ((tri[:, 0] == tri[:, 1]) | (tri[:, 1] == tri[:, 2]) |
+          (tri[:, 0] == tri[:, 2]))
+
+
+# Restart-flag encoding: a single strip in which every element carries a flag
+# that suppresses the triangle ending at that element (e.g. SH2/SH3 ADC bit
+# 0x8000). Winding alternates on every element regardless of the flag; the
+# triangle ending at an even element is forward unless start_flipped is set.
+def triangulate_restart(indices,
+                        restart,
+                        start_flipped=False,
+                        drop_degenerate=True):
+  indices = np.asarray(indices, dtype=np.int32)
+  if len(indices) < 3:
+    return _empty()
+  restart = np.asarray(restart, dtype=bool)[2:]
+  flip = (np.arange(2, len(indices)) & 1).astype(bool)
+  if start_flipped:
+    flip = ~flip
+  emit = ~restart
+  return _build(indices, emit & ~flip, emit & flip, drop_degenerate)
+
+
+# Winding-flag encoding: every element carries an explicit winding for the
+# triangle ending at it (e.g. KH2 flags 0x20/0x30, Rule of Rose reverse byte).
+# forward and flipped are boolean masks over the strip elements. The first two
+# elements never emit a triangle.
+def triangulate_winding(indices, forward, flipped, drop_degenerate=True):
+  indices = np.asarray(indices, dtype=np.int32)
+  if len(indices) < 3:
+    return _empty()
+  forward = np.asarray(forward, dtype=bool)[2:]
+  flipped = np.asarray(flipped, dtype=bool)[2:]
+  return _build(indices, forward, flipped, drop_degenerate)
+
+
+# Explicit-length encoding: several strips concatenated back to back, with the
+# number of elements of each strip given in lengths (e.g. Gitaroo Man
+# triStripData). Winding alternates within each strip and restarts at each
+# strip boundary. first_flipped optionally gives the winding of the first
+# triangle of each strip (bool or per-strip array).
+def triangulate_lengths(indices,
+                        lengths,
+                        first_flipped=False,
+                        drop_degenerate=True):
+  indices = np.asarray(indices, dtype=np.int32)
+  lengths = np.asarray(lengths, dtype=np.int64)
+  if len(indices) < 3 or len(lengths) == 0:
+    return _empty()
+  if lengths.sum() != len(indices):
+    raise ValueError(
+        f'Strip lengths add up to {lengths.sum()}, expected {len(indices)}')
+  starts = np.cumsum(lengths) - lengths
+  strip = np.repeat(np.arange(len(lengths)), lengths)
+  pos = np.arange(len(indices)) - starts[strip]
+  first_flipped = np.broadcast_to(np.asarray(first_flipped, dtype=bool),
+                                  lengths.shape)
+  flip = ((pos & 1).astype(bool)) != first_flipped[strip]
+  emit = pos >= 2
+  # Triangle k ends at element k + 2.
+  return _build(indices, (emit & ~flip)[2:], (emit & flip)[2:],
+                drop_degenerate)
+
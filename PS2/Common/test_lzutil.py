@@ -0,0 +1,185 @@
+# Round-trip tests of the Musashi TLD resource codec, for the pure-Python
+# decoder and, when it is built, the native one. Run with
+# python PS2/Common/test_lzutil.py.
+
+import random
+import unittest
+from unittest import mock
+
+from lzutil import lzutil
+
+BLOCK_SIZE = lzutil.BLOCK_SIZE
+
+
+# Mix of random bytes, runs and repeated short strings, as in lzbench.py.
+def make_data(size, seed=0):
+  rng = random.Random(seed)
+  words = [rng.randbytes(rng.randint(2, 8)) for _ in range(64)]
+  data = bytearray()
+  while len(data) < size:
+    r = rng.random()
+    if r < 0.3:
+      data += rng.randbytes(rng.randint(1, 16))
+    elif r < 0.4:
+      data += bytes([rng.randrange(0x100)]) * rng.randint(2, 64)
+    else:
+      data += rng.choice(words)
+  return bytes(data[:size])
+
+
+def incompressible(size, seed=0):
+  return random.Random(seed).randbytes(size)
+
+
+# Inputs named for the failure message: empty, single byte, around the block
+# size, incompressible (whose compressed blocks hold fewer bytes than
+# BLOCK_SIZE) and several blocks long.
+CASES = [
+    ('empty', b''),
+    ('1 byte', b'\x5a'),
+    ('1 zero byte', b'\0'),
+    ('block - 1', make_data(BLOCK_SIZE - 1)),
+    ('block', make_data(BLOCK_SIZE)),
+    ('block + 1', make_data(BLOCK_SIZE + 1)),
+    ('incompressible block - 1', incompressible(BLOCK_SIZE - 1)),
+    ('incompressible block + 1', incompressible(BLOCK_SIZE + 1)),
+    ('incompressible', incompressible(3 * BLOCK_SIZE + 0x123)),
+    ('runs', bytes(5 * BLOCK_SIZE)),
+    ('multiple blocks', make_data(6 * BLOCK_SIZE + 0x321, seed=1)),
+]
+
+_compressed = dict()
+
+
+# Chunks may be views into a buffer that the next one reuses, so each is
+# copied before reading on.
+def join_iter(chunks):
+  return b''.join(bytes(chunk) for chunk in chunks)
+
+
+def compress(data):
+  src = _compressed.get(data)
+  if src is None:
+    src = lzutil.compress(data)
+    _compressed[data] = src
+  return src
+
+
+class RoundTripTest(unittest.TestCase):
+  def check(self, decompress):
+    for name, data in CASES:
+      with self.subTest(name):
+        self.assertEqual(bytes(decompress(compress(data), len(data))), data)
+
+  def test_python(self):
+    def decompress(src, size):
+      dst = bytearray(size)
+      self.assertEqual(lzutil.decompress_into_python(src, dst), size)
+      return dst
+    self.check(decompress)
+
+  def test_python_iter(self):
+    with mock.patch.object(lzutil, 'lzcodec', None):
+      self.check(lambda src, size: join_iter(lzutil.decompress_iter(src, size)))
+
+  @unittest.skipUnless(lzutil.has_native(), 'native codec not built')
+  def test_native(self):
+    def decompress(src, size):
+      dst = bytearray(size)
+      self.assertEqual(lzutil.decompress_into(src, dst), size)
+      return dst
+    self.check(decompress)
+
+  @unittest.skipUnless(lzutil.has_native(), 'native codec not built')
+  def test_native_iter(self):
+    self.check(lambda src, size: join_iter(lzutil.decompress_iter(src, size)))
+
+  # Literals 'a' and 'b', a copy of 4 bytes from dictionary offset 1 that
+  # overlaps its own output, and the end of block marker.
+  def test_known_stream(self):
+    src = b'\xb0\xd8\x80\x24\x00'
+    dst = bytearray(6)
+    self.assertEqual(lzutil.decompress_into_python(src, dst), 6)
+    self.assertEqual(dst, b'ababab')
+    if lzutil.has_native():
+      self.assertEqual(lzutil.decompress(src, 6), b'ababab')
+
+  # Output is padded with zeros when the stream ends before size bytes.
+  def test_padding(self):
+    data = make_data(BLOCK_SIZE + 7)
+    expected = data + bytes(100)
+    self.assertEqual(lzutil.decompress(compress(data), len(expected)), expected)
+    self.assertEqual(
+        join_iter(lzutil.decompress_iter(compress(data), len(expected))),
+        expected)
+
+  def test_truncated(self):
+    src = compress(make_data(BLOCK_SIZE))[:100]
+    with self.assertRaises(lzutil.LzError):
+      lzutil.decompress_into_python(src, bytearray(BLOCK_SIZE))
+    if lzutil.has_native():
+      with self.assertRaises(lzutil.LzError):
+        lzutil.decompress_into(src, bytearray(BLOCK_SIZE))
+
+
+# Returns how many bytes the first block_count blocks of src decompress to.
+def blocks_output_size(src, block_count, size):
+  return lzutil.decompress_into_python(src[:block_count * BLOCK_SIZE],
+                                       bytearray(size))
+
+
+# The block-parallel decoder needs the native codec, as the pure-Python one
+# cannot run in parallel threads.
+@unittest.skipUnless(lzutil.has_native(), 'native codec not built')
+class ParallelTest(unittest.TestCase):
+  # Checks that the parallel decoder writes the same bytes as the serial ones
+  # for the first size bytes of the output of data (padded with zeros).
+  def check(self, data, size=None):
+    size = len(data) if size is None else size
+    src = compress(data)
+    self.assertGreater(len(src), BLOCK_SIZE)
+    serial = bytearray(size)
+    serial_size = lzutil.decompress_into(src, serial)
+    self.assertEqual(serial, (data + bytes(size))[:size])
+    self.assertEqual(join_iter(lzutil.decompress_iter(src, size)), serial)
+    for max_workers in (1, 3, None):
+      with self.subTest(max_workers=max_workers):
+        dst = bytearray(size)
+        self.assertEqual(
+            lzutil.decompress_into(src, dst, parallel=True,
+                                   max_workers=max_workers), serial_size)
+        self.assertEqual(dst, serial)
+
+  def test_multiple_blocks(self):
+    self.check(make_data(8 * BLOCK_SIZE + 0x321, seed=2))
+
+  def test_incompressible(self):
+    self.check(incompressible(4 * BLOCK_SIZE + 0x55, seed=3))
+
+  # Cuts the data 3 bytes after the end of the third block, so that only a
+  # few bytes are left for the last one.
+  def test_short_final_block(self):
+    full = make_data(8 * BLOCK_SIZE, seed=4)
+    data = full[:blocks_output_size(compress(full), 3, len(full)) + 3]
+    src = compress(data)
+    block_count = -(-len(src) // BLOCK_SIZE)
+    self.assertGreater(block_count, 1)
+    self.assertLessEqual(
+        len(data) - blocks_output_size(src, block_count - 1, len(data)), 3)
+    self.check(data)
+
+  def test_size_ends_mid_block(self):
+    data = make_data(6 * BLOCK_SIZE, seed=5)
+    src = compress(data)
+    # Halfway through the output of the fourth block.
+    start = blocks_output_size(src, 3, len(data))
+    end = blocks_output_size(src, 4, len(data))
+    self.check(data, (start + end) // 2)
+    self.check(data, 1)
+
+  def test_size_past_end(self):
+    self.check(make_data(3 * BLOCK_SIZE, seed=6), 3 * BLOCK_SIZE + 0x1000)
+
+
+if __name__ == '__main__':
+  unittest.main()
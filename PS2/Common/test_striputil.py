@@ -0,0 +1,163 @@
+# Pins the winding convention of each game's strip encoding, called the way
+# the importers call striputil. Run with python PS2/Common/test_striputil.py.
+
+import unittest
+
+import numpy as np
+
+from striputil import striputil
+
+# Silent Hill 3 models: restart (ADC) bit 0x8000 on vertex addresses.
+SH3_BASE = 0x10
+R = 0x8000
+
+
+def sh3_mdl(vertices, restart):
+  tri_cmds = np.array([(SH3_BASE + v * 4) | (R if r else 0)
+                       for v, r in zip(vertices, restart)], dtype=np.int64)
+  return striputil.triangulate_restart(
+      ((tri_cmds & 0x7FFF) - SH3_BASE) // 0x4, tri_cmds & 0x8000)
+
+
+# Silent Hill 3 maps: bit 0 of the U coordinate of each vertex.
+def sh3_map(uv_flags):
+  return striputil.triangulate_restart(np.arange(len(uv_flags)),
+                                       [flag & 0x1 for flag in uv_flags])
+
+
+# Kingdom Hearts II models: flags 0x20 and 0x30 select the winding, 0 emits
+# both and 0x10 none.
+def kh2_mdlx(flags):
+  flags = np.array(flags, dtype=np.int32)
+  return striputil.triangulate_winding(np.arange(len(flags)),
+                                       (flags == 0x20) | (flags == 0),
+                                       (flags == 0x30) | (flags == 0))
+
+
+# Rule of Rose models: (vertex index, ctrl, _, reverse) elements, ctrl 0x80
+# emits nothing. Returns [[vertex index, strip position]] per corner.
+def ror(ind):
+  ind = np.array(ind, dtype=np.int32).reshape(-1, 4)
+  emit = ind[:, 1] != 0x80
+  tri = striputil.triangulate_winding(np.arange(len(ind)),
+                                      emit & (ind[:, 3] != 0),
+                                      emit & (ind[:, 3] == 0))
+  tri = tri[~striputil.is_degenerate(ind[tri, 0])]
+  return np.stack((ind[tri, 0], tri), axis=2)
+
+
+# Gitaroo Man models: back-to-back strips of triStripData, with the winding of
+# the first triangle of each strip given by its vertex normals.
+def gitaroo(strips, first_flipped):
+  return striputil.triangulate_lengths(np.concatenate(strips),
+                                       [len(strip) for strip in strips],
+                                       first_flipped)
+
+
+class StripTestCase(unittest.TestCase):
+  def assertTriangles(self, tri, expected):
+    self.assertEqual(tri.dtype, np.int32)
+    self.assertEqual(tri.shape[1:], (3,) + np.shape(expected)[2:])
+    self.assertEqual(tri.tolist(), expected)
+
+
+class Sh3MdlTest(StripTestCase):
+  def test_alternates_from_first_triangle(self):
+    self.assertTriangles(
+        sh3_mdl([0, 1, 2, 3, 4], [1, 1, 0, 0, 0]),
+        [[0, 1, 2], [3, 2, 1], [2, 3, 4]])
+
+  # Winding follows the position in the whole strip, not in the restarted one.
+  def test_restart_keeps_parity(self):
+    self.assertTriangles(
+        sh3_mdl([0, 1, 2, 3, 4, 5, 6], [1, 1, 0, 1, 1, 0, 0]),
+        [[0, 1, 2], [5, 4, 3], [4, 5, 6]])
+
+  def test_first_commands_without_restart(self):
+    self.assertTriangles(sh3_mdl([0, 1, 2], [0, 0, 0]), [[0, 1, 2]])
+
+  def test_drops_degenerate(self):
+    self.assertTriangles(
+        sh3_mdl([0, 1, 0, 2, 3], [1, 1, 0, 0, 0]), [[2, 0, 1], [0, 2, 3]])
+
+  def test_short_strips(self):
+    self.assertEqual(sh3_mdl([], []).shape, (0, 3))
+    self.assertEqual(sh3_mdl([0, 1], [1, 1]).shape, (0, 3))
+    self.assertEqual(sh3_mdl([0, 1, 2], [1, 1, 1]).shape, (0, 3))
+
+
+class Sh3MapTest(StripTestCase):
+  def test_alternates_from_first_triangle(self):
+    self.assertTriangles(sh3_map([1, 1, 0, 0, 0]),
+                         [[0, 1, 2], [3, 2, 1], [2, 3, 4]])
+
+  def test_only_bit_0_restarts(self):
+    self.assertTriangles(sh3_map([0x101, 0x3, 0x100, 0x2, 0x1, 0x0]),
+                         [[0, 1, 2], [3, 2, 1], [5, 4, 3]])
+
+  # The previous loop built triangles that wrapped around to the end of the
+  # shape for these elements.
+  def test_first_vertices_without_restart(self):
+    self.assertTriangles(sh3_map([0, 0, 0]), [[0, 1, 2]])
+
+  def test_short_strips(self):
+    self.assertEqual(sh3_map([]).shape, (0, 3))
+    self.assertEqual(sh3_map([0, 0]).shape, (0, 3))
+
+
+class Kh2MdlxTest(StripTestCase):
+  def test_flags(self):
+    self.assertTriangles(
+        kh2_mdlx([0x10, 0x10, 0x20, 0x30, 0x00, 0x10]),
+        [[0, 1, 2], [3, 2, 1], [2, 3, 4], [4, 3, 2]])
+
+  def test_first_elements_without_restart(self):
+    self.assertTriangles(kh2_mdlx([0x00, 0x20, 0x30]), [[2, 1, 0]])
+
+  def test_short_strips(self):
+    self.assertEqual(kh2_mdlx([]).shape, (0, 3))
+    self.assertEqual(kh2_mdlx([0x00, 0x00]).shape, (0, 3))
+
+
+class RorTest(StripTestCase):
+  def test_reverse_byte(self):
+    self.assertTriangles(
+        ror([(5, 0x80, 0, 0), (6, 0x80, 0, 0), (7, 0, 0, 1), (8, 0, 0, 0)]),
+        [[[5, 0], [6, 1], [7, 2]], [[8, 3], [7, 2], [6, 1]]])
+
+  def test_drops_degenerate_vertex_indices(self):
+    self.assertTriangles(
+        ror([(5, 0x80, 0, 0), (5, 0x80, 0, 0), (7, 0, 0, 1), (8, 0, 0, 1)]),
+        [[[5, 1], [7, 2], [8, 3]]])
+
+  # The previous loop built triangles from the end of the index list for
+  # these elements.
+  def test_first_elements_without_ctrl(self):
+    self.assertTriangles(
+        ror([(5, 0, 0, 1), (6, 0, 0, 0), (7, 0, 0, 1)]),
+        [[[5, 0], [6, 1], [7, 2]]])
+
+  def test_short_strips(self):
+    self.assertEqual(ror([(5, 0, 0, 1), (6, 0, 0, 0)]).shape, (0, 3, 2))
+
+
+class GitarooTest(StripTestCase):
+  def test_winding_restarts_with_each_strip(self):
+    self.assertTriangles(
+        gitaroo([[0, 1, 2, 3], [4, 5, 6]], [False, True]),
+        [[0, 1, 2], [3, 2, 1], [6, 5, 4]])
+
+  def test_drops_degenerate(self):
+    self.assertTriangles(gitaroo([[0, 0, 1, 2]], [False]), [[2, 1, 0]])
+
+  def test_short_strips(self):
+    self.assertTriangles(gitaroo([[0, 1], [2, 3, 4]], False), [[2, 3, 4]])
+    self.assertEqual(gitaroo([[0, 1]], False).shape, (0, 3))
+
+  def test_lengths_must_match(self):
+    with self.assertRaises(ValueError):
+      striputil.triangulate_lengths(np.arange(5), [3, 3])
+
+
+if __name__ == '__main__':
+  unittest.main()
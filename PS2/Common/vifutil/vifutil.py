@@ -0,0 +1,132 @@
+import collections
+import hashlib
+import struct
+
+# Helpers shared by the VIF packet parsers.
+#
+# Parsing a packet is split into compiling it into a compact list of commands
+# or operations once, and replaying that list. Compiled programs are cached by
+# packet content, so packets that occur many times (instanced submeshes,
+# morph packets with the same layout) are only decoded once per process.
+
+# One command of a VIF packet. cmd has the interrupt bit cleared, and data is
+# held in buf[offs:offs + size] of the tokenized packet.
+VifCommand = collections.namedtuple('VifCommand',
+                                    ['cmd', 'imm', 'num', 'offs', 'size'])
+
+# Hit/miss counters of a ProgramCache, or how much they grew while decoding
+# something. Decode jobs return the latter, since each worker process has its
+# own cache.
+CacheStats = collections.namedtuple('CacheStats', ['hits', 'misses'])
+
+STCYCL = 0b00000001
+MPG = 0b01001010
+STMASK = 0b00100000
+STROW = 0b00110000
+STCOL = 0b00110001
+DIRECT = 0b01010000
+DIRECTHL = 0b01010001
+
+
+def is_unpack(cmd):
+  return cmd >> 5 == 0b11
+
+
+# Returns the size in bytes of the data consumed by an UNPACK command that
+# writes num quadwords with the given cycle settings.
+def unpack_size(cmd, num, cl=1, wl=1):
+  if num == 0:
+    num = 256
+  if wl > cl:
+    num = (num // wl) * cl + min(num % wl, cl)
+  vn = ((cmd >> 2) & 0x3) + 1
+  vl_bits = 32 >> (cmd & 0x3)
+  return ((num * vn * vl_bits + 31) // 32) * 4
+
+
+# Splits a VIF packet into commands. Tokenizing stops after a command equal
+# to stop_cmd, or at the first command whose data does not fit in buf.
+def tokenize(buf, stop_cmd=None):
+  buf = memoryview(buf)
+  commands = []
+  cl = 1
+  wl = 1
+  offs = 0
+  end_offs = len(buf)
+  while offs + 4 <= end_offs:
+    imm, num, cmd = struct.unpack_from('<HBB', buf, offs)
+    cmd &= 0x7F
+    offs += 4
+    if is_unpack(cmd):
+      size = unpack_size(cmd, num, cl, wl)
+    elif cmd == STCYCL:
+      cl = imm & 0xFF
+      wl = (imm >> 8) & 0xFF
+      size = 0
+    elif cmd in (STROW, STCOL):
+      size = 0x10
+    elif cmd == STMASK:
+      size = 4
+    elif cmd == MPG:
+      size = (num or 256) * 8
+    elif cmd in (DIRECT, DIRECTHL):
+      size = (imm or 0x10000) * 0x10
+    else:
+      size = 0
+    if offs + size > end_offs:
+      break
+    commands.append(VifCommand(cmd, imm, num, offs, size))
+    if cmd == stop_cmd:
+      break
+    offs += size
+  return commands
+
+
+def sum_stats(stats):
+  hits = 0
+  misses = 0
+  for s in stats:
+    hits += s.hits
+    misses += s.misses
+  return CacheStats(hits, misses)
+
+
+# Identifies a packet by its content and any parser state it was compiled
+# against.
+def packet_key(buf, *state):
+  return (hashlib.blake2b(buf, digest_size=16).digest(),) + state
+
+
+# Least recently used cache of compiled packets.
+class ProgramCache:
+  def __init__(self, maxsize=256):
+    self.maxsize = maxsize
+    self.programs = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  # Returns the program cached for key, or compiles it with compile_fn().
+  def get(self, key, compile_fn):
+    program = self.programs.get(key)
+    if program is not None:
+      self.hits += 1
+      self.programs.move_to_end(key)
+      return program
+    self.misses += 1
+    program = compile_fn()
+    self.programs[key] = program
+    if len(self.programs) > self.maxsize:
+      self.programs.popitem(last=False)
+    return program
+
+  def stats(self):
+    return CacheStats(self.hits, self.misses)
+
+  # Returns how much the counters grew since stats() returned start.
+  def stats_since(self, start):
+    return CacheStats(self.hits - start.hits, self.misses - start.misses)
+
+  def clear(self):
+    self.programs.clear()
+    self.hits = 0
+    self.misses = 0
@@ -1,14 +1,25 @@
-''' Converts a Gitaroo Man .XG model file to .OBJ or .FBX. '''
+''' Converts a Gitaroo Man .XG model file to .OBJ, .FBX or .GLB. '''
 
 import ctypes
+import json
+import mmap
+import numpy as np
 import os
+import re
 import struct
 import sys
-import FbxCommon
-from fbx import *
+from striputil import striputil
+
+# The FBX SDK is only needed for FBX export.
+try:
+  import FbxCommon
+  from fbx import *
+except ImportError:
+  FbxCommon = None
 
 EXPORT_OBJ = False
 EXPORT_FBX = True
+EXPORT_GLB = False
 USE_FBX_BINARY_FORMAT = True
 EXPORT_ANIMATION = True
 EXPORT_NORMALS = False  # Currently broken.
@@ -24,29 +35,56 @@ def error(message):
   sys.exit(1)
 
 
+# Reads a file mapped in memory, so that values are unpacked from the mapping
+# instead of being read one at a time, and blocks of values are returned as
+# arrays without copies.
 class BinaryFileReader:
   def __init__(self, filename):
     self.f = open(filename, 'rb')
+    if os.fstat(self.f.fileno()).st_size > 0:
+      self.buf = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+    else:
+      self.buf = b''
+    self.pos = 0
+    # {encoded string: string}, as tags and object names repeat a lot.
+    self.strings = {}
+    
+  def unpack(self, fmt, size):
+    val = struct.unpack_from(fmt, self.buf, self.pos)[0]
+    self.pos += size
+    return val
     
   def getbyte(self):
-    b = self.f.read(1)
-    if b:
-      return struct.unpack('<B', b)[0]
+    if self.pos < len(self.buf):
+      return self.unpack('<B', 1)
     
   def getshort(self):
-    return struct.unpack('<H', self.f.read(2))[0]
+    return self.unpack('<H', 2)
     
   def getint(self):
-    return struct.unpack('<I', self.f.read(4))[0]
+    return self.unpack('<I', 4)
     
   def getsignedint(self):
-    return struct.unpack('<i', self.f.read(4))[0]
+    return self.unpack('<i', 4)
     
   def getfloat(self):
-    return struct.unpack('<f', self.f.read(4))[0]
+    return self.unpack('<f', 4)
     
   def getsignedshort(self):
-    return struct.unpack('<h', self.f.read(2))[0]
+    return self.unpack('<h', 2)
+    
+  # Returns the values of the struct.Struct s at the current position.
+  def getstruct(self, s):
+    vals = s.unpack_from(self.buf, self.pos)
+    self.pos += s.size
+    return vals
+    
+  # Returns the next count values of type dtype as a read-only NumPy array.
+  def getarray(self, count, dtype):
+    dtype = np.dtype(dtype)
+    a = np.frombuffer(self.buf, dtype, count, self.pos)
+    self.pos += count * dtype.itemsize
+    return a
     
   def getblock(self, len, func):
     b = []
@@ -55,70 +93,135 @@ class BinaryFileReader:
     return b
     
   def getstringb(self):
-    len = self.getbyte()
-    if len:
-      return self.f.read(len).decode('cp932')
+    pos = self.pos
+    if pos < len(self.buf):
+      end = pos + 1 + self.buf[pos]
+      self.pos = end
+      if end > pos + 1:
+        raw = self.buf[pos + 1:end]
+        string = self.strings.get(raw)
+        if string is None:
+          string = self.strings[raw] = raw.decode('cp932')
+        return string
   
   def read(self, n):
-    return self.f.read(n)
+    b = self.buf[self.pos:self.pos + n]
+    self.pos += len(b)
+    return b
+  
+  # Returns the offset of the next match of the compiled regular expression
+  # pattern that starts a multiple of align bytes after the current position,
+  # or -1 if there is none.
+  def find(self, pattern, align=1):
+    m = pattern.search(self.buf, self.pos)
+    while m and (m.start() - self.pos) % align:
+      m = pattern.search(self.buf, m.start() + 1)
+    return m.start() if m else -1
   
   def seek(self, n):
-    self.f.seek(n)
+    self.pos = n
     
   def tell(self):
-    return self.f.tell()
+    return self.pos
   
   def skip(self, n):
-    self.f.seek(self.f.tell() + n)
+    self.pos += n
     
+  # Arrays returned by getarray() keep the mapping alive until they are
+  # released.
   def close(self):
+    self.buf = b''
     self.f.close()
 
 
+# Floats per vertex, by vertex type.
+VERTEX_SIZES = {
+  1:  4,   # X,Y,Z,W
+  3:  7,   # X,Y,Z,W, NX,NY,NZ
+  7:  11,  # X,Y,Z,W, NX,NY,NZ, X2,Y2,Z2,W2
+  11: 9,   # X,Y,Z,W, NX,NY,NZ, U,V
+  15: 13   # X,Y,Z,W, NX,NY,NZ, X2,Y2,Z2,W2, U,V
+}
+
+# Vertices are returned as [type, count, (count, floats per vertex) array].
 def parse_data_vertices(f):
   type = f.getint()
   len = f.getint()
-  blocks = []
-  if type == 1:
-    bsize = 4   # X,Y,Z,W
-  elif type == 3:
-    bsize = 7   # X,Y,Z,W, NX,NY,NZ
-  elif type == 7:
-    bsize = 11  # X,Y,Z,W, NX,NY,NZ, X2,Y2,Z2,W2
-  elif type == 11:
-    bsize = 9   # X,Y,Z,W, NX,NY,NZ, U,V
-  elif type == 15:
-    bsize = 13  # X,Y,Z,W, NX,NY,NZ, X2,Y2,Z2,W2, U,V
-  
-  for i in range(len):
-    b = []
-    for j in range(bsize):
-      b += [f.getfloat()]
-    blocks += [b]
+  if type not in VERTEX_SIZES:
+    error("Unsupported vertex type: " + str(type))
+  bsize = VERTEX_SIZES[type]
   
+  blocks = f.getarray(len * bsize, '<f4').reshape(len, bsize)
   return [type, len, blocks]
 
+# Returns views of the position, normal, second position and UV columns of
+# parsed vertices, or None for those that the vertex type does not have.
+def vertex_channels(vertices):
+  type, len, blocks = vertices
+  pos = blocks[:, 0:3]
+  normals = blocks[:, 4:7] if type > 1 else None
+  pos2 = blocks[:, 7:10] if type in (7, 15) else None
+  if type == 11:
+    uvs = blocks[:, 7:9]
+  elif type == 15:
+    uvs = blocks[:, 11:13]
+  else:
+    uvs = None
+  return pos, normals, pos2, uvs
+
+# Vertex indices are grouped in blocks ended by a negative value, one block
+# per weight of the envelope.
 def parse_data_vertex_targets(f):
   len = f.getint()
-  blocks = []
-  curblock = []
-  for i in range(len):
-    val = f.getsignedint()
-    if val >= 0:
-      curblock += [val]
-    else:
-      blocks += [curblock]
-      curblock = []
-  return blocks
+  vals = f.getarray(len, '<i4')
+  ends = np.flatnonzero(vals < 0)
+  starts = np.concatenate(([0], ends[:-1] + 1))
+  return [vals[start:end] for start, end in zip(starts, ends)]
+
+# Weights are returned as one (count, 4) array.
+def parse_data_weights(f):
+  len = f.getint()
+  return [f.getarray(len * 4, '<f4').reshape(len, 4)]
+
+# Skips size bytes of parameter data, returning no data.
+def skip_data(f, size):
+  f.skip(size)
+  return []
+
+def skip_data_vertices(f):
+  type = f.getint()
+  len = f.getint()
+  if type not in VERTEX_SIZES:
+    error("Unsupported vertex type: " + str(type))
+  return skip_data(f, len * VERTEX_SIZES[type] * 4)
+
+def skip_data_vertex_targets(f):
+  return skip_data(f, f.getint() * 4)
+
+def skip_data_weights(f):
+  return skip_data(f, f.getint() * 16)
   
+# Tags that can follow the keys of an interpolator.
+KEYS_END_TAGS = re.compile(b"\x09inp|\x07tar")
+
 def parse_data_keys(f):
   # It's suspected that the size of this block is dependent on the model entry in the .XGM file.
-  # For now just seek to the end of the data field by finding the next valid tag.
-  tag = f.read(4)
-  while tag != b"\x09inp" and tag != b"\x07tar":
-    tag = f.read(4)  # Skip floats
-  f.seek(f.tell() - 4)
-  return []
+  # For now just find the end of the data field by finding the next valid tag,
+  # and return the floats up to it as one flat array.
+  start = f.tell()
+  end = f.find(KEYS_END_TAGS, 4)
+  if end < 0:
+    error("Expected end of keys at offset " + hex(start))
+  return [f.getarray((end - start) // 4, '<f4')]
+
+
+# Functions that skip the data read by the parsers used in obj_defs, for those
+# that can find its end without decoding it.
+param_skippers = {
+  parse_data_vertices:       skip_data_vertices,
+  parse_data_vertex_targets: skip_data_vertex_targets,
+  parse_data_weights:        skip_data_weights
+}
 
 
 obj_defs = {
@@ -148,7 +251,7 @@ obj_defs = {
   },
   "xgEnvelope": {
     "startVertex":       ["int"],
-    "weights":           ["len", [4,"float"]],
+    "weights":           [parse_data_weights],
     "vertexTargets":     [parse_data_vertex_targets],
     "inputMatrix1":      ["str"],
     "envelopeMatrix":    ["str"],
@@ -247,6 +350,9 @@ obj_defs = {
 }
 
 
+# Reads the data of a parameter by interpreting its spec from obj_defs.
+# Parsing uses the decoders compiled by compile_param_data instead, which
+# return the same lists.
 def parse_param_data(data_list, f):
     data = []
     count = 1
@@ -282,7 +388,112 @@ def parse_param_data(data_list, f):
     return data
 
 
-def parse_object(obj_type, f):
+# Struct format characters of the value types of obj_defs that have a fixed
+# size.
+VALUE_FORMATS = {"int": "I", "sint": "i", "float": "f"}
+
+
+# Returns the struct format of a spec made only of fixed size values, or None.
+def fixed_format(data_list):
+  fmt = "<"
+  count = 1
+  for t in data_list:
+    if type(t) is int:
+      count = t
+    elif type(t) is str and t in VALUE_FORMATS:
+      fmt += str(count) + VALUE_FORMATS[t]
+      count = 1
+    else:
+      return None
+  return fmt
+
+
+# Compiles the spec of a parameter from obj_defs into a function that reads
+# the data of the parameter from a BinaryFileReader, returning the same list
+# as parse_param_data. "len" must be followed by the spec of the elements it
+# counts, as it is everywhere in obj_defs.
+#
+# With skip=True, the function only moves past the data instead, returning an
+# empty list. Strings are still read, as parse_object checks them for the tag
+# of the next parameter.
+def compile_param_data(data_list, skip=False):
+  fmt = fixed_format(data_list)
+  if fmt is not None:
+    s = struct.Struct(fmt)
+    if skip:
+      return lambda f: skip_data(f, s.size)
+    return lambda f: list(f.getstruct(s))
+  
+  decoders = []
+  count = 1
+  i = 0
+  while i < len(data_list):
+    t = data_list[i]
+    if type(t) is int:
+      count = t
+      
+    elif t == "len":
+      if count != 1 or i + 1 >= len(data_list) or type(data_list[i + 1]) is not list:
+        raise ValueError("Unsupported parameter spec: " + repr(data_list))
+      decoders += [compile_block(data_list[i + 1], skip)]
+      i += 1
+      
+    elif type(t) is str:
+      fmt = fixed_format([count, t])
+      if fmt is not None:
+        decoders += [compile_param_data([count, t], skip)]
+      elif t == "str":
+        decoders += [lambda f, count=count: [f.getstringb() for j in range(count)]]
+      else:
+        raise ValueError("Unsupported parameter spec: " + repr(data_list))
+      count = 1
+      
+    elif type(t) is list:
+      raise ValueError("Unsupported parameter spec: " + repr(data_list))
+      
+    elif hasattr(t, '__call__'):
+      decoders += [param_skippers.get(t, t) if skip else t]
+    i += 1
+  
+  if len(decoders) == 1:
+    return decoders[0]
+  def decode(f):
+    data = []
+    for decoder in decoders:
+      data += decoder(f)
+    return data
+  return decode
+
+
+# Compiles the spec of the elements of a "len" prefixed block, returning a
+# function that reads the length and the elements.
+def compile_block(data_list, skip=False):
+  fmt = fixed_format(data_list)
+  if fmt is not None:
+    s = struct.Struct(fmt)
+    if skip:
+      return lambda f: skip_data(f, f.getint() * s.size)
+    return lambda f: [list(vals) for vals in s.iter_unpack(f.read(f.getint() * s.size))]
+  decoder = compile_param_data(data_list, skip)
+  return lambda f: [decoder(f) for j in range(f.getint())]
+
+
+# Returns {object type: {parameter: decoder}} for the specs of obj_defs.
+# Decoders are made by compile_spec, compile_param_data by default.
+def compile_obj_defs(obj_defs, compile_spec=compile_param_data):
+  return {
+    obj_type: {tag: compile_spec(data_list) for tag, data_list in param_list.items()}
+    for obj_type, param_list in obj_defs.items()
+  }
+
+
+obj_decoders = compile_obj_defs(obj_defs)
+obj_skippers = compile_obj_defs(obj_defs, lambda data_list: compile_param_data(data_list, skip=True))
+
+
+# Parses the parameters of an object, read by decoders ({parameter: decoder})
+# for its type.
+def parse_object(obj_type, f, decoders):
   params = {}
   
   prev_empty = False
@@ -297,12 +508,10 @@ def parse_object(obj_type, f):
     if tag == "}":
       break
     
-    elif tag in obj_defs[obj_type]:
-      param_list = obj_defs[obj_type]
-      data_list = param_list[tag]
-      data = parse_param_data(data_list, f)
+    elif tag in decoders:
+      data = decoders[tag](f)
       
-      if len(data) > 0 and type(data[0]) is str and (data[0] in param_list or data[0] == "}"):
+      if len(data) > 0 and type(data[0]) is str and (data[0] in decoders or data[0] == "}"):
         # Empty
         if tag not in params:
           params[tag] = []
@@ -340,7 +549,33 @@ def parse_dag(f):
   return dag
 
 
-def parse_xg(f):
+# An object of an XG file, as {"type": type, "params": params}, whose
+# parameters are only parsed from its span [start, end) of the file when
+# "params" is first accessed.
+class LazyObject(dict):
+  def __init__(self, obj_type, f, start, end, decoders):
+    dict.__init__(self, type=obj_type)
+    self.f = f
+    self.start = start
+    self.end = end
+    self.decoders = decoders
+    
+  def __missing__(self, key):
+    if key != "params":
+      raise KeyError(key)
+    pos = self.f.tell()
+    self.f.seek(self.start)
+    params = parse_object(self["type"], self.f, self.decoders)
+    self.f.seek(pos)
+    self["params"] = params
+    return params
+
+
+# Returns the dag, {object name: object} and {object type: [object names]}
+# of an XG file. With lazy=True, objects are only indexed here and parse
+# their parameters when they are first used, so the reader must stay open
+# until then.
+def parse_xg(f, decoders=obj_decoders, lazy=True):
   dag = {}
   objs = {}
   obj_types = {}
@@ -355,7 +590,7 @@ def parse_xg(f):
         error("Unexpected { following \"dag\"")
       dag = parse_dag(f)
       
-    elif tag in obj_defs:
+    elif tag in decoders:
       obj_type = tag
       obj_name = f.getstringb()
       if not obj_name or obj_name in ["{", "}", ";"]:
@@ -367,9 +602,14 @@ def parse_xg(f):
       elif next != "{":
         error("Unexpected string \"" + next + "\" after object name")
       
-      obj = {}
-      obj["type"] = obj_type
-      obj["params"] = parse_object(obj_type, f)
+      if lazy:
+        start = f.tell()
+        parse_object(obj_type, f, obj_skippers[obj_type])
+        obj = LazyObject(obj_type, f, start, f.tell(), decoders[obj_type])
+      else:
+        obj = {}
+        obj["type"] = obj_type
+        obj["params"] = parse_object(obj_type, f, decoders[obj_type])
       objs[obj_name] = obj
       if obj_type not in obj_types:
         obj_types[obj_type] = [obj_name]
@@ -392,6 +632,104 @@ def fixString(buffer):
       result += c
   return result
 
+# Returns the triangles of a mesh as a (count, 3) array of vertex indices, and
+# the smallest and largest index used. Triangles are wound to face the same way
+# as most of the normals of their vertices, from the vertex positions vBlock
+# and normals nBlock.
+def mesh_triangles(xgDagMesh, vBlock, nBlock):
+  primType = xgDagMesh["primType"][0]
+  triangles = [np.empty((0, 3), dtype=np.int64)]
+  vMin = len(vBlock) + 1
+  vMax = 0
+  
+  # Returns whether each triangle (s1[i], s2[i], s3[i]) faces away from the
+  # normals of most of its vertices.
+  def shouldreverse(vB, nB, s1, s2, s3):
+    if len(nB) > 0:
+      u = vB[s2] - vB[s1]
+      v = vB[s3] - vB[s1]
+      
+      nx = u[:, 1]*v[:, 2] - u[:, 2]*v[:, 1]
+      ny = u[:, 2]*v[:, 0] - u[:, 0]*v[:, 2]
+      nz = u[:, 0]*v[:, 1] - u[:, 1]*v[:, 0]
+      
+      r = np.zeros(len(s1), dtype=int)
+      for s in (s1, s2, s3):
+        r += (nx*nB[s, 0] + ny*nB[s, 1] + nz*nB[s, 2]) > 0
+      return r >= 2
+    return np.zeros(len(s1), dtype=bool)
+  
+  # Triangle lists
+  tListCount = xgDagMesh["triListCount"][0]
+  tLists = []
+  tListVTotal = 0
+  if tListCount > 0:
+    if primType == 4:
+      # Explicit List
+      tListCount = xgDagMesh["triListData"][0][0]
+      tLists = [v[0] for v in xgDagMesh["triListData"][1:]]
+      tListVTotal = tListCount
+    elif primType == 5:
+      # Start + End
+      tListStart = xgDagMesh["triListData"][0][0]
+      tListCount = xgDagMesh["triListData"][1][0]
+      tLists = range(tListStart, tListStart + tListCount)
+      tListVTotal = sum([v[0] for v in xgDagMesh["triListData"][1:]])
+    else:
+      error("Unsupported primType: " + str(primType))
+  
+    tListTris = np.asarray(tLists, dtype=np.int64)[:len(tLists) // 3 * 3].reshape(-1, 3)
+    if len(tListTris):
+      vMin = min(vMin, int(tListTris.min()))
+      vMax = max(vMax, int(tListTris.max()))
+      reverse = shouldreverse(vBlock, nBlock, tListTris[:, 0], tListTris[:, 1], tListTris[:, 2])
+      tListTris[reverse] = tListTris[reverse, ::-1]
+      triangles += [tListTris]
+  
+  # Triangle strips
+  tStripCount = xgDagMesh["triStripCount"][0]
+  tStrips = []
+  tStripVTotal = 0
+  if tStripCount > 0:
+    if primType == 4:
+      # Explicit List
+      stripSize = 0
+      ind = 0
+      for j in range(tStripCount):
+        strip = []
+        stripSize = xgDagMesh["triStripData"][ind][0]
+        tStripVTotal += stripSize
+        for k in range(stripSize):
+          strip += xgDagMesh["triStripData"][ind+k+1]
+        tStrips += [strip]
+        ind += stripSize + 1
+    elif primType == 5:
+      # Start + List of # of vertices per strip
+      tStripStart = xgDagMesh["triStripData"][0][0]
+      ind = 0
+      for j in range(tStripCount):
+        stripSize = xgDagMesh["triStripData"][j+1][0]
+        strip = range(tStripStart+ind, tStripStart+ind+stripSize)
+        tStrips += [strip]
+        ind += stripSize
+      tStripVTotal = sum([v[0] for v in xgDagMesh["triStripData"][1:]])
+    else:
+      error("Unsupported primType: " + str(primType))
+      
+    # Winding alternates within each strip, starting from the winding of
+    # the first triangle as judged by its vertex normals.
+    tStrips = [strip for strip in tStrips if len(strip) >= 3]
+    if tStrips:
+      tStripIndices = np.concatenate([np.asarray(strip) for strip in tStrips])
+      vMin = min(vMin, int(tStripIndices.min()))
+      vMax = max(vMax, int(tStripIndices.max()))
+      tStripFirsts = np.asarray([strip[:3] for strip in tStrips])
+      triangles += [striputil.triangulate_lengths(
+        tStripIndices, [len(strip) for strip in tStrips],
+        shouldreverse(vBlock, nBlock, tStripFirsts[:, 0], tStripFirsts[:, 1], tStripFirsts[:, 2])).astype(np.int64)]
+  return np.concatenate(triangles), vMin, vMax
+
+
 def outputFbx(filebasename, objs, materialNames, boneNames, meshNames, timeNames):
   (sdk_manager, scene) = FbxCommon.InitializeSdkObjects()
   root_node = scene.GetRootNode()
@@ -476,128 +814,13 @@ def outputFbx(filebasename, objs, materialNames, boneNames, meshNames, timeNames
       meshNode.AddMaterial(materials[xgDagMesh["inputMaterial"][0]])
       meshNode.SetShadingMode(FbxNode.eTextureShading)
     
-    primType = xgDagMesh["primType"][0]
-    vType, vCount, vData = xgBgGeometry["vertices"]
-    vBlock = [(v[0], v[1], v[2]) for v in vData]
-    nBlock = [(v[4], v[5], v[6]) for v in vData] if vType > 1 else []
-    if vType == 11:
-      uvBlock = [(v[7], v[8]) for v in vData]
-    elif vType == 15:
-      uvBlock = [(v[11], v[12]) for v in vData]
-    else:
-      uvBlock = []
+    # Positions and normals are copied as they are adjusted by bones below.
+    vPos, vNorm, vPos2, vUv = vertex_channels(xgBgGeometry["vertices"])
+    vBlock = vPos.astype(np.float64)
+    nBlock = vNorm.astype(np.float64) if vNorm is not None else np.empty((0, 3))
+    uvBlock = vUv if vUv is not None else np.empty((0, 2))
 
-    # triangles
-    triangles = []
-    vMin = len(vBlock) + 1
-    vMax = 0
-    
-    def shouldreverse(vB, nB, s1, s2, s3):
-      if len(nB) > 0:
-        ux = vB[s2][0] - vB[s1][0]
-        uy = vB[s2][1] - vB[s1][1]
-        uz = vB[s2][2] - vB[s1][2]
-        vx = vB[s3][0] - vB[s1][0]
-        vy = vB[s3][1] - vB[s1][1]
-        vz = vB[s3][2] - vB[s1][2]
-        
-        nx = uy*vz - uz*vy
-        ny = uz*vx - ux*vz
-        nz = ux*vy - uy*vx
-        
-        # nxavg = (nB[s1][0] + nB[s2][0] + nB[s3][0]) / 3.
-        # nyavg = (nB[s1][1] + nB[s2][1] + nB[s3][1]) / 3.
-        # nzavg = (nB[s1][2] + nB[s2][2] + nB[s3][2]) / 3.
-        
-        # return nx*nxavg + ny*nyavg + nz*nzavg > 0
-
-        r1 = 1 if (nx*nB[s1][0] + ny*nB[s1][1] + nz*nB[s1][2]) > 0 else 0
-        r2 = 1 if (nx*nB[s2][0] + ny*nB[s2][1] + nz*nB[s2][2]) > 0 else 0
-        r3 = 1 if (nx*nB[s3][0] + ny*nB[s3][1] + nz*nB[s3][2]) > 0 else 0
-        return r1 + r2 + r3 >= 2
-      return False
-    
-    def trackminmax(s1, s2, s3, vMin, vMax):
-      sMin = min(s1, s2, s3)
-      if sMin < vMin:
-        vMin = sMin
-      sMax = max(s1, s2, s3)
-      if sMax > vMax:
-        vMax = sMax
-      return vMin, vMax
-    
-    # Triangle lists
-    tListCount = xgDagMesh["triListCount"][0]
-    tLists = []
-    tListVTotal = 0
-    if tListCount > 0:
-      if primType == 4:
-        # Explicit List
-        tListCount = xgDagMesh["triListData"][0][0]
-        tLists = [v[0] for v in xgDagMesh["triListData"][1:]]
-        tListVTotal = tListCount
-      elif primType == 5:
-        # Start + End
-        tListStart = xgDagMesh["triListData"][0][0]
-        tListCount = xgDagMesh["triListData"][1][0]
-        tLists = range(tListStart, tListStart + tListCount)
-        tListVTotal = sum([v[0] for v in xgDagMesh["triListData"][1:]])
-      else:
-        error("Unsupported primType: " + str(primType))
-    
-      for j in range(len(tLists))[::3]:
-        s1 = tLists[j]
-        s2 = tLists[j+1]
-        s3 = tLists[j+2]
-        vMin, vMax = trackminmax(s1, s2, s3, vMin, vMax)
-        if shouldreverse(vBlock, nBlock, s1, s2, s3):
-          triangles += [(s3, s2, s1)]
-        else:
-          triangles += [(s1, s2, s3)]
-    
-    # Triangle strips
-    tStripCount = xgDagMesh["triStripCount"][0]
-    tStrips = []
-    tStripVTotal = 0
-    if tStripCount > 0:
-      if primType == 4:
-        # Explicit List
-        stripSize = 0
-        ind = 0
-        for j in range(tStripCount):
-          strip = []
-          stripSize = xgDagMesh["triStripData"][ind][0]
-          tStripVTotal += stripSize
-          for k in range(stripSize):
-            strip += xgDagMesh["triStripData"][ind+k+1]
-          tStrips += [strip]
-          ind += stripSize + 1
-      elif primType == 5:
-        # Start + List of # of vertices per strip
-        tStripStart = xgDagMesh["triStripData"][0][0]
-        ind = 0
-        for j in range(tStripCount):
-          stripSize = xgDagMesh["triStripData"][j+1][0]
-          strip = range(tStripStart+ind, tStripStart+ind+stripSize)
-          tStrips += [strip]
-          ind += stripSize
-        tStripVTotal = sum([v[0] for v in xgDagMesh["triStripData"][1:]])
-      else:
-        error("Unsupported primType: " + str(primType))
-        
-      for j in range(len(tStrips)):
-        strip = tStrips[j]
-        reverse = shouldreverse(vBlock, nBlock, strip[0], strip[1], strip[2])
-        for k in range(len(strip) - 2):
-          s1 = strip[k]
-          s2 = strip[k+1]
-          s3 = strip[k+2]
-          vMin, vMax = trackminmax(s1, s2, s3, vMin, vMax)
-          if reverse:
-            triangles += [(s3, s2, s1)]
-          else:
-            triangles += [(s1, s2, s3)]
-          reverse = not reverse
+    triangles, vMin, vMax = mesh_triangles(xgDagMesh, vBlock, nBlock)
           
     # Pre-adjust vertices given rest pose and bone transform.
     if "inputGeometry" in xgBgGeometry:
@@ -622,22 +845,22 @@ def outputFbx(filebasename, objs, materialNames, boneNames, meshNames, timeNames
         M_s.SetTRS(FbxVector4(), FbxVector4(), FbxVector4(-1.0, 1.0, 1.0))
         M_r = M_s * M_r
         
-        for j in range(len(xgEnvelope["vertexTargets"])):
-          for k in xgEnvelope["vertexTargets"][j]:
-            v = FbxVector4(vBlock[k][0], vBlock[k][1], vBlock[k][2], 1.0)
-            v = M_r.MultNormalize(v)
-            vBlock[k] = [v[0], v[1], v[2]]
-            if nBlock:
-              n = FbxVector4(nBlock[k][0], nBlock[k][1], nBlock[k][2], 0.0)
-
-              # Because MultNormalize normalizes the w component of the vector to 1,
-              # there is literally no way to multiply a standard matrix by a normal
-              # vector using the FBX SDK...
-              nx, ny, nz = nBlock[k]
-              nnx = M_r_it.Get(0, 0) * nx + M_r_it.Get(0, 1) * ny + M_r_it.Get(0, 2) * nz
-              nny = M_r_it.Get(1, 0) * nx + M_r_it.Get(1, 1) * ny + M_r_it.Get(1, 2) * nz
-              nnz = M_r_it.Get(2, 0) * nx + M_r_it.Get(2, 1) * ny + M_r_it.Get(2, 2) * nz
-              nBlock[k] = [-nnx, nny, nnz]
+        # Because MultNormalize normalizes the w component of the vector to 1,
+        # there is literally no way to multiply a standard matrix by a normal
+        # vector using the FBX SDK...
+        M_n = [[M_r_it.Get(r, c) for c in range(3)] for r in range(3)]
+        
+        for block in xgEnvelope["vertexTargets"]:
+          for k in block.tolist():
+            x, y, z = vBlock[k].tolist()
+            v = M_r.MultNormalize(FbxVector4(x, y, z, 1.0))
+            vBlock[k] = (v[0], v[1], v[2])
+            if len(nBlock):
+              nx, ny, nz = nBlock[k].tolist()
+              nnx = M_n[0][0] * nx + M_n[0][1] * ny + M_n[0][2] * nz
+              nny = M_n[1][0] * nx + M_n[1][1] * ny + M_n[1][2] * nz
+              nnz = M_n[2][0] * nx + M_n[2][1] * ny + M_n[2][2] * nz
+              nBlock[k] = (-nnx, nny, nnz)
 
         # M_w = FbxAMatrix()
         # M_w.SetT(FbxVector4(-xgBonePos[0], xgBonePos[1], xgBonePos[2]))
@@ -656,12 +879,11 @@ def outputFbx(filebasename, objs, materialNames, boneNames, meshNames, timeNames
    
     # Vertices
     mesh.InitControlPoints(vMax - vMin + 1)
-    for j in range(vMin, vMax + 1):
-      v = FbxVector4(vBlock[j][0], vBlock[j][1], vBlock[j][2])
-      mesh.SetControlPointAt(v, j - vMin)
+    for j, (x, y, z) in enumerate(vBlock[vMin:vMax + 1].tolist()):
+      mesh.SetControlPointAt(FbxVector4(x, y, z), j)
           
     # Add triangles to mesh.
-    for s1, s2, s3 in triangles:
+    for s1, s2, s3 in triangles.tolist():
       s1 -= vMin
       s2 -= vMin
       s3 -= vMin
@@ -680,8 +902,7 @@ def outputFbx(filebasename, objs, materialNames, boneNames, meshNames, timeNames
       layerElemUV.SetMappingMode(FbxLayerElement.eByControlPoint)
       layerElemUV.SetReferenceMode(FbxLayerElement.eDirect)
       mesh.GetLayer(0).SetUVs(layerElemUV, FbxLayerElement.eTextureDiffuse)
-      for j in range(vMin, vMax + 1):
-        u, v = uvBlock[j]
+      for u, v in uvBlock[vMin:vMax + 1].tolist():
         uv = FbxVector2(u, 1.0 - v)
         layerElemUV.GetDirectArray().Add(uv)
       
@@ -691,8 +912,7 @@ def outputFbx(filebasename, objs, materialNames, boneNames, meshNames, timeNames
       layerElemNormal.SetMappingMode(FbxLayerElement.eByControlPoint)
       layerElemNormal.SetReferenceMode(FbxLayerElement.eDirect)
       mesh.GetLayer(0).SetNormals(layerElemNormal)
-      for j in range(vMin, vMax + 1):
-        nx, ny, nz = nBlock[j]
+      for nx, ny, nz in nBlock[vMin:vMax + 1].tolist():
         n = FbxVector4(nx, ny, nz)
         layerElemNormal.GetDirectArray().Add(n)
     
@@ -784,9 +1004,11 @@ def outputFbx(filebasename, objs, materialNames, boneNames, meshNames, timeNames
         #M_iw = scene.GetAnimationEvaluator().GetNodeGlobalTransform(bone).Inverse()
         #cluster.SetTransformMatrix(M_iw)
         
-        for j in range(len(xgEnvelope["vertexTargets"])):
-          for v in xgEnvelope["vertexTargets"][j]:
-            cluster.AddControlPointIndex(v - vMin, xgEnvelope["weights"][j][0])
+        weights = xgEnvelope["weights"][0]
+        for j, block in enumerate(xgEnvelope["vertexTargets"]):
+          weight = float(weights[j, 0])
+          for v in (block - vMin).tolist():
+            cluster.AddControlPointIndex(v, weight)
             
         skin.AddCluster(cluster)
 
@@ -941,13 +1163,335 @@ def outputFbx(filebasename, objs, materialNames, boneNames, meshNames, timeNames
   sdk_manager.Destroy()
 
 
+# glTF component types, by NumPy dtype, and accessor types, by array shape.
+GLTF_COMPONENT_TYPES = {
+  np.dtype(np.uint8):   5121,
+  np.dtype(np.uint16):  5123,
+  np.dtype(np.uint32):  5125,
+  np.dtype(np.float32): 5126
+}
+GLTF_TYPES = {
+  (): "SCALAR",
+  (2,): "VEC2",
+  (3,): "VEC3",
+  (4,): "VEC4",
+  (4, 4): "MAT4"
+}
+GLTF_ARRAY_BUFFER = 34962
+GLTF_ELEMENT_ARRAY_BUFFER = 34963
+
+# Binary buffer of a GLB file, with the glTF buffer views and accessors that
+# describe it. Each array added gets its own view and is written to the file
+# as it is, in one write.
+class GlbBuffer:
+  def __init__(self):
+    self.arrays = []
+    self.size = 0
+    self.views = []
+    self.accessors = []
+    
+  # Adds a (count, ...) array and returns the index of its accessor. Matrices
+  # must be transposed to the column-major order of glTF.
+  def add(self, array, target=None, bounds=False):
+    array = np.ascontiguousarray(array)
+    view = {"buffer": 0, "byteOffset": self.size, "byteLength": array.nbytes}
+    if target is not None:
+      view["target"] = target
+    self.views += [view]
+    self.arrays += [array]
+    self.size += array.nbytes
+    # Views must start at a multiple of 4 bytes.
+    padding = -self.size % 4
+    if padding:
+      self.arrays += [np.zeros(padding, dtype=np.uint8)]
+      self.size += padding
+    
+    accessor = {
+      "bufferView": len(self.views) - 1,
+      "componentType": GLTF_COMPONENT_TYPES[array.dtype],
+      "count": len(array),
+      "type": GLTF_TYPES[array.shape[1:]]
+    }
+    if bounds:
+      accessor["min"] = np.atleast_1d(array.min(axis=0)).tolist()
+      accessor["max"] = np.atleast_1d(array.max(axis=0)).tolist()
+    self.accessors += [accessor]
+    return len(self.accessors) - 1
+    
+  # Writes a GLB file with the glTF JSON gltf and the buffer.
+  def write(self, filename, gltf):
+    if self.size > 0:
+      gltf["buffers"] = [{"byteLength": self.size}]
+      gltf["bufferViews"] = self.views
+      gltf["accessors"] = self.accessors
+    jsonChunk = json.dumps(gltf, separators=(',', ':')).encode()
+    jsonChunk += b' ' * (-len(jsonChunk) % 4)
+    size = 12 + 8 + len(jsonChunk)
+    if self.size > 0:
+      size += 8 + self.size
+    with open(filename, "wb") as f:
+      f.write(struct.pack("<4sII", b"glTF", 2, size))
+      f.write(struct.pack("<I4s", len(jsonChunk), b"JSON"))
+      f.write(jsonChunk)
+      if self.size > 0:
+        f.write(struct.pack("<I4s", self.size, b"BIN\0"))
+        for array in self.arrays:
+          f.write(array)
+
+# Returns (count, 4) X,Y,Z,W quaternions scaled to unit length, with zero
+# quaternions replaced by the identity.
+def unit_quats(q):
+  q = np.asarray(q, dtype=np.float64).reshape(-1, 4)
+  norms = np.linalg.norm(q, axis=1)
+  q = q / np.where(norms > 0, norms, 1)[:, None]
+  q[norms == 0] = (0., 0., 0., 1.)
+  return q
+
+# Returns the (count, 4, 4) matrices that rotate by the unit quaternions q and
+# then translate by t, for column vectors.
+def trs_matrices(t, q):
+  x, y, z, w = q.T
+  m = np.zeros((len(q), 4, 4))
+  m[:, 0, 0] = 1 - 2*(y*y + z*z)
+  m[:, 0, 1] = 2*(x*y - z*w)
+  m[:, 0, 2] = 2*(x*z + y*w)
+  m[:, 1, 0] = 2*(x*y + z*w)
+  m[:, 1, 1] = 1 - 2*(x*x + z*z)
+  m[:, 1, 2] = 2*(y*z - x*w)
+  m[:, 2, 0] = 2*(x*z - y*w)
+  m[:, 2, 1] = 2*(y*z + x*w)
+  m[:, 2, 2] = 1 - 2*(x*x + y*y)
+  m[:, :3, 3] = t
+  m[:, 3, 3] = 1
+  return m
+
+# Exports the meshes, skeleton and bone animation to a binary glTF file,
+# without the FBX SDK. The scene is converted the same way as by outputFbx:
+# X is mirrored, the bones are flat children of a root node, enveloped
+# vertices are moved to their rest pose and bone rotations are read as
+# -X,Y,Z,W quaternions. Unlike in FBX, every bone is bound at its initial
+# transform, and vertices that no bone moves are bound to the root node.
+def outputGlb(filebasename, objs, materialNames, boneNames, meshNames, timeNames):
+  buf = GlbBuffer()
+  mirror = np.array([-1., 1., 1.])
+  
+  # Materials
+  materials = {}
+  gltfMaterials = []
+  images = []
+  imageIndices = {}
+  for i in range(len(materialNames)):
+    materialName = materialNames[i]
+    xgMaterial = objs[materialNames[i]]
+    if xgMaterial["type"] == "xgMultiPassMaterial":
+      materialName = xgMaterial["params"]["inputMaterial"][1]
+      xgMaterial = objs[xgMaterial["params"]["inputMaterial"][1]]["params"]
+    else:
+      xgMaterial = xgMaterial["params"]
+    
+    diffuse = np.clip(xgMaterial["diffuse"], 0., 1.).tolist()
+    pbr = {"baseColorFactor": diffuse, "metallicFactor": 0.}
+    material = {"name": materialName, "pbrMetallicRoughness": pbr}
+    if diffuse[3] < 1.:
+      material["alphaMode"] = "BLEND"
+    
+    if "inputTexture" in xgMaterial:
+      xgTexture = objs[xgMaterial["inputTexture"][0]]["params"]
+      texUrl = xgTexture["url"][0].replace('.imx', '.png')
+      if '/' in texUrl:
+        texUrl = texUrl[len(texUrl) - texUrl[::-1].index('/'):]
+      if texUrl not in imageIndices:
+        imageIndices[texUrl] = len(images)
+        images += [{"uri": texUrl}]
+        print("*** Texture required:", texUrl)
+      pbr["baseColorTexture"] = {"index": imageIndices[texUrl]}
+    
+    materials[materialNames[i]] = len(gltfMaterials)
+    gltfMaterials += [material]
+  
+  # Skeleton. Joint 0 is the root node, joint i + 1 is bone i.
+  nodes = [{"name": os.path.basename(filebasename)}]
+  boneMatrices = [objs[objs[name]["params"]["inputMatrix"][0]]["params"] for name in boneNames]
+  bonePos = np.zeros((len(boneNames), 3))
+  boneRot = np.zeros((len(boneNames), 4))
+  for i in range(len(boneNames)):
+    xgBoneMatrix = boneMatrices[i]
+    bonePos[i] = xgBoneMatrix["position"]
+    boneRot[i] = xgBoneMatrix["rotation"]
+    xgParentBoneMatrix = xgBoneMatrix
+    while "inputParentMatrix" in xgParentBoneMatrix:
+      xgParentBoneMatrix = objs[xgParentBoneMatrix["inputParentMatrix"][0]]["params"]
+      bonePos[i] += xgParentBoneMatrix["position"]
+  bonePos *= mirror
+  boneRot = unit_quats(boneRot * [-1., 1., 1., 1.])
+  for i in range(len(boneNames)):
+    nodes += [{
+      "name": boneNames[i],
+      "translation": bonePos[i].tolist(),
+      "rotation": boneRot[i].tolist()
+    }]
+  boneIndices = {boneNames[i]: i for i in range(len(boneNames))}
+  
+  skins = []
+  if boneNames:
+    nodes[0]["children"] = list(range(1, len(boneNames) + 1))
+    inverseBind = np.linalg.inv(trs_matrices(bonePos, boneRot))
+    inverseBind = np.concatenate((np.identity(4)[None], inverseBind))
+    skins = [{
+      "joints": list(range(len(boneNames) + 1)),
+      "skeleton": 0,
+      "inverseBindMatrices": buf.add(inverseBind.transpose(0, 2, 1).astype(np.float32))
+    }]
+  
+  # Meshes
+  meshes = []
+  for i in range(len(meshNames)):
+    xgDagMesh = objs[meshNames[i]]["params"]
+    xgBgGeometry = objs[xgDagMesh["inputGeometry"][0]]["params"]
+    
+    vPos, vNorm, vPos2, vUv = vertex_channels(xgBgGeometry["vertices"])
+    vBlock = vPos.astype(np.float64)
+    nBlock = vNorm.astype(np.float64) if vNorm is not None else np.empty((0, 3))
+    
+    # Move enveloped vertices to their rest pose, and gather the bone weights
+    # of each vertex as (vertex, joint, weight) arrays.
+    skinVerts = []
+    skinJoints = []
+    skinWeights = []
+    for name in xgBgGeometry.get("inputGeometry", []):
+      xgEnvelope = objs[name]["params"]
+      if "inputMatrix1" not in xgEnvelope:
+        continue  # no bone
+      boneName = xgEnvelope["inputMatrix1"][0]
+      xgBone = objs[boneName]["params"]
+      blocks = xgEnvelope["vertexTargets"]
+      if not blocks:
+        continue
+      targets = np.concatenate(blocks)
+      lengths = [len(block) for block in blocks]
+      skinVerts += [targets]
+      skinJoints += [np.full(len(targets), boneIndices[boneName] + 1)]
+      skinWeights += [np.repeat(xgEnvelope["weights"][0][:len(blocks), 0], lengths)]
+      
+      targets = targets[targets < len(vBlock)]
+      M_r = np.asarray(xgBone["restMatrix"], dtype=np.float64).reshape(4, 4)
+      v = np.hstack((vBlock[targets], np.ones((len(targets), 1)))) @ M_r
+      vBlock[targets] = v[:, :3] / v[:, 3:]
+      if len(nBlock):
+        nBlock[targets] = nBlock[targets] @ np.linalg.pinv(M_r[:3, :3]).T
+    vBlock *= mirror
+    nBlock *= mirror
+    
+    # Winding is judged once vertices are in place, as mirroring flips it.
+    triangles, vMin, vMax = mesh_triangles(xgDagMesh, vBlock, nBlock)
+    if len(triangles) == 0:
+      continue
+    if len(nBlock) == 0:
+      triangles = triangles[:, ::-1]
+    vCount = vMax - vMin + 1
+    
+    attributes = {
+      "POSITION": buf.add(vBlock[vMin:vMax + 1].astype(np.float32), GLTF_ARRAY_BUFFER, bounds=True)
+    }
+    if vUv is not None:
+      attributes["TEXCOORD_0"] = buf.add(vUv[vMin:vMax + 1], GLTF_ARRAY_BUFFER)
+    
+    # Keep the 4 largest weights of each vertex, scaled to add up to 1.
+    if skins:
+      joints = np.zeros((vCount, 4), dtype=np.uint16)
+      weights = np.zeros((vCount, 4), dtype=np.float32)
+      if skinVerts:
+        sVerts = np.concatenate(skinVerts) - vMin
+        sJoints = np.concatenate(skinJoints)
+        sWeights = np.concatenate(skinWeights)
+        keep = (sVerts >= 0) & (sVerts < vCount) & (sWeights > 0)
+        sVerts, sJoints, sWeights = sVerts[keep], sJoints[keep], sWeights[keep]
+        order = np.lexsort((-sWeights, sVerts))
+        sVerts, sJoints, sWeights = sVerts[order], sJoints[order], sWeights[order]
+        rank = np.arange(len(sVerts)) - np.searchsorted(sVerts, sVerts)
+        keep = rank < 4
+        joints[sVerts[keep], rank[keep]] = sJoints[keep]
+        weights[sVerts[keep], rank[keep]] = sWeights[keep]
+      totals = weights.sum(axis=1)
+      weights[totals == 0, 0] = 1.
+      weights /= np.where(totals > 0, totals, 1.)[:, None]
+      attributes["JOINTS_0"] = buf.add(joints, GLTF_ARRAY_BUFFER)
+      attributes["WEIGHTS_0"] = buf.add(weights, GLTF_ARRAY_BUFFER)
+    
+    indexType = np.uint16 if vCount < 0xFFFF else np.uint32
+    primitive = {
+      "attributes": attributes,
+      "indices": buf.add((triangles - vMin).astype(indexType).ravel(), GLTF_ELEMENT_ARRAY_BUFFER),
+      "mode": 4  # Triangles
+    }
+    if xgDagMesh["inputMaterial"][0] in materials:
+      primitive["material"] = materials[xgDagMesh["inputMaterial"][0]]
+    
+    node = {"name": meshNames[i], "mesh": len(meshes)}
+    if skins:
+      node["skin"] = 0
+    nodes += [node]
+    meshes += [{"name": meshNames[i], "primitives": [primitive]}]
+  
+  # Animation, with all animations concatenated together as in FBX export.
+  samplers = []
+  channels = []
+  if EXPORT_ANIMATION and len(timeNames) > 0:
+    timeAccessors = {}
+    for i in range(len(boneNames)):
+      xgBoneMatrix = boneMatrices[i]
+      # Position keys are local to the parent, as if the skeleton was flat.
+      for inputName, path, size, convert in (
+          ("inputPosition", "translation", 3, lambda keys: keys * mirror),
+          ("inputRotation", "rotation", 4, lambda keys: unit_quats(keys * [-1., 1., 1., 1.])),
+          ("inputScale", "scale", 3, lambda keys: keys)):
+        if inputName not in xgBoneMatrix:
+          continue
+        xgInterp = objs[xgBoneMatrix[inputName][0]]["params"]
+        if xgInterp["type"][0] != 1:
+          print("Warning: Unknown animation type", xgInterp["type"])
+          continue
+        keys = np.asarray(xgInterp["keys"], dtype=np.float64).reshape(-1, size)
+        if len(keys) == 0:
+          continue
+        if len(keys) not in timeAccessors:
+          times = np.arange(len(keys)) / PLAYBACK_SPEED / FRAMES_PER_SECOND
+          timeAccessors[len(keys)] = buf.add(times.astype(np.float32), bounds=True)
+        channels += [{"sampler": len(samplers), "target": {"node": i + 1, "path": path}}]
+        samplers += [{
+          "input": timeAccessors[len(keys)],
+          "output": buf.add(convert(keys).astype(np.float32)),
+          "interpolation": "LINEAR"
+        }]
+  
+  gltf = {
+    "asset": {"version": "2.0", "generator": "xg.py"},
+    "scene": 0,
+    "scenes": [{"nodes": [0] + list(range(len(boneNames) + 1, len(nodes)))}],
+    "nodes": nodes
+  }
+  if meshes:
+    gltf["meshes"] = meshes
+  if gltfMaterials:
+    gltf["materials"] = gltfMaterials
+  if images:
+    gltf["images"] = images
+    gltf["textures"] = [{"source": j} for j in range(len(images))]
+  if skins:
+    gltf["skins"] = skins
+  if channels:
+    gltf["animations"] = [{"name": "XGAnim", "samplers": samplers, "channels": channels}]
+  buf.write(filebasename + ".glb", gltf)
+
+
 def outputMesh(filebasename, objs, meshNames):
   def ffloat(val):
     return "%.4f" % val
   def ffloatarr(vals):
     return " ".join([ffloat(v) for v in vals])
-  def slash(val, count):
-    return "/".join([str(val) for i in range(count)])
+  # Formats each row of a 2D array with fmt, at once.
+  def frows(fmt, rows):
+    return (fmt * len(rows)) % tuple(rows.ravel().tolist())
 
   # Material
   with open(filebasename + ".mat", "w+") as f:
@@ -958,190 +1502,176 @@ def outputMesh(filebasename, objs, meshNames):
       if xgMaterialName not in matNames:
         matNames += [xgMaterialName]
   
+    out = []
     for i in range(len(matNames)):
       xgMaterial = objs[matNames[i]]
       
-      f.write("newmtl " + matNames[i].replace('$', '_') + "\n")
-      f.write("illum 2\n")
+      out += ["newmtl " + matNames[i].replace('$', '_') + "\n"]
+      out += ["illum 2\n"]
       if "diffuse" in xgMaterial["params"]:
-        f.write("Kd " + ffloatarr(xgMaterial["params"]["diffuse"][:3]) + "\n")
-      f.write("Ka 0.0000 0.0000 0.0000\n")
+        out += ["Kd " + ffloatarr(xgMaterial["params"]["diffuse"][:3]) + "\n"]
+      out += ["Ka 0.0000 0.0000 0.0000\n"]
       if "specular" in xgMaterial["params"]:
-        f.write("Ks " + ffloatarr(xgMaterial["params"]["specular"][:3]) + "\n")
+        out += ["Ks " + ffloatarr(xgMaterial["params"]["specular"][:3]) + "\n"]
       
       if "inputTexture" in xgMaterial["params"]:
         xgTextureName = xgMaterial["params"]["inputTexture"][0]
         xgTexture = objs[xgTextureName]
         texname = xgTexture["params"]["url"][0]
         texname = texname[:texname.find(".")] + ".png"
-        f.write("map_Kd " + texname + "\n")
+        out += ["map_Kd " + texname + "\n"]
         print("Texture needed:", texname)
       
-      f.write("\n")
+      out += ["\n"]
+    f.write("".join(out))
+  
+  # Vertices of all meshes are gathered first, as face winding is judged from
+  # the vertices and normals written up to each mesh.
+  meshes = []
+  for i in range(0, len(meshNames)):
+    xgDagMesh = objs[meshNames[i]]
+    xgBgGeometryName = xgDagMesh["params"]["inputGeometry"][0]
+    xgBgGeometry = objs[xgBgGeometryName]
+    
+    # Vertices (only those that are used by the mesh, not the whole list)
+    vPos, vNorm, vPos2, vUv = vertex_channels(xgBgGeometry["params"]["vertices"])
+    primType = xgDagMesh["params"]["primType"][0]
+    
+    tStripCount = xgDagMesh["params"]["triStripCount"][0]
+    tStripData = xgDagMesh["params"]["triStripData"]
+    tStripSizes = []
+    tStrips = np.empty(0, dtype=np.int64)
+    if tStripCount > 0:
+      if primType == 4:
+        # Explicit List
+        tStripData = np.asarray(tStripData, dtype=np.int64).reshape(-1)
+        tStripStarts = []
+        ind = 0
+        for j in range(tStripCount):
+          stripSize = int(tStripData[ind])
+          tStripStarts += [ind + 1]
+          tStripSizes += [stripSize]
+          ind += stripSize + 1
+        tStrips = np.concatenate([tStripData[start:start + size] for start, size in zip(tStripStarts, tStripSizes)])
+      elif primType == 5:
+        # Start + List of # of vertices per strip
+        tStripStart = tStripData[0][0]
+        tStripSizes = [tStripData[j+1][0] for j in range(tStripCount)]
+        tStripVTotal = sum([v[0] for v in tStripData[1:]])
+        tStrips = np.arange(tStripStart, tStripStart+tStripVTotal)
+      else:
+        error("Unsupported primType: " + str(primType))
+    
+    tListCount = xgDagMesh["params"]["triListCount"][0]
+    tLists = np.empty(0, dtype=np.int64)
+    if tListCount > 0:
+      if primType == 4:
+        # Explicit List
+        tListData = np.asarray(xgDagMesh["params"]["triListData"], dtype=np.int64).reshape(-1)
+        tListCount = int(tListData[0])
+        tLists = tListData[1:]
+      elif primType == 5:
+        # Start + End
+        tListStart = xgDagMesh["params"]["triListData"][0][0]
+        tListCount = xgDagMesh["params"]["triListData"][1][0]
+        tLists = np.arange(tListStart, tListStart + tListCount)
+      else:
+        error("Unsupported primType: " + str(primType))
+    
+    # X is mirrored.
+    vIndices = np.concatenate((tLists, tStrips)).astype(np.intp)
+    meshPos = vPos[vIndices].astype(np.float64)
+    meshPos[:, 0] *= -1.0
+    meshNorms = np.empty((0, 3))
+    if vNorm is not None:
+      meshNorms = vNorm[vIndices].astype(np.float64)
+      meshNorms[:, 0] *= -1.0
+    meshUvs = np.empty((0, 2))
+    if vUv is not None:
+      meshUvs = vUv[vIndices].astype(np.float64)
+    meshes += [(meshPos, meshNorms, meshUvs, tListCount, np.asarray(tStripSizes, dtype=np.int64))]
+  
+  pos = np.concatenate([np.empty((0, 3))] + [mesh[0] for mesh in meshes])
+  norms = np.concatenate([np.empty((0, 3))] + [mesh[1] for mesh in meshes])
+  uvs = np.concatenate([np.empty((0, 2))] + [mesh[2] for mesh in meshes])
+  
+  # Returns whether the faces starting at each of the 1-based vertex indices
+  # vIndices should be reversed, given the first posCount positions and
+  # normsCount normals written. Faces are judged from the vertices at vIndex,
+  # vIndex + 1 and vIndex + 2 used as 0-based indices.
+  def shouldreverse(vIndices, posCount, normsCount):
+    if normsCount == 0 or len(vIndices) == 0:
+      return np.zeros(len(vIndices), dtype=bool)
+    if vIndices.max() + 2 >= min(posCount, normsCount):
+      error("Vertex index out of range while checking face winding")
+    u = pos[vIndices+1] - pos[vIndices]
+    v = pos[vIndices+2] - pos[vIndices]
+    
+    nx = u[:, 1]*v[:, 2] - u[:, 2]*v[:, 1]
+    ny = u[:, 2]*v[:, 0] - u[:, 0]*v[:, 2]
+    nz = u[:, 0]*v[:, 1] - u[:, 1]*v[:, 0]
+    
+    navg = (norms[vIndices] + norms[vIndices+1] + norms[vIndices+2]) / 3
+    
+    return nx*navg[:, 0] + ny*navg[:, 1] + nz*navg[:, 2] > 0
   
   # Wavefront OBJ
   with open(filebasename + ".obj", "w+") as f:
     f.write("mtllib " + filebasename + ".mat\n")
     f.write("o " + filebasename + "\n\n")
     
-    pos = []
-    uvs = []
-    norms = []
-    
-    def shouldreverse(startIndex):
-      if len(norms) > 0:
-        ux = pos[vIndex+1][0] - pos[vIndex][0]
-        uy = pos[vIndex+1][1] - pos[vIndex][1]
-        uz = pos[vIndex+1][2] - pos[vIndex][2]
-        vx = pos[vIndex+2][0] - pos[vIndex][0]
-        vy = pos[vIndex+2][1] - pos[vIndex][1]
-        vz = pos[vIndex+2][2] - pos[vIndex][2]
-        
-        nx = uy*vz - uz*vy
-        ny = uz*vx - ux*vz
-        nz = ux*vy - uy*vx
-        
-        nxavg = (norms[vIndex][0] + norms[vIndex+1][0] + norms[vIndex+2][0]) / 3
-        nyavg = (norms[vIndex][1] + norms[vIndex+1][1] + norms[vIndex+2][1]) / 3
-        nzavg = (norms[vIndex][2] + norms[vIndex+1][2] + norms[vIndex+2][2]) / 3
-        
-        return nx*nxavg + ny*nyavg + nz*nzavg > 0
-      return False
-    
     vIndex = 1
-    vTotalCount = 0
+    posCount = 0
+    normsCount = 0
+    uvsCount = 0
     for i in range(0, len(meshNames)):
       xgDagMesh = objs[meshNames[i]]
-      xgBgGeometryName = xgDagMesh["params"]["inputGeometry"][0]
-      xgBgGeometry = objs[xgBgGeometryName]
-      
-      f.write("g " + meshNames[i].replace('$', '_') + "\n")
-      f.write("usemtl " + xgDagMesh["params"]["inputMaterial"][0].replace('$', '_') + "\n")
-      
-      # Vertices (only those that are used by the mesh, not the whole list)
-      vType, vCount, vData = xgBgGeometry["params"]["vertices"]
-      primType = xgDagMesh["params"]["primType"][0]
+      meshPos, meshNorms, meshUvs, tListCount, tStripSizes = meshes[i]
+      posCount += len(meshPos)
+      normsCount += len(meshNorms)
+      uvsCount += len(meshUvs)
       
-      tStripCount = xgDagMesh["params"]["triStripCount"][0]
-      tStrips = []
-      tStripVTotal = 0
-      if tStripCount > 0:
-        if primType == 4:
-          # Explicit List
-          stripSize = 0
-          ind = 0
-          for j in range(tStripCount):
-            stripSize = xgDagMesh["params"]["triStripData"][ind][0]
-            tStripVTotal += stripSize
-            for k in range(stripSize):
-              tStrips += xgDagMesh["params"]["triStripData"][ind+k+1]
-            ind += stripSize + 1
-        elif primType == 5:
-          # Start + List of # of vertices per strip
-          tStripStart = xgDagMesh["params"]["triStripData"][0][0]
-          tStripVTotal = sum([v[0] for v in xgDagMesh["params"]["triStripData"][1:]])
-          tStrips = list(range(tStripStart, tStripStart+tStripVTotal))
-        else:
-          error("Unsupported primType: " + str(primType))
-      
-      tListCount = xgDagMesh["params"]["triListCount"][0]
-      tLists = []
-      tListVTotal = 0
-      if tListCount > 0:
-        if primType == 4:
-          # Explicit List
-          tListCount = xgDagMesh["params"]["triListData"][0][0]
-          tLists = [v[0] for v in xgDagMesh["params"]["triListData"][1:]]
-          tListVTotal = tListCount
-        elif primType == 5:
-          # Start + End
-          tListStart = xgDagMesh["params"]["triListData"][0][0]
-          tListCount = xgDagMesh["params"]["triListData"][1][0]
-          tLists = list(range(tListStart, tListStart + tListCount))
-          tListVTotal = sum([v[0] for v in xgDagMesh["params"]["triListData"][1:]])
-        else:
-          error("Unsupported primType: " + str(primType))
+      out = ["g " + meshNames[i].replace('$', '_') + "\n"]
+      out += ["usemtl " + xgDagMesh["params"]["inputMaterial"][0].replace('$', '_') + "\n"]
+      out += [frows("v %.4f %.4f %.4f\n", meshPos)]
       
-      for j in tLists + tStrips:
-        if vType == 1:
-          x, y, z, w = vData[j]
-          x *= -1.0
-          f.write("v " + ffloatarr([x,y,z]) + "\n")
-          pos += [[x,y,z]]
-        elif vType == 3:
-          x, y, z, w, nx, ny, nz = vData[j]
-          x *= -1.0
-          nx *= -1.0
-          f.write("v " + ffloatarr([x,y,z]) + "\n")
-          pos += [[x,y,z]]
-          norms += [[nx,ny,nz]]
-        elif vType == 7:
-          x, y, z, w, nx, ny, nz, x2, y2, z2, w2 = vData[j]
-          x *= -1.0
-          x2 *= -1.0
-          nx *= -1.0
-          f.write("v " + ffloatarr([x,y,z]) + "\n")
-          pos += [[x,y,z]]
-          norms += [[nx,ny,nz]]
-        elif vType == 11:
-          x, y, z, w, nx, ny, nz, u, v = vData[j]
-          x *= -1.0
-          nx *= -1.0
-          f.write("v " + ffloatarr([x,y,z]) + "\n")
-          pos += [[x,y,z]]
-          norms += [[nx,ny,nz]]
-          uvs += [[u,v]]
-        elif vType == 15:
-          x, y, z, w, nx, ny, nz, x2, y2, z2, w2, u, v = vData[j]
-          x *= -1.0
-          x2 *= -1.0
-          nx *= -1.0
-          f.write("v " + ffloatarr([x,y,z]) + "\n")
-          pos += [[x,y,z]]
-          norms += [[nx,ny,nz]]
-          uvs += [[u,v]]
-        
       # Normals
-      for nx, ny, nz in norms[vIndex-1:]:
-        f.write("vn " + ffloatarr([nx,ny,nz]) + "\n")
+      out += [frows("vn %.4f %.4f %.4f\n", norms[vIndex-1:normsCount])]
         
       # Texture Coordinates
-      for u, v in uvs[vIndex-1:]:
-        f.write("vt " + ffloatarr([u,v*-1]) + "\n")
+      meshUvs = uvs[vIndex-1:uvsCount].copy()
+      meshUvs[:, 1] *= -1
+      out += [frows("vt %.4f %.4f\n", meshUvs)]
       
-      # Triangle Lists
-      tListData = xgDagMesh["params"]["triListData"]
-      for k in range(tListCount // 3):
-        if shouldreverse(vIndex):
-          f.write("f " + slash(vIndex+k*3+2,3) + " " + slash(vIndex+k*3+1,3) + " " + slash(vIndex+k*3,3) + "\n")
-        else:
-          f.write("f " + slash(vIndex+k*3,3) + " " + slash(vIndex+k*3+1,3) + " " + slash(vIndex+k*3+2,3) + "\n")
+      # Triangle Lists. All of them have the winding of the first one.
+      tListFaces = np.empty((0, 3), dtype=np.int64)
+      if tListCount // 3 > 0:
+        tListStarts = vIndex + 3 * np.arange(tListCount // 3)
+        tListFaces = np.stack((tListStarts, tListStarts + 1, tListStarts + 2), axis=1)
+        if shouldreverse(np.array([vIndex]), posCount, normsCount)[0]:
+          tListFaces = tListFaces[:, ::-1]
       vIndex += tListCount
       
-      # Triangle Strips
-      tStripData = xgDagMesh["params"]["triStripData"]
-      tStripSize = 0
-      ind = 0
-      for j in range(tStripCount):
+      # Triangle Strips. Winding alternates within each strip, starting from
+      # that of its first triangle.
+      tStripFaceCounts = np.maximum(tStripSizes - 2, 0)
+      tStripAdvance = tStripFaceCounts + 2
+      tStripStarts = vIndex + np.cumsum(tStripAdvance) - tStripAdvance
+      tStripReverse = np.zeros(len(tStripSizes), dtype=bool)
+      hasFaces = tStripFaceCounts > 0
+      tStripReverse[hasFaces] = shouldreverse(tStripStarts[hasFaces], posCount, normsCount)
+      strip = np.repeat(np.arange(len(tStripSizes)), tStripFaceCounts)
+      k = np.arange(len(strip)) - (np.cumsum(tStripFaceCounts) - tStripFaceCounts)[strip]
+      tStripFaceStarts = tStripStarts[strip] + k
+      tStripFaces = np.stack((tStripFaceStarts, tStripFaceStarts + 1, tStripFaceStarts + 2), axis=1)
+      reverse = tStripReverse[strip] != (k % 2 == 1)
+      tStripFaces[reverse] = tStripFaces[reverse, ::-1]
+      vIndex += int(tStripAdvance.sum())
       
-        if primType == 4:
-          tStripSize = tStripData[ind][0]
-          ind += tStripSize + 1
-        elif primType == 5:
-          tStripSize = tStripData[j+1][0]
-        
-        for k in range(tStripSize - 2):
-          if k == 0:
-            reverse = shouldreverse(vIndex)
-          if reverse:
-            f.write("f " + slash(vIndex+2,3) + " " + slash(vIndex+1,3) + " " + slash(vIndex,3) + "\n")
-          else:
-            f.write("f " + slash(vIndex,3) + " " + slash(vIndex+1,3) + " " + slash(vIndex+2,3) + "\n")
-          reverse = not reverse
-          vIndex += 1
-        vIndex += 2
-
-      f.write("\n")
+      faces = np.concatenate((tListFaces, tStripFaces))
+      out += [frows("f %d/%d/%d %d/%d/%d %d/%d/%d\n", np.repeat(faces, 3, axis=1))]
+      out += ["\n"]
+      f.write("".join(out))
 
       
 def testVertices(objs, meshNames):
@@ -1188,11 +1718,21 @@ def printDag(objs, obj_types):
 
 
 def main():
-  if len(sys.argv) != 2:
-    print("Usage: python xg.py <XG File>")
+  formats = sys.argv[2:]
+  if len(sys.argv) < 2 or any(fmt not in ("obj", "fbx", "glb") for fmt in formats):
+    print("Usage: python xg.py <XG File> [obj] [fbx] [glb]")
     sys.exit(1)
    
   filename = sys.argv[1]
+  exportObj = "obj" in formats if formats else EXPORT_OBJ
+  exportFbx = "fbx" in formats if formats else EXPORT_FBX
+  exportGlb = "glb" in formats if formats else EXPORT_GLB
+  if exportFbx and FbxCommon is None:
+    if formats:
+      error("FBX export requires the FBX Python SDK")
+    print("FBX Python SDK not found, exporting GLB instead of FBX.")
+    exportFbx = False
+    exportGlb = True
   
   try:
     f = BinaryFileReader(filename)
@@ -1208,20 +1748,29 @@ def main():
   if header != b"XGBv1.00":
     error("File type not supported")
   
-  dag, objs, obj_types = parse_xg(f)
+  # FBX and GLB export use almost every object, which is faster to parse in one
+  # pass.
+  dag, objs, obj_types = parse_xg(f, lazy=not (exportFbx or exportGlb))
   
   if DEBUG_PRINT_DAG:
     printDag(objs, obj_types)
   
   prefix = filename[:filename.index('.')]
-  if EXPORT_OBJ:
+  if exportObj:
     outputMesh(prefix, objs, obj_types["xgDagMesh"])
 
-  if EXPORT_FBX:
-    mats = obj_types["xgMaterial"]
-    if "xgMultiPassMaterial" in obj_types:
-      mats += obj_types["xgMultiPassMaterial"]
-    outputFbx(prefix, objs, mats, obj_types["xgBone"] if "xgBone" in obj_types else [], obj_types["xgDagMesh"], obj_types["xgTime"] if "xgTime" in obj_types else [])
+  mats = obj_types["xgMaterial"]
+  if "xgMultiPassMaterial" in obj_types:
+    mats += obj_types["xgMultiPassMaterial"]
+  bones = obj_types["xgBone"] if "xgBone" in obj_types else []
+  times = obj_types["xgTime"] if "xgTime" in obj_types else []
+  # GLB export comes first, as FBX export adds parent bone positions to the
+  # bone positions in objs.
+  if exportGlb:
+    outputGlb(prefix, objs, mats, bones, obj_types["xgDagMesh"], times)
+
+  if exportFbx:
+    outputFbx(prefix, objs, mats, bones, obj_types["xgDagMesh"], times)
   
   # testVertices(objs, obj_types["xgDagMesh"])
   
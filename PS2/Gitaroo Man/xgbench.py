@@ -0,0 +1,236 @@
+# Measures how fast xg.py parses XG models, on a synthetic model with objects
+# of every type, and checks that the compiled parameter decoders and lazy
+# parsing read the same data as the parse_param_data interpreter.
+
+import argparse
+import os
+import random
+import struct
+import tempfile
+import time
+
+import numpy as np
+
+import xg
+
+parser = argparse.ArgumentParser(description='''
+Benchmarks parsing of Gitaroo Man (PS2) XG models.
+''')
+parser.add_argument('--meshes', type=int, default=200,
+                    help='Number of meshes in the test model')
+parser.add_argument('--vertices', type=int, default=100,
+                    help='Number of vertices per mesh')
+parser.add_argument('--keys', type=int, default=30,
+                    help='Number of keys of the position and rotation '
+                    'interpolators of each bone')
+parser.add_argument('--repeat', type=int, default=5,
+                    help='Number of runs, the fastest one is reported')
+parser.add_argument('--seed', type=int, default=0)
+args = parser.parse_args()
+
+
+class XgWriter:
+  def __init__(self):
+    self.buf = bytearray(b'XGBv1.00')
+
+  def strings(self, *vals):
+    for val in vals:
+      val = val.encode('cp932')
+      self.buf += bytes([len(val)]) + val
+    return self
+
+  def ints(self, *vals):
+    self.buf += struct.pack(f'<{len(vals)}I', *vals)
+    return self
+
+  def floats(self, *vals):
+    self.buf += struct.pack(f'<{len(vals)}f', *vals)
+    return self
+
+  def begin(self, obj_type, name):
+    self.strings(obj_type, name, '{')
+
+  def end(self):
+    self.strings('}')
+
+
+# Returns an XG model with a skeleton of bones, and meshes made of triangle
+# lists and strips that use envelopes, materials and vertex interpolators.
+def make_model(mesh_count, vertex_count, key_count, rng):
+  w = XgWriter()
+  w.strings('dag', '{', 'mesh0', '[', ']', '}')
+  w.strings('xgTexture', 'tex', ';')
+
+  w.begin('xgTime', 'time')
+  w.strings('numFrames').floats(60.0)
+  w.strings('time').floats(0.0)
+  w.end()
+  w.begin('xgTexture', 'tex')
+  w.strings('url', 'tex.imx')
+  w.strings('mipmap_depth').ints(0)
+  w.end()
+  w.begin('xgMaterial', 'mat')
+  w.strings('blendType').ints(0)
+  w.strings('shadingType').ints(1)
+  w.strings('diffuse').floats(1.0, 1.0, 1.0, 1.0)
+  w.strings('specular').floats(0.0, 0.0, 0.0, 1.0)
+  w.strings('flags').ints(0)
+  w.strings('textureEnv').ints(0)
+  w.strings('uTile').ints(1)
+  w.strings('vTile').ints(1)
+  w.strings('inputTexture', 'tex', 'outputTexture')
+  w.end()
+
+  bone_count = 8
+  for i in range(bone_count):
+    w.begin('xgVec3Interpolator', f'pos{i}')
+    w.strings('type').ints(1)
+    w.strings('keys').ints(key_count)
+    w.floats(*(rng.uniform(-1, 1) for _ in range(key_count * 3)))
+    w.strings('inputTime', 'time', 'outputTime')
+    w.end()
+    w.begin('xgQuatInterpolator', f'rot{i}')
+    w.strings('type').ints(1)
+    w.strings('keys').ints(key_count)
+    w.floats(*(rng.uniform(-1, 1) for _ in range(key_count * 4)))
+    w.strings('inputTime', 'time', 'outputTime')
+    w.end()
+    w.begin('xgBgMatrix', f'matrix{i}')
+    w.strings('position').floats(0.0, 1.0, 0.0)
+    w.strings('rotation').floats(0.0, 0.0, 0.0, 1.0)
+    w.strings('scale').floats(1.0, 1.0, 1.0)
+    w.strings('inputPosition', f'pos{i}', 'inputRotation', f'rot{i}')
+    w.strings('outputQuat', 'outputVec3')
+    if i > 0:
+      w.strings('inputParentMatrix', f'matrix{i - 1}')
+    w.strings('outputMatrix')
+    w.end()
+    w.begin('xgBone', f'bone{i}')
+    w.strings('restMatrix').floats(*np.identity(4).ravel())
+    w.strings('inputMatrix', f'matrix{i}', 'outputMatrix')
+    w.end()
+
+  for i in range(mesh_count):
+    # Type 15 vertices: X,Y,Z,W, NX,NY,NZ, X2,Y2,Z2,W2, U,V
+    vertices = np.array([[rng.uniform(-1, 1) for _ in range(13)]
+                         for _ in range(vertex_count)], dtype='<f4')
+    for j in range(2):
+      targets = list(range(j, vertex_count, 2))
+      w.begin('xgEnvelope', f'env{i}_{j}')
+      w.strings('startVertex').ints(0)
+      w.strings('weights').ints(len(targets))
+      w.floats(*(rng.random() for _ in range(len(targets) * 4)))
+      w.strings('vertexTargets').ints(len(targets) * 2)
+      w.buf += struct.pack(f'<{len(targets) * 2}i',
+                           *(v for t in targets for v in (t, -1)))
+      w.strings('inputMatrix1', f'bone{rng.randrange(bone_count)}')
+      w.strings('envelopeMatrix', 'inputGeometry', f'envgeom{i}',
+                'outputGeometry')
+      w.end()
+    w.begin('xgBgGeometry', f'envgeom{i}')
+    w.strings('density').floats(1.0)
+    w.strings('vertices').ints(15, vertex_count)
+    w.buf += vertices.tobytes()
+    w.strings('outputGeometry')
+    w.end()
+    w.begin('xgBgGeometry', f'geom{i}')
+    w.strings('density').floats(1.0)
+    w.strings('vertices').ints(15, vertex_count)
+    w.buf += vertices.tobytes()
+    w.strings('inputGeometry', f'env{i}_0', 'inputGeometry', f'env{i}_1')
+    w.strings('outputGeometry')
+    w.end()
+    w.begin('xgVertexInterpolator', f'morph{i}')
+    w.strings('type').ints(1)
+    w.strings('times').ints(2).floats(0.0, 1.0)
+    w.strings('keys')
+    w.floats(*(rng.uniform(-1, 1) for _ in range(vertex_count * 3)))
+    w.strings('targets').ints(1, i)
+    w.strings('inputTime', 'time', 'outputTime')
+    w.end()
+
+    half = vertex_count // 2 // 3 * 3
+    strips = []
+    start = half
+    while vertex_count - start >= 3:
+      size = min(rng.randint(3, 16), vertex_count - start)
+      strips.append(list(range(start, start + size)))
+      start += size
+    w.begin('xgDagMesh', f'mesh{i}')
+    w.strings('primType').ints(4)
+    w.strings('primCount').ints(2)
+    w.strings('primData').ints(0)
+    w.strings('triFanCount').ints(0)
+    w.strings('triFanData').ints(0)
+    w.strings('triStripCount').ints(len(strips))
+    strip_data = [v for strip in strips for v in [len(strip)] + strip]
+    w.strings('triStripData').ints(len(strip_data), *strip_data)
+    w.strings('triListCount').ints(1)
+    w.strings('triListData').ints(half + 1, half, *range(half))
+    w.strings('cullFunc').ints(0)
+    w.strings('inputGeometry', f'geom{i}', 'outputGeometry')
+    w.strings('inputMaterial', 'mat', 'outputMaterial')
+    w.end()
+  return bytes(w.buf)
+
+
+def same(a, b):
+  if isinstance(a, np.ndarray):
+    return isinstance(b, np.ndarray) and np.array_equal(a, b)
+  if isinstance(a, (list, tuple)):
+    return (isinstance(b, (list, tuple)) and len(a) == len(b) and
+            all(same(x, y) for x, y in zip(a, b)))
+  if isinstance(a, dict):
+    return (isinstance(b, dict) and a.keys() == b.keys() and
+            all(same(a[key], b[key]) for key in a))
+  return a == b
+
+
+def bench(name, path, parse):
+  best = None
+  for _ in range(args.repeat):
+    start = time.perf_counter()
+    f = xg.BinaryFileReader(path)
+    f.read(8)
+    objs = parse(f)
+    elapsed = time.perf_counter() - start
+    best = elapsed if best is None else min(best, elapsed)
+  print(f'{name}: {len(objs) / best:.0f} objects/s ({best * 1000:.1f} ms)')
+  return objs
+
+
+# Parses objects lazily, then the parameters of those of the given types (all
+# if None).
+def parse_lazy(f, obj_types=None):
+  objs = xg.parse_xg(f)[1]
+  for obj in objs.values():
+    if obj_types is None or obj["type"] in obj_types:
+      obj["params"]
+  return objs
+
+
+data = make_model(args.meshes, args.vertices, args.keys,
+                  random.Random(args.seed))
+with tempfile.TemporaryDirectory() as tmpdir:
+  path = os.path.join(tmpdir, 'bench.xg')
+  with open(path, 'wb') as f:
+    f.write(data)
+  print(f'Parsing a {len(data)} byte model...')
+  interpreted = xg.compile_obj_defs(
+      xg.obj_defs, lambda data_list: lambda f: xg.parse_param_data(data_list, f))
+  expected = bench('interpreted',
+                   path, lambda f: xg.parse_xg(f, interpreted, lazy=False)[1])
+  results = {
+      'compiled':
+          bench('compiled', path, lambda f: xg.parse_xg(f, lazy=False)[1]),
+      'lazy, all objects':
+          bench('lazy, all objects', path, parse_lazy),
+  }
+  bench('lazy, index only', path, lambda f: xg.parse_xg(f)[1])
+  bench('lazy, objects used by OBJ export', path, lambda f: parse_lazy(
+      f, ('xgDagMesh', 'xgBgGeometry', 'xgMaterial', 'xgTexture')))
+  for name, objs in results.items():
+    if not same(objs, expected):
+      print(f'Error: {name} parsing does not read the same data')
+  # Release the arrays mapped from the file before it is deleted.
+  del objs, results, expected
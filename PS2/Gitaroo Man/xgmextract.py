@@ -1,48 +1,71 @@
-''' Extracts files from a Gitaroo Man XGM archive. '''
-
-import sys
-import struct
-import os
-
-if len(sys.argv) != 2:
-  print('Usage: python xgmextract.py <XGM File>')
-  sys.exit(0)
-  
-with open(sys.argv[1], 'rb') as f:
-  def readstr(len):
-    string = f.read(len)
-    return string.rstrip(b'\0')
-    
-  def readint():
-    return struct.unpack('<I', f.read(4))[0]
-    
-  def skip(len):
-    f.seek(len, 1)
-
-  texcount = readint()
-  modelcount = readint()
-  filecount = texcount + modelcount
-  print(f'\nNumber of files: {filecount}')
-    
-  dirname = f'{sys.argv[1]}.out'
-  if not os.path.exists(dirname):
-    os.makedirs(dirname)
-    
-  for i in range(filecount):
-    filepath = readstr(0x100)
-    if not filepath:
-      break
-    
-    filename = readstr(0x10).decode('ascii')
-    print(f'Extracting: {filename}')
-    skip(0x4)
-    filesize = readint()
-    
-    if '.IMX' in filename:
-      skip(0x18)
-    else:
-      animcount = readint()
-      skip(animcount * 0x20 + 4)
-
-    with open(os.path.join(dirname, filename), 'wb+') as fout:
-      fout.write(f.read(filesize))
+''' Extracts files from a Gitaroo Man XGM archive.
+
+Can also be imported to read archives from other scripts:
+
+  import xgmextract
+  xgmextract.extract('STAGE1.XGM', ['model.XG'])
+  async for name, data in xgmextract.iter_members('STAGE1.XGM'):
+    ...
+'''
+
+import argparse
+
+from archiveutil import archiveutil
+
+
+def open_archive(xgmpath, rebuild_index=False):
+  return archiveutil.XgmArchive(xgmpath, archiveutil.open_index(),
+                                rebuild_index)
+
+
+# Extracts members (by default, all of them) of the archive at xgmpath. Other
+# arguments are passed to Archive.extract_all. Returns the extracted members
+# and the number of skipped members.
+def extract(xgmpath, members=None, rebuild_index=False, **kwargs):
+  with open_archive(xgmpath, rebuild_index) as archive:
+    return archive.extract_all(members, **kwargs)
+
+
+# Yields (name, memoryview) of members (by default, all of them) of the
+# archive at xgmpath as they are read. See archiveutil.iter_members_async.
+async def iter_members(xgmpath, members=None, concurrency=4):
+  with open_archive(xgmpath) as archive:
+    async for item in archiveutil.iter_members_async(archive, members,
+                                                     concurrency):
+      yield item
+
+
+def main():
+  parser = argparse.ArgumentParser(description='''
+  Extracts files from a Gitaroo Man XGM archive.
+  ''')
+  parser.add_argument('xgmpath', help='Input path of .XGM file')
+  parser.add_argument('--rebuild-index', action='store_true',
+                      help='Parse the archive again instead of using the cached index')
+  parser.add_argument('-j', '--jobs', type=int,
+                      help='Number of files to extract concurrently')
+  parser.add_argument('--verify', action='store_true',
+                      help='Check the contents of previously extracted files '
+                      'even if they look unchanged')
+  archiveutil.add_selection_args(parser)
+  archiveutil.add_dedupe_args(parser)
+  args = parser.parse_args()
+
+  with open_archive(args.xgmpath, args.rebuild_index) as archive:
+    members = archiveutil.select_from_args(archive, args)
+    if members is not None:
+      print(f'\nNumber of files: {len(members)}')
+
+      dedupe = archiveutil.open_dedupe_store(args)
+      archive.extract_all(
+          members,
+          max_workers=args.jobs,
+          on_extract=lambda member, _: print(f'Extracting: {member.name}'),
+          verify=args.verify,
+          dedupe=dedupe)
+      if dedupe:
+        print(dedupe.report())
+
+
+if __name__ == '__main__':
+  main()
@@ -5,15 +5,25 @@ if "bpy" in locals():
   import importlib
   if "readutil" in locals():
     importlib.reload(readutil)
+  if "poolutil" in locals():
+    importlib.reload(poolutil)
+  if "vifutil" in locals():
+    importlib.reload(vifutil)
+  if "mdlx_decode" in locals():
+    importlib.reload(mdlx_decode)
 
 import bpy
 import collections
 import os
 import math
 import mathutils
+import numpy as np
 
 from .gsutil import gsutil
+from .poolutil import poolutil
 from .readutil import readutil
+from .vifutil import vifutil
+from . import mdlx_decode
 
 Options = collections.namedtuple('Options', ['USE_EMISSION'])
 
@@ -57,182 +67,6 @@ class MaterialManager:
     return f'{basename}_tex_{texture_index}'
 
 
-class VifHeader:
-  def __init__(self, header):
-    self.type = header[0]
-    self.uv_ind_flags_count = header[4]
-    self.uv_ind_flags_addr = header[5]
-    self.vtx_bone_assign_addr = header[6]
-    # self.bone_matrix_addr = header[7]
-    self.vcol_count = header[8] if self.type == 1 else 0
-    self.vcol_addr = header[9] if self.type == 1 else 0
-    self.vtx_mix_count = header[10] if self.type == 1 else 0
-    self.vtx_mix_addr = header[11] if self.type == 1 else 0
-    self.vtx_count = header[12] if self.type == 1 else header[8]
-    self.vtx_addr = header[13] if self.type == 1 else header[9]
-    self.bone_count = header[15] if self.type == 1 else header[11]
-
-
-class VifParser:
-  def __init__(self, bone_matrices):
-    self.bone_matrices = bone_matrices
-
-  def parse(self, f, offs, qwc):
-    uv = []
-    ind = []
-    flags = []
-    vtx = []
-    vtx_local = []
-    # (bone index, weight)
-    vtx_to_bone = []
-
-    header = None
-    mask = 0
-    ind_start = 0
-
-    end_offs = offs + (qwc << 4)
-    # TODO: Remove use of offs. I don't believe this does any significant jumps
-    # anywhere.
-    while offs < end_offs:
-      f.seek(offs)
-      imm = f.read_uint16()
-      qwd = f.read_uint8()
-      cmd = f.read_uint8() & 0x7F
-      offs += 0x4
-
-      if cmd >> 5 == 0b11:  # UNPACK
-        if cmd == 0x60:
-          break  # Done
-        m = (cmd & 0x10) > 0
-        addr = imm & 0x1FF
-        vnvl = cmd & 0xF
-
-        if vnvl == 0b1100:  # UNPACK V4-32
-          if addr == 0 and not m:
-            header = VifHeader(f.read_nuint32(qwd << 4))
-            ind_start = len(vtx)
-            vtx_local = []
-          elif addr == header.vtx_addr:
-            vtx_local = [f.read_nfloat32(4) for _ in range(header.vtx_count)]
-
-          elif addr == header.vtx_bone_assign_addr:
-            # Assign local vertices to bones
-            vtx_to_bone_local = []
-            for i in range(header.bone_count):
-              vtx_to_bone_local.extend([i for _ in range(f.read_uint32())])
-            if header.vtx_mix_addr > 0:
-              # Build final vertex list by mixing vertices
-              mix_header_offs = offs + (
-                  (header.vtx_mix_addr - header.vtx_bone_assign_addr) << 4)
-              mix_offs = mix_header_offs + math.ceil(
-                  header.vtx_mix_count / 0x4) * 0x10
-              f.seek(mix_header_offs)
-              mix_count_table = f.read_nuint32(header.vtx_mix_count)
-              for i in range(header.vtx_mix_count):
-                f.seek(mix_offs)
-                for vtx_list in [
-                    f.read_nuint32(i + 1) for _ in range(mix_count_table[i])
-                ]:
-                  bone_list = []
-                  for v in vtx_list:
-                    bone_list.append((vtx_to_bone_local[v], vtx_local[v][3]))
-                  vtx_to_bone.append(bone_list)
-                  v_mixed = mathutils.Vector((0, 0, 0, 0))
-                  for v in vtx_list:
-                    v_mixed += (self.bone_matrices[vtx_to_bone_local[v]]
-                                @ mathutils.Vector(vtx_local[v]))
-                  vtx.append(v_mixed.to_3d().to_tuple())
-                mix_offs += math.ceil(
-                    (mix_count_table[i] * (i + 1) * 0x4) / 0x10) * 0x10
-            else:
-              for i in range(len(vtx_local)):
-                vtx.append(
-                    (self.bone_matrices[vtx_to_bone_local[i]]
-                     @ mathutils.Vector(vtx_local[i])).to_3d().to_tuple())
-                vtx_to_bone.append([(vtx_to_bone_local[i], 1.0)])
-
-          offs += qwd * 0x10
-
-        elif vnvl == 0b1000:  # UNPACK V3-32
-          if addr == header.vtx_addr and m:
-            vtx_local = [
-                f.read_nfloat32(3) + (1.0,) for i in range(header.vtx_count)
-            ]
-          offs += qwd * 0xC
-
-        elif vnvl == 0b0010:  # UNPACK S-8
-          if addr == header.uv_ind_flags_addr and m:
-            if mask == 0xCFCFCFCF:
-              ind += [
-                  i + ind_start
-                  for i in f.read_nuint8(header.uv_ind_flags_count)
-              ]
-            elif mask == 0x3F3F3F3F:
-              flags += f.read_nuint8(header.uv_ind_flags_count)
-          offs += int(math.ceil(qwd / 4)) * 0x4
-
-        elif vnvl == 0b0101:  # UNPACK V2-16
-          if addr == header.uv_ind_flags_addr and not m:
-            uv += [(f.read_int16() / 4096.0, 1.0 - f.read_int16() / 4096.0)
-                   for _ in range(header.uv_ind_flags_count)]
-          offs += qwd * 0x4
-
-        elif vnvl == 0b1110:  # UNPACK V4-8
-          # TODO: Support vertex colors?
-          # if addr == header.vertex_color_addr:
-          #   for i in range(header.vertex_color_count):
-          #     vcol.append((
-          #       f.read_uint8() / 0x80,
-          #       f.read_uint8() / 0x80,
-          #       f.read_uint8() / 0x80,
-          #       f.read_uint8() / 0x80
-          #     ))
-          offs += qwd * 0x4
-
-        elif vnvl != 0b0000:
-          raise Exception('Unexpected vnvl {} at offset {}'.format(
-              hex(vnvl), hex(offs)))
-
-      elif cmd == 0b00100000:  # STMASK
-        mask = f.read_uint32()
-        offs += 0x4
-
-      elif cmd == 0b00110001:  # STCOL
-        offs += 0x10
-
-      elif cmd not in (
-          0b00000000,  # NOP
-          0b00000001,  # STCYCL (always cl = 1, wl = 1)
-          0b00010000,  # FLUSHE
-          0b00010001,  # FLUSH
-          0b00010011,  # FLUSHA
-          0b00010111):  # MSCNT
-        raise Exception('Unexpected cmd {} at offset {}'.format(
-            hex(cmd), hex(offs)))
-
-    # Build triangle list
-    tri = []
-    vtx_expand = []
-    vtx_to_bone_expand = []
-    for i, f in zip(range(len(ind)), flags):
-      vtx_expand.append(vtx[ind[i]])
-      vtx_to_bone_expand.append(vtx_to_bone[ind[i]])
-      if i < 2:
-        continue
-      if f == 0x20 or not f:
-        tri.append((i - 2, i - 1, i))
-      if f == 0x30 or not f:
-        tri.append((i, i - 1, i - 2))
-
-    # Build vertex groups
-    vtx_groups = [[] for _ in range(len(self.bone_matrices))]
-    for i, bone_list in enumerate(vtx_to_bone_expand):
-      for bone, weight in bone_list:
-        vtx_groups[bone].append((i, weight))
-
-    return vtx_expand, tri, uv, vtx_groups
-
-
 class MdlxParser:
   def __init__(self, options):
     self.options = options
@@ -255,7 +89,7 @@ class MdlxParser:
         tex_offs = file_offs
 
     if model_offs > 0:
-      self.parse_model(f, model_offs)
+      self.parse_model(f, filepath, model_offs)
     if tex_offs > 0:
       self.parse_textures(f, tex_offs)
 
@@ -273,7 +107,7 @@ class MdlxParser:
       files.append((file_type, file_name, file_offs, file_size))
     return files
 
-  def parse_model(self, f, model_offs):
+  def parse_model(self, f, filepath, model_offs):
     model_offs += 0x90
     f.seek(model_offs + 0x10)
 
@@ -282,6 +116,7 @@ class MdlxParser:
     bone_table_offs = model_offs + f.read_uint32()
     self.parse_bones(f, bone_table_offs, bone_count)
 
+    jobs = []
     model_index = 0
     while model_offs > 0:
       f.seek(model_offs)
@@ -293,8 +128,8 @@ class MdlxParser:
         group_count = f.read_uint32()
         for group_index in range(group_count):
           group_entry_offs = model_offs + group_index * 0x20 + 0x20
-          self.parse_submodel(f, group_entry_offs, model_offs, model_index,
-                              group_index)
+          jobs += self.parse_submodel(f, group_entry_offs, model_offs,
+                                      model_index, group_index)
       else:
         print(
             f'Skipping unsupported model type {model_type} at offset {hex(model_offs)}'
@@ -303,6 +138,22 @@ class MdlxParser:
       model_offs = (next_model_offs + model_offs) if next_model_offs > 0 else 0
       model_index += 1
 
+    # Shapes do not depend on each other, so they are decoded by mdlx_decode
+    # (in worker processes where possible) and only turned into Blender
+    # objects here.
+    # Blender 2.8x runs its bundled Python from binary_path_python, which
+    # later versions dropped as sys.executable is then the interpreter.
+    shapes = poolutil.run_jobs(
+        mdlx_decode.decode_shape, jobs, filepath, __package__,
+        os.path.dirname(__file__),
+        executable=getattr(bpy.app, 'binary_path_python', None))
+    for job, shape in zip(jobs, shapes):
+      self.build_shape(job, shape)
+    # Workers each count the packets that they decoded from their own cache.
+    cache_stats = vifutil.sum_stats(shape.cache_stats for shape in shapes)
+    print(f'{self.basename}: {cache_stats.hits} VIF packets replayed from '
+          f'cache, {cache_stats.misses} compiled')
+
     # Attach geometry to armature
     if self.armature and self.objects:
       for obj in self.objects:
@@ -387,6 +238,7 @@ class MdlxParser:
     dma_qwd = f.read_uint32()
     dma_end_offs = dma_offs + (dma_qwd << 4)
 
+    jobs = []
     offs = dma_offs
     while offs < dma_end_offs:
       f.seek(offs)
@@ -406,36 +258,48 @@ class MdlxParser:
         bone_palette_matrices.append(self.bone_matrices[bone_index])
 
       offs += 0x10
-      vif_parser = VifParser(bone_palette_matrices)
-      vtx, tri, uv, vtx_groups = vif_parser.parse(f, vif_offs, vif_qwc)
-
-      objname = '{}_{}_{}_{}'.format(self.basename, model_index, group_index,
-                                     hex(shape_offs)[2:])
-      mesh_data = bpy.data.meshes.new(objname + '_mesh_data')
-      mesh_data.from_pydata(vtx, [], tri)
-      mesh_data.update()
-
-      if uv:
-        mesh_data.uv_layers.new(do_init=False)
-        mesh_data.uv_layers[-1].data.foreach_set('uv', [
-            vt for pair in [uv[loop.vertex_index] for loop in mesh_data.loops]
-            for vt in pair
-        ])
-
-      obj = bpy.data.objects.new(objname, mesh_data)
-      obj.data.materials.append(
-          self.mat_manager.get_material(texture_index, use_alpha,
-                                        self.basename))
-
-      for i, v_list in enumerate(vtx_groups):
-        group = obj.vertex_groups.new(name='Bone_%d' % bone_palette[i])
-        for v, weight in v_list:
-          group.add([v], weight, 'ADD')
-
-      bpy.context.scene.collection.objects.link(obj)
-      obj.select_set(state=True)
-
-      self.objects.append(obj)
+      jobs.append(
+          mdlx_decode.ShapeJob(
+              shape_offs=shape_offs,
+              model_index=model_index,
+              group_index=group_index,
+              texture_index=texture_index,
+              use_alpha=use_alpha,
+              vif_offs=vif_offs,
+              vif_size=vif_qwc << 4,
+              bone_palette=bone_palette,
+              bone_matrices=np.array(bone_palette_matrices,
+                                     dtype=np.float64).reshape(-1, 4, 4)))
+    return jobs
+
+  def build_shape(self, job, shape):
+    objname = '{}_{}_{}_{}'.format(self.basename, job.model_index,
+                                   job.group_index, hex(job.shape_offs)[2:])
+    mesh_data = bpy.data.meshes.new(objname + '_mesh_data')
+    mesh_data.from_pydata(shape.vtx.tolist(), [], shape.tri.tolist())
+    mesh_data.update()
+
+    if len(shape.uv):
+      loop_vertex_indices = np.empty(len(mesh_data.loops), dtype=np.int32)
+      mesh_data.loops.foreach_get('vertex_index', loop_vertex_indices)
+      mesh_data.uv_layers.new(do_init=False)
+      mesh_data.uv_layers[-1].data.foreach_set(
+          'uv', shape.uv[loop_vertex_indices].ravel())
+
+    obj = bpy.data.objects.new(objname, mesh_data)
+    obj.data.materials.append(
+        self.mat_manager.get_material(job.texture_index, job.use_alpha,
+                                      self.basename))
+
+    for i, (v_list, weights) in enumerate(shape.vtx_groups):
+      group = obj.vertex_groups.new(name='Bone_%d' % job.bone_palette[i])
+      for v, weight in zip(v_list.tolist(), weights.tolist()):
+        group.add([v], weight, 'ADD')
+
+    bpy.context.scene.collection.objects.link(obj)
+    obj.select_set(state=True)
+
+    self.objects.append(obj)
 
   def parse_textures(self, f, tex_offs):
     f.seek(tex_offs + 0x4)  # Skip type, flag
@@ -0,0 +1,288 @@
+# Decodes MDLX shapes into arrays. This module must not depend on Blender so
+# that shapes can be decoded in worker processes (see poolutil).
+
+import collections
+import math
+import numpy as np
+import struct
+
+from .striputil import striputil
+from .vifutil import vifutil
+
+ShapeJob = collections.namedtuple('ShapeJob', [
+    'shape_offs',
+    'model_index',
+    'group_index',
+    'texture_index',
+    'use_alpha',
+    'vif_offs',
+    'vif_size',
+    'bone_palette',
+    'bone_matrices',  # (palette size, 4, 4) global matrices of bone_palette
+])
+
+DecodedShape = collections.namedtuple('DecodedShape', [
+    'vtx',  # (N, 3) float32, one vertex per strip element
+    'tri',  # (M, 3) int32
+    'uv',  # (N, 2) float32
+    'vtx_groups',  # [(vertex indices, weights)] per bone palette entry
+    'cache_stats',  # vifutil.CacheStats of decoding this shape
+])
+
+# Commands without any effect on decoding.
+_IGNORED_CMDS = (
+    0b00000000,  # NOP
+    0b00000001,  # STCYCL (always cl = 1, wl = 1)
+    0b00010000,  # FLUSHE
+    0b00010001,  # FLUSH
+    0b00010011,  # FLUSHA
+    0b00010111,  # MSCNT
+    0b00110001)  # STCOL
+
+_programs = vifutil.ProgramCache()
+
+
+# Compiles a VIF packet into the actions that decoding it performs, as a list
+# of (fn, args) called as fn(shape, *args) on a ShapeBuilder. Headers and masks
+# only decide which actions are emitted, and the data that each action unpacks
+# is copied out of the packet, so replaying a program neither dispatches on
+# commands nor reads the packet again.
+# base_offs is only used to report file offsets in errors.
+def compile_packet(buf, base_offs=0):
+  buf = memoryview(buf)
+  program = []
+  header = None
+  mask = 0
+  for cmd, imm, qwd, offs, _ in vifutil.tokenize(buf, stop_cmd=0x60):
+    if cmd in _IGNORED_CMDS:
+      continue
+    if vifutil.is_unpack(cmd):
+      if cmd == 0x60:
+        break  # Done
+      m = (cmd & 0x10) > 0
+      addr = imm & 0x1FF
+      vnvl = cmd & 0xF
+
+      if vnvl == 0b1100:  # UNPACK V4-32
+        if addr == 0 and not m:
+          header = VifHeader(struct.unpack_from(f'<{qwd * 4}I', buf, offs))
+          program.append((ShapeBuilder.begin_batch, ()))
+        elif addr == header.vtx_addr:
+          vtx_local = np.frombuffer(buf, '<f4', header.vtx_count * 4,
+                                    offs).reshape(-1, 4).astype(np.float64)
+          program.append((ShapeBuilder.set_local_vertices, (vtx_local,)))
+
+        elif addr == header.vtx_bone_assign_addr:
+          # Assign local vertices to bones
+          vtx_to_bone_local = np.repeat(
+              np.arange(header.bone_count),
+              np.frombuffer(buf, '<u4', header.bone_count, offs))
+          mix_lists = None
+          if header.vtx_mix_addr > 0:
+            # Lists of the local vertices mixed into each final vertex, by
+            # number of influences.
+            mix_lists = []
+            mix_header_offs = offs + (
+                (header.vtx_mix_addr - header.vtx_bone_assign_addr) << 4)
+            mix_offs = mix_header_offs + math.ceil(
+                header.vtx_mix_count / 0x4) * 0x10
+            mix_count_table = struct.unpack_from(
+                f'<{header.vtx_mix_count}I', buf, mix_header_offs)
+            for i in range(header.vtx_mix_count):
+              mix_count = mix_count_table[i]
+              mix_size = mix_count * (i + 1) * 0x4
+              mix_lists.append(
+                  np.frombuffer(buf, '<u4', mix_count * (i + 1),
+                                mix_offs).reshape(-1, i + 1).astype(np.int64))
+              mix_offs += math.ceil(mix_size / 0x10) * 0x10
+          program.append(
+              (ShapeBuilder.assign_bones, (vtx_to_bone_local, mix_lists)))
+
+      elif vnvl == 0b1000:  # UNPACK V3-32
+        if addr == header.vtx_addr and m:
+          vtx_local = np.ones((header.vtx_count, 4))
+          vtx_local[:, :3] = np.frombuffer(buf, '<f4', header.vtx_count * 3,
+                                           offs).reshape(-1, 3)
+          program.append((ShapeBuilder.set_local_vertices, (vtx_local,)))
+
+      elif vnvl == 0b0010:  # UNPACK S-8
+        if addr == header.uv_ind_flags_addr and m:
+          values = np.frombuffer(buf, np.uint8, header.uv_ind_flags_count,
+                                 offs)
+          if mask == 0xCFCFCFCF:
+            program.append(
+                (ShapeBuilder.add_indices, (values.astype(np.int64),)))
+          elif mask == 0x3F3F3F3F:
+            program.append((ShapeBuilder.add_flags, (values.copy(),)))
+
+      elif vnvl == 0b0101:  # UNPACK V2-16
+        if addr == header.uv_ind_flags_addr and not m:
+          uv_int16 = np.frombuffer(buf, '<i2', header.uv_ind_flags_count * 2,
+                                   offs).reshape(-1, 2)
+          uv = np.stack(
+              (uv_int16[:, 0] / 4096.0, 1.0 - uv_int16[:, 1] / 4096.0),
+              axis=1)
+          program.append((ShapeBuilder.add_uv, (uv,)))
+
+      elif vnvl == 0b1110:  # UNPACK V4-8
+        # TODO: Support vertex colors?
+        # if addr == header.vertex_color_addr:
+        #   vcol = np.frombuffer(buf, np.uint8, header.vcol_count * 4,
+        #                        offs).reshape(-1, 4) / 0x80
+        pass
+
+      elif vnvl != 0b0000:
+        raise Exception('Unexpected vnvl {} at offset {}'.format(
+            hex(vnvl), hex(base_offs + offs)))
+
+    elif cmd == 0b00100000:  # STMASK
+      mask = struct.unpack_from('<I', buf, offs)[0]
+
+    else:
+      raise Exception('Unexpected cmd {} at offset {}'.format(
+          hex(cmd), hex(base_offs + offs)))
+  return program
+
+
+def decode_shape(buf, job):
+  vif_parser = VifParser(job.bone_matrices)
+  return vif_parser.parse(buf[job.vif_offs:job.vif_offs + job.vif_size],
+                          job.vif_offs)
+
+
+class VifHeader:
+  def __init__(self, header):
+    self.type = header[0]
+    self.uv_ind_flags_count = header[4]
+    self.uv_ind_flags_addr = header[5]
+    self.vtx_bone_assign_addr = header[6]
+    # self.bone_matrix_addr = header[7]
+    self.vcol_count = header[8] if self.type == 1 else 0
+    self.vcol_addr = header[9] if self.type == 1 else 0
+    self.vtx_mix_count = header[10] if self.type == 1 else 0
+    self.vtx_mix_addr = header[11] if self.type == 1 else 0
+    self.vtx_count = header[12] if self.type == 1 else header[8]
+    self.vtx_addr = header[13] if self.type == 1 else header[9]
+    self.bone_count = header[15] if self.type == 1 else header[11]
+
+
+class VifParser:
+  def __init__(self, bone_matrices):
+    self.bone_matrices = np.asarray(bone_matrices,
+                                    dtype=np.float64).reshape(-1, 4, 4)
+
+  # Parses a VIF packet held in memory (bytes, bytearray, memoryview or an
+  # mmap slice). base_offs is only used to report file offsets in errors.
+  def parse(self, buf, base_offs=0):
+    buf = memoryview(buf)
+    start_stats = _programs.stats()
+    program = _programs.get(vifutil.packet_key(buf),
+                            lambda: compile_packet(buf, base_offs))
+    shape = ShapeBuilder(self.bone_matrices)
+    for action, args in program:
+      action(shape, *args)
+    return shape.build(_programs.stats_since(start_stats))
+
+
+# Accumulates the vertices, strips and bone influences of the batches of a
+# packet, as replayed from its compiled program.
+class ShapeBuilder:
+  def __init__(self, bone_matrices):
+    self.bone_matrices = bone_matrices
+    self.uv = []
+    self.ind = []
+    self.flags = []
+    self.vtx = []
+    self.vtx_count = 0
+    self.vtx_local = np.empty((0, 4))
+    # Bone influences as parallel arrays of (vertex, bone index, weight).
+    self.infl_vtx = []
+    self.infl_bone = []
+    self.infl_weight = []
+    self.ind_start = 0
+
+  def begin_batch(self):
+    self.ind_start = self.vtx_count
+    self.vtx_local = np.empty((0, 4))
+
+  def set_local_vertices(self, vtx_local):
+    self.vtx_local = vtx_local
+
+  def assign_bones(self, vtx_to_bone_local, mix_lists):
+    local_count = min(len(self.vtx_local), len(vtx_to_bone_local))
+    # Each local vertex transformed by the matrix of its bone.
+    vtx_bone_space = np.einsum(
+        'nij,nj->ni', self.bone_matrices[vtx_to_bone_local[:local_count]],
+        self.vtx_local[:local_count])[:, :3]
+    if mix_lists is not None:
+      # Build final vertex list by mixing vertices
+      for vtx_lists in mix_lists:
+        mix_count, influence_count = vtx_lists.shape
+        self.vtx.append(vtx_bone_space[vtx_lists].sum(axis=1))
+        self.infl_vtx.append(
+            np.repeat(np.arange(self.vtx_count, self.vtx_count + mix_count),
+                      influence_count))
+        self.infl_bone.append(vtx_to_bone_local[vtx_lists].ravel())
+        self.infl_weight.append(self.vtx_local[vtx_lists, 3].ravel())
+        self.vtx_count += mix_count
+    else:
+      self.vtx.append(vtx_bone_space)
+      self.infl_vtx.append(
+          np.arange(self.vtx_count, self.vtx_count + local_count))
+      self.infl_bone.append(vtx_to_bone_local[:local_count])
+      self.infl_weight.append(np.ones(local_count))
+      self.vtx_count += local_count
+
+  def add_indices(self, values):
+    self.ind.append(values + self.ind_start)
+
+  def add_flags(self, values):
+    self.flags.append(values)
+
+  def add_uv(self, uv):
+    self.uv.append(uv)
+
+  def build(self, cache_stats):
+    vtx_count = self.vtx_count
+    vtx = _concat(self.vtx, np.float64, 3)
+    ind = _concat(self.ind, np.int64)
+    flags = _concat(self.flags, np.int32)
+    infl_vtx = _concat(self.infl_vtx, np.int64)
+    infl_bone = _concat(self.infl_bone, np.int64)
+    infl_weight = _concat(self.infl_weight, np.float64)
+
+    # Build triangle list. Flag 0x20 and 0x30 select the winding of the
+    # triangle ending at each strip element, 0 emits both windings.
+    strip_len = min(len(ind), len(flags))
+    ind = ind[:strip_len]
+    flags = flags[:strip_len]
+    tri = striputil.triangulate_winding(np.arange(strip_len),
+                                        (flags == 0x20) | (flags == 0),
+                                        (flags == 0x30) | (flags == 0))
+
+    # Build vertex groups. Every strip element gets a copy of the influences
+    # of the vertex it refers to. Influences are stored in vertex order, so
+    # those of vertex v start at infl_starts[v].
+    infl_counts = np.bincount(infl_vtx, minlength=vtx_count)
+    infl_starts = np.cumsum(infl_counts) - infl_counts
+    elem_counts = infl_counts[ind]
+    elem = np.repeat(np.arange(strip_len), elem_counts)
+    elem_infl = np.arange(len(elem)) + np.repeat(
+        infl_starts[ind] - (np.cumsum(elem_counts) - elem_counts), elem_counts)
+    elem_bone = infl_bone[elem_infl]
+    elem_weight = infl_weight[elem_infl]
+    vtx_groups = []
+    for bone in range(len(self.bone_matrices)):
+      in_group = elem_bone == bone
+      vtx_groups.append((elem[in_group].astype(np.int32),
+                         elem_weight[in_group].astype(np.float32)))
+
+    return DecodedShape(
+        np.ascontiguousarray(vtx[ind], dtype=np.float32), tri,
+        _concat(self.uv, np.float32, 2), vtx_groups, cache_stats)
+
+
+def _concat(parts, dtype, width=None):
+  if not parts:
+    return np.empty((0, width) if width else 0, dtype=dtype)
+  return np.concatenate(parts).astype(dtype)
@@ -0,0 +1,70 @@
+# Measures the decompression speed of the TLD resource codec (lzutil) on
+# synthetic data, after checking that every decoder round-trips it.
+
+import argparse
+import os
+import random
+import time
+
+from lzutil import lzutil
+
+parser = argparse.ArgumentParser(description='''
+Benchmarks decompression of Musashi: Samurai Legend (PS2) TLD resources.
+''')
+parser.add_argument('--size', type=int, default=0x400000,
+                    help='Size in bytes of the uncompressed test data')
+parser.add_argument('--repeat', type=int, default=5,
+                    help='Number of runs, the fastest one is reported')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('-j', '--jobs', type=int,
+                    help='Number of threads used for parallel decompression')
+args = parser.parse_args()
+
+
+# Mix of random bytes, runs and repeated short strings, roughly resembling
+# game data.
+def make_data(size, rng):
+  words = [os.urandom(rng.randint(2, 8)) for _ in range(64)]
+  data = bytearray()
+  while len(data) < size:
+    r = rng.random()
+    if r < 0.3:
+      data += os.urandom(rng.randint(1, 16))
+    elif r < 0.4:
+      data += bytes([rng.randrange(0x100)]) * rng.randint(2, 64)
+    else:
+      data += rng.choice(words)
+  return bytes(data[:size])
+
+
+def bench(name, fn, src, size):
+  dst = bytearray(size)
+  best = None
+  for _ in range(args.repeat):
+    start = time.perf_counter()
+    fn(src, dst)
+    elapsed = time.perf_counter() - start
+    best = elapsed if best is None else min(best, elapsed)
+  print(f'{name}: {size / best / 1e6:.2f} MB/s')
+  return dst
+
+
+data = make_data(args.size, random.Random(args.seed))
+print(f'Compressing {len(data)} bytes...')
+src = lzutil.compress(data)
+print(f'Compressed to {len(src)} bytes ({len(src) / max(1, len(data)):.1%})')
+
+impls = [('python', lzutil.decompress_into_python)]
+if lzutil.has_native():
+  impls.append(('native', lzutil.decompress_into))
+  impls.append(('native, parallel', lambda src, dst: lzutil.decompress_into(
+      src, dst, parallel=True, max_workers=args.jobs)))
+else:
+  print('Native codec not built, see README.md')
+errors = 0
+for name, fn in impls:
+  if bench(name, fn, src, len(data)) != data:
+    print(f'Error: {name} output does not match the input')
+    errors += 1
+if errors:
+  raise SystemExit(1)
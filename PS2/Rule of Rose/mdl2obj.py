@@ -7,6 +7,8 @@ import numpy as np
 import os
 import sys
 import struct
+from archiveutil import archiveutil
+from striputil import striputil
 
 parser = argparse.ArgumentParser(description='''
 Converts a Rule of Rose (PS2) I3D model file (.MDL) to OBJ.
@@ -38,36 +40,6 @@ if len(args.mdlpath[0]) == 0:
     parser.print_usage()
     sys.exit(1)
 
-# Extracts a file from an RPK archive with the given index.
-def ReadRpkFile(f, index):
-    f.seek(0)
-    header = f.read(0x20)
-    if header[:4] != b'RTPK':
-        err("Not an RTPK archive!")
-
-    numfiles = getuint16(header, 0xE)
-    if index < 0 or index >= numfiles:
-        err("File index {} out of range in RTPK archive".format(index))
-    totalsize = getuint32(header, 0x4)
-    filesize = 0
-    fileoffs = 0
-
-    if header[0xA] == 0x2:  # Offset table only
-        f.seek(index * 0x4 + 0x20)
-        fileoffs = getuint32(f.read(4))
-        if index == numfiles - 1:
-            filesize = totalsize - fileoffs
-        else:
-            filesize = getuint32(f.read(4)) - fileoffs
-    elif header[0xA] == 0x3:  # Size and offset tables
-        f.seek(index * 0x4 + 0x20)
-        filesize = getuint32(f.read(4))
-        f.seek((numfiles + index) * 4 + 0x20)
-        fileoffs = getuint32(f.read(4))
-
-    f.seek(fileoffs)
-    return f.read(filesize)
-
 
 class Node:
     def __init__(self, buf, offs):
@@ -92,7 +64,7 @@ def parseName(buf, offs):
     endOffs = offs
     while buf[endOffs] != 0:
         endOffs += 1
-    return buf[offs:endOffs].decode(encoding='ascii')
+    return bytes(buf[offs:endOffs]).decode(encoding='ascii')
 
 
 class SubmeshPiece:
@@ -238,9 +210,15 @@ if __name__ == '__main__':
     basepath = os.path.splitext(mdlpath)[0]
     basename = os.path.splitext(os.path.basename(mdlpath))[0]
 
-    f = open(mdlpath, 'rb')
-    buf = ReadRpkFile(f, 1)[0x10:]
-    f.close()
+    # The model is the second file of the RPK archive. buf is a view into the
+    # archive, which stays open until the end of the script.
+    try:
+        archive = archiveutil.RpkArchive(mdlpath)
+    except archiveutil.ArchiveError as e:
+        err(e)
+    if len(archive) < 2:
+        err("File index 1 out of range in RTPK archive")
+    buf = archive.open(1)[0x10:]
     if len(buf) < 0x10:
         err('MDL model file is too small! {} bytes'.format(len(buf)))
 
@@ -355,14 +333,13 @@ if __name__ == '__main__':
                             for i in range(indCount):
                                 ind.append(struct.unpack('BBBB', buf[indOffs + i * 4: indOffs + i * 4 + 4]))
                         
-                        for i in range(len(ind)):
-                            _, ctrl, _, reverse = ind[i]
-                            if ctrl == 0x80:
-                                continue
-                            if reverse:
-                                submeshPiece.ind.append([ (ind[i-2][0], i-2), (ind[i-1][0], i-1), (ind[i][0], i) ])
-                            else:
-                                submeshPiece.ind.append([ (ind[i][0], i), (ind[i-1][0], i-1), (ind[i-2][0], i-2) ])
+                        # Each strip element is (vertex index, ctrl, _, reverse). Triangles are built over
+                        # strip positions, which double as texture coordinate indices.
+                        ind = np.array(ind, dtype=np.int32).reshape(-1, 4)
+                        emit = ind[:, 1] != 0x80
+                        tri = striputil.triangulate_winding(np.arange(len(ind)), emit & (ind[:, 3] != 0), emit & (ind[:, 3] == 0))
+                        tri = tri[~striputil.is_degenerate(ind[tri, 0])]
+                        submeshPiece.ind = np.stack((ind[tri, 0], tri), axis=2).tolist()
 
     # Export OBJ and MTL.
     objpath = os.path.join(os.path.dirname(mdlpath), basename + '_out.obj')
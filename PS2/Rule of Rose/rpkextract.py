@@ -1,97 +1,95 @@
 # Extracts files from a Rule of Rose (PS2) RPK archive.
+#
+# Can also be imported to read archives from other scripts:
+#
+#   import rpkextract
+#   rpkextract.extract('ROSE.RPK', suffix='.bin')
+#   async for name, data in rpkextract.iter_members('ROSE.RPK'):
+#     ...
 
 import argparse
 import os
 import sys
-import struct
 
-parser = argparse.ArgumentParser(description='''
-Script to extract files from a Rule of Rose (PS2) RPK archive.
-''')
+from archiveutil import archiveutil
+
 
 def err(msg):
   print("Error: {}".format(msg))
   sys.exit(1)
 
-def getuint16(b, offs = 0):
-  return struct.unpack('<H', b[offs:offs+2])[0]
 
-def getuint32(b, offs = 0):
-  return struct.unpack('<I', b[offs:offs+4])[0]
+def open_archive(rpkpath, rebuild_index=False):
+  return archiveutil.RpkArchive(rpkpath, archiveutil.open_index(),
+                                rebuild_index)
 
-parser.add_argument('rpkpath', help='Input path of .RPK or .BIN file', nargs=1)
-parser.add_argument('-s', '--suffix', help='Suffix to add to each file', default='')
-args = parser.parse_args()
 
-if len(args.rpkpath[0]) == 0:
-  parser.print_usage()
-  sys.exit(1)
-  
-if not os.path.exists(args.rpkpath[0]):
-  err("RPK path not found: {}".format(args.pacpath[0]))
-
-rpkpath = sys.argv[1] if sys.argv[1][0] != '-' else args.pacpath[0]  # Drag-and-drop hack
-basename = os.path.splitext(os.path.basename(rpkpath))[0]
-
-outdir = os.path.join(os.path.dirname(rpkpath), basename)
-if os.path.isfile(outdir):
-    outdir += '_out'
-if not os.path.exists(outdir):
-    os.makedirs(outdir)
-
-f = open(rpkpath, 'rb')
-header = f.read(0x20)
-if header[:4] != b'RTPK':
-    err("Not an RTPK archive!")
-totalsize = getuint32(header, 0x4)
-numfiles = getuint16(header, 0xE)
-nametable_size = getuint32(header, 0x10)
-if numfiles == 0:
+# Extracts members (by default, all of them) of the archive at rpkpath. Other
+# arguments are passed to Archive.extract_all. Returns the extracted members
+# and the number of skipped members.
+def extract(rpkpath, members=None, rebuild_index=False, **kwargs):
+  with open_archive(rpkpath, rebuild_index) as archive:
+    return archive.extract_all(members, **kwargs)
+
+
+# Yields (name, memoryview) of members (by default, all of them) of the
+# archive at rpkpath as they are read. See archiveutil.iter_members_async.
+async def iter_members(rpkpath, members=None, concurrency=4):
+  with open_archive(rpkpath) as archive:
+    async for item in archiveutil.iter_members_async(archive, members,
+                                                     concurrency):
+      yield item
+
+
+def main():
+  parser = argparse.ArgumentParser(description='''
+  Script to extract files from a Rule of Rose (PS2) RPK archive.
+  ''')
+  parser.add_argument('rpkpath', help='Input path of .RPK or .BIN file', nargs=1)
+  parser.add_argument('-s', '--suffix', help='Suffix to add to each file', default='')
+  parser.add_argument('--rebuild-index', action='store_true',
+                      help='Parse the archive again instead of using the cached index')
+  parser.add_argument('-j', '--jobs', type=int,
+                      help='Number of files to extract concurrently')
+  parser.add_argument('--verify', action='store_true',
+                      help='Check the contents of previously extracted files '
+                      'even if they look unchanged')
+  archiveutil.add_selection_args(parser)
+  archiveutil.add_dedupe_args(parser)
+  args = parser.parse_args()
+
+  if len(args.rpkpath[0]) == 0:
+    parser.print_usage()
+    sys.exit(1)
+
+  if not os.path.exists(args.rpkpath[0]):
+    err("RPK path not found: {}".format(args.rpkpath[0]))
+
+  rpkpath = sys.argv[1] if sys.argv[1][0] != '-' else args.rpkpath[0]  # Drag-and-drop hack
+
+  try:
+    archive = open_archive(rpkpath, args.rebuild_index)
+  except archiveutil.ArchiveError as e:
+    err(e)
+  if len(archive) == 0:
     err('No files in the RPK!')
 
-file_sizes = []
-file_offsets = []
-
-if header[0xA] & 0x3 == 0x2:
-    for _ in range(numfiles):
-        file_offsets.append(getuint32(f.read(4)))
-    for i in range(1, numfiles):
-        file_sizes.append(file_offsets[i] - file_offsets[i - 1])
-    file_sizes.append(totalsize- file_offsets[numfiles - 1])
-elif header[0xA] & 0x3 == 0x3:
-    for _ in range(numfiles):
-        file_sizes.append(getuint32(f.read(4)))
-    for _ in range(numfiles):
-        file_offsets.append(getuint32(f.read(4)))
-else:
-    err('Unknown RPK format {}'.format(hex(header[0xA])))
-
-if (header[0xA] & 0x10) > 0:
-    # Unknown index table (0, 1, 2, 3...)?
-    f.read(numfiles * 0x2)
-file_names = []
-if nametable_size > 0:
-    nametable = f.read(nametable_size)
-    start = 0
-    for i in range(len(nametable)):
-        if nametable[i] == 0:
-            file_names.append(nametable[start:i].decode(encoding='ascii'))
-            start = i + 1
-else:
-    file_names = ['unnamed_{}.bin'.format(i) for i in range(numfiles)]
-
-for i in range(numfiles):
-    print('Extracting: {} ({} bytes)'.format(file_names[i], file_sizes[i]))
-    f.seek(file_offsets[i])
-    filename = file_names[i] + args.suffix
-    if filename[:3] == '../':
-        filename = filename[3:]
-    elif filename[:2] == './':
-        filename = filename[2:]
-    outpath = os.path.join(outdir, filename)
-    if not os.path.exists(os.path.dirname(outpath)):
-        os.makedirs(os.path.dirname(outpath))
-    with open(os.path.join(outdir, filename), 'wb+') as fout:
-        fout.write(f.read(file_sizes[i]))
-
-print('Done.')
+  with archive:
+    members = archiveutil.select_from_args(archive, args)
+    if members is not None:
+      dedupe = archiveutil.open_dedupe_store(args)
+      archive.extract_all(
+          members,
+          max_workers=args.jobs,
+          on_extract=lambda member, _: print('Extracting: {} ({} bytes)'.format(
+              member.name, member.size)),
+          verify=args.verify,
+          dedupe=dedupe,
+          suffix=args.suffix)
+      if dedupe:
+        print(dedupe.report())
+      print('Done.')
+
+
+if __name__ == '__main__':
+  main()
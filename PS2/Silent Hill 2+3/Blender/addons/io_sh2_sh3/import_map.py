@@ -5,13 +5,17 @@ if "bpy" in locals():
   import importlib
   if "readutil" in locals():
     importlib.reload(readutil)
+  if "striputil" in locals():
+    importlib.reload(striputil)
 
 import bpy
 import math
 import mathutils
+import numpy as np
 import os
 
 from .readutil import readutil
+from .striputil import striputil
 from . import vu
 
 
@@ -113,11 +117,10 @@ class MapParser:
       f.seek(offs + data_start_offs)
 
       vtx = []
-      tri = []
       vn = []
       uv = []
       vcol = []
-      reverse = False
+      restart = []
       for i in range(vertex_count):
         # vtx.append([v / 0x8000 * 100.0 for v in f.read_nint16(3)])
         vtx_local = mathutils.Vector(f.read_nint16(3)).to_4d()
@@ -129,13 +132,9 @@ class MapParser:
         uv.append((uv_flag[0] / 0x8000, 1.0 - uv_flag[1] / 0x8000))
         vn.append(mathutils.Vector([(v & ~0x3F) / -0x8000 for v in vn_vcol]).normalized())
         vcol.append([(v & 0x3F) / 0x20 for v in vn_vcol])
-        flag = uv_flag[0] & 0x1
-        if not flag:
-          if reverse:
-            tri.append((i, i - 1, i - 2))
-          else:
-            tri.append((i - 2, i - 1, i))
-        reverse = not reverse
+        restart.append(uv_flag[0] & 0x1)
+      tri = striputil.triangulate_restart(np.arange(vertex_count),
+                                          restart).tolist()
 
       # Build Blender object at the shape level.
       offs_str = '{0:#010x}'.format(offs)
@@ -5,17 +5,26 @@ if "bpy" in locals():
   import importlib
   if "readutil" in locals():
     importlib.reload(readutil)
+  if "poolutil" in locals():
+    importlib.reload(poolutil)
+  if "vifutil" in locals():
+    importlib.reload(vifutil)
   if "vu" in locals():
     importlib.reload(vu)
+  if "mdl_decode" in locals():
+    importlib.reload(mdl_decode)
 
 import bpy
 import math
 import mathutils
+import numpy as np
 import os
-import struct
 
 from .gsutil import gsutil
+from .poolutil import poolutil
 from .readutil import readutil
+from .vifutil import vifutil
+from . import mdl_decode
 from . import vu
 
 
@@ -84,12 +93,14 @@ class MdlParser:
   def __init__(self):
     self.basename = ''
     self.bone_matrices = []
-    self.bone_matrices_it = []  # Inverse-transposed
+    self.bone_matrix_array = None  # (bone count, 4, 4)
+    self.bone_matrix_it_array = None  # Inverse-transposed
     self.helper_table = []
     self.morph_targets = []
     self.armature = None
-    self.vif_parser = vu.VifParser()
     self.mat_manager = MaterialManager()
+    # Follows the VIF registers through the packets of all submeshes.
+    self.vif_scanner = vu.VifParser()
 
   def parse(self, filepath):
     self.basename = os.path.splitext(os.path.basename(filepath))[0]
@@ -105,10 +116,11 @@ class MdlParser:
     self.parse_morph_targets(f, model_header)
     self.parse_armature(f, model_header)
     self.parse_helper_armature(f, model_header)
-    self.parse_submeshes(f, model_header.submesh_count,
-                         model_header.submesh_start_offs, blend=False)
-    self.parse_submeshes(f, model_header.submesh_blend_count,
-                         model_header.submesh_blend_start_offs, blend=True)
+    jobs = self.parse_submesh_headers(f, model_header.submesh_count,
+                                      model_header.submesh_start_offs, blend=False)
+    jobs += self.parse_submesh_headers(f, model_header.submesh_blend_count,
+                                       model_header.submesh_blend_start_offs, blend=True)
+    self.parse_submeshes(filepath, jobs)
     self.parse_textures(f, image_count, image_sector_offs, model_header)
 
     # Finalize the scene.
@@ -116,15 +128,15 @@ class MdlParser:
     self.armature.scale = (0.1, 0.1, 0.1)
 
   def parse_armature(self, f, header):
-    self.bone_matrices = []
-    self.bone_matrices_it = []
     f.seek(header.bone_transform_offs)
-    for _ in range(header.bone_count):
-      self.bone_matrices.append(mathutils.Matrix(
-          [f.read_nfloat32(4) for _ in range(4)]
-      ).transposed())
-      self.bone_matrices_it.append(
-          self.bone_matrices[-1].inverted().transposed())
+    bone_rows = [[f.read_nfloat32(4) for _ in range(4)]
+                 for _ in range(header.bone_count)]
+    self.bone_matrices = [mathutils.Matrix(
+        rows).transposed() for rows in bone_rows]
+    self.bone_matrix_array = np.array(
+        bone_rows, dtype=np.float64).reshape(-1, 4, 4).transpose(0, 2, 1)
+    self.bone_matrix_it_array = np.linalg.inv(
+        self.bone_matrix_array).transpose(0, 2, 1)
 
     f.seek(header.bone_parent_table_offs)
     bone_parents = f.read_nint8(header.bone_count)
@@ -236,7 +248,12 @@ class MdlParser:
 
       self.morph_targets.append((pos_int16, norm_int16))
 
-  def parse_submeshes(self, f, submesh_count, submesh_start_offs, blend=False):
+  def parse_submesh_headers(self, f, submesh_count, submesh_start_offs, blend=False):
+    morph_positions = None
+    if self.morph_targets:
+      morph_positions = np.array([pos for pos, _ in self.morph_targets], dtype=np.int32)
+
+    jobs = []
     next_offs = submesh_start_offs
     for submesh_index in range(submesh_count):
       offs = next_offs
@@ -266,183 +283,141 @@ class MdlParser:
           count = f.read_uint16()
           morph_refs.append((src_index, dst_addr, count))
 
+      # Jobs are sent to worker processes, so each one only carries the base
+      # vertices that its morph packets replace.
+      job_morph_positions = None
+      if morph_refs and morph_positions is not None:
+        job_morph_positions = [
+            morph_positions[:, src_index:src_index + count]
+            for src_index, _, count in morph_refs
+        ]
+
+      # Packets start from the VIF registers left by those of previous
+      # submeshes (e.g. the cycle set by morph packets), which are only
+      # scanned here rather than decoded.
+      vif_state = self.vif_scanner.state()
+      f.seek(vif_offs)
+      self.vif_scanner.scan(f.read(vif_qwd * 0x10))
+      if job_morph_positions is not None:
+        # Morph packets only differ by the vertices they unpack.
+        self.vif_scanner.scan(mdl_decode.build_morph_packet(
+            [positions[0] for positions in job_morph_positions], morph_refs))
+
       f.seek(bone_palette_offs)
       bone_palette = f.read_nint16(bone_palette_count)
       f.seek(helper_palette_offs)
       helper_palette = f.read_nint16(helper_palette_count)
+      # Jobs only carry the bones of their palettes rather than those of the
+      # whole model.
+      bone_palette_indices = np.array(bone_palette, dtype=np.int64)
+      helper_bones = [self.helper_table[index][1] for index in helper_palette]
       f.seek(texture_index_offs)
       texture_index = f.read_int16()
 
-      f.seek(vif_offs)
-      vtx, vn, uv, tri, vtx_group_dict, primary_bone_list = self.run_vif_parser(
-          f.read(vif_qwd * 0x10), vif_addr, bone_palette, helper_palette)
-
-      # Build Blender object.
-      offs_str = '{0:#010x}'.format(offs)
-      objname = f'{self.basename}_m_{submesh_index}_{offs_str}'
-      objname += f'_{material_type}_{display_group}'
-      objname += '_t' if blend else ''
-      objname += '_b' if morph_ref_count > 0 else ''
-      mesh_data = bpy.data.meshes.new(objname + '_mesh_data')
-      mesh_data.from_pydata(vtx, [], tri)
-      mesh_data.update()
-
-      if uv:
-        mesh_data.uv_layers.new(do_init=False)
-        mesh_data.uv_layers[-1].data.foreach_set('uv', [
-            vt for pair in [uv[loop.vertex_index] for loop in mesh_data.loops]
-            for vt in pair
-        ])
-
-      obj = bpy.data.objects.new(objname, mesh_data)
-      obj.data.materials.append(
-          self.mat_manager.get_material(texture_index, blend,
-                                        self.basename))
-
-      # Required to derive the original position values for each vertex.
-      obj['primary_bone_list'] = primary_bone_list
-
-      # Apply blendshapes if used.
-      if morph_refs and self.morph_targets:
-        shape_key = obj.shape_key_add(name='ShapeKey_Base')
+      jobs.append(mdl_decode.SubmeshJob(
+          index=submesh_index,
+          offs=offs,
+          blend=blend,
+          vif_offs=vif_offs,
+          vif_size=vif_qwd * 0x10,
+          vif_addr=vif_addr,
+          vif_state=vif_state,
+          morph_refs=morph_refs,
+          bone_palette=bone_palette,
+          helper_bones=helper_bones,
+          texture_index=texture_index,
+          material_type=material_type,
+          display_group=display_group,
+          bone_matrices=self.bone_matrix_array[bone_palette_indices],
+          bone_matrices_it=self.bone_matrix_it_array[bone_palette_indices],
+          morph_positions=job_morph_positions))
+    return jobs
+
+  # Submeshes are decoded by mdl_decode (in worker processes where possible)
+  # and only turned into Blender objects here. Each one starts from the VIF
+  # registers that its job carries, so they can be decoded independently
+  # unless one reads VU memory left by previous submeshes. The whole model is
+  # then decoded again in order, with one parser.
+  def parse_submeshes(self, filepath, jobs):
+    # Blender 2.8x runs its bundled Python from binary_path_python, which
+    # later versions dropped as sys.executable is then the interpreter.
+    submeshes = poolutil.run_jobs(
+        mdl_decode.decode_submesh, jobs, filepath, __package__,
+        os.path.dirname(__file__),
+        executable=getattr(bpy.app, 'binary_path_python', None))
+    if any(submesh is None for submesh in submeshes):
+      buf = poolutil.get_buffer(filepath)
+      try:
+        vif_parser = vu.VifParser()
+        submeshes = [mdl_decode.decode_submesh(buf, job, vif_parser)
+                     for job in jobs]
+      finally:
+        poolutil.release_buffer(filepath)
+    for job, submesh in zip(jobs, submeshes):
+      self.build_submesh(job, submesh)
+    # Workers each count the packets that they decoded from their own cache.
+    cache_stats = vifutil.sum_stats(
+        submesh.cache_stats for submesh in submeshes)
+    print(f'{self.basename}: {cache_stats.hits} VIF packets replayed from '
+          f'cache, {cache_stats.misses} compiled')
+
+  def build_submesh(self, job, submesh):
+    # Build Blender object.
+    offs_str = '{0:#010x}'.format(job.offs)
+    objname = f'{self.basename}_m_{job.index}_{offs_str}'
+    objname += f'_{job.material_type}_{job.display_group}'
+    objname += '_t' if job.blend else ''
+    objname += '_b' if job.morph_refs else ''
+    mesh_data = bpy.data.meshes.new(objname + '_mesh_data')
+    mesh_data.from_pydata(submesh.vtx.tolist(), [], submesh.tri.tolist())
+    mesh_data.update()
+
+    loop_vertex_indices = np.empty(len(mesh_data.loops), dtype=np.int32)
+    mesh_data.loops.foreach_get('vertex_index', loop_vertex_indices)
+
+    if len(submesh.uv):
+      mesh_data.uv_layers.new(do_init=False)
+      mesh_data.uv_layers[-1].data.foreach_set(
+          'uv', submesh.uv[loop_vertex_indices].ravel())
+
+    obj = bpy.data.objects.new(objname, mesh_data)
+    obj.data.materials.append(
+        self.mat_manager.get_material(job.texture_index, job.blend,
+                                      self.basename))
+
+    # Required to derive the original position values for each vertex.
+    obj['primary_bone_list'] = submesh.primary_bone_list.tolist()
+
+    # Apply blendshapes if used.
+    if submesh.morph_vtx:
+      shape_key = obj.shape_key_add(name='ShapeKey_Base')
+      shape_key.interpolation = 'KEY_LINEAR'
+      obj.data.shape_keys.use_relative = True
+
+      for morph_index, vtx_morph in enumerate(submesh.morph_vtx):
+        shape_key = obj.shape_key_add(name='ShapeKey_%d' % morph_index)
         shape_key.interpolation = 'KEY_LINEAR'
-        obj.data.shape_keys.use_relative = True
-
-        # Build packet to replace vertex data in VU1 memory.
-        for morph_index, (morph_pos, _) in enumerate(self.morph_targets):
-          shape_key = obj.shape_key_add(name='ShapeKey_%d' % morph_index)
-          shape_key.interpolation = 'KEY_LINEAR'
-
-          packet = b''
-          for src_index, dst_addr, count in morph_refs:
-            packet += struct.pack('<II', 0x01000104,
-                                  0x69000000 | dst_addr | (count << 0x10))
-            packet += b''.join([struct.pack('<hhh', morph_pos[src_index + i][0],
-                               morph_pos[src_index + i][1], morph_pos[src_index + i][2]) for i in range(count)])
-            if len(packet) % 0x4 > 0:
-              packet += b'\x00' * (0x4 - len(packet) % 0x4)
-
-          vtx_morph, vn_morph, _, _, _, _ = self.run_vif_parser(
-              packet, vif_addr, bone_palette, helper_palette, morph_only=True)
-          for i in range(len(vtx_morph)):
-            shape_key.data[i].co = vtx_morph[i]
-            # TODO: Sadly, Blender shape keys do not support custom split normals. Is there any other way?
-
-      # Normals should be set after creating the mesh object to prevent Blender from recalculating them.
-      custom_vn = []
-      for face in mesh_data.polygons:
-        for vertex_index in face.vertices:
-          custom_vn.append(vn[vertex_index])
-        face.use_smooth = True
-      mesh_data.use_auto_smooth = True
-      mesh_data.normals_split_custom_set(custom_vn)
-
-      for i, v_list in vtx_group_dict.items():
-        group = obj.vertex_groups.new(name='Bone_%d' % i)
-        for v, weight in v_list:
-          group.add([v], weight, 'ADD')
-
-      # Attach geometry to armature
-      if self.armature:
-        obj.parent = self.armature
-        modifier = obj.modifiers.new(type='ARMATURE', name='Armature')
-        modifier.object = self.armature
-
-      bpy.context.scene.collection.objects.link(obj)
-      obj.select_set(state=True)
-
-  def run_vif_parser(self, vif_packet, vif_addr, bone_palette, helper_palette, morph_only=False):
-    self.vif_parser.parse(vif_packet)
-
-    vertex_group_count, _, vertex_data_start_addr, bone_matrix_start_addr = self.vif_parser.read_uint32_xyzw(
-        vif_addr)
-    _, _, tristrip_addr, tristrip_end_addr = self.vif_parser.read_uint32_xyzw(
-        vif_addr + 0x1)
-
-    vtx_group_dict = dict()
-    vtx = []
-    vn = []
-    uv = []
-    primary_bone_list = []
-    for vtx_group_index in range(vertex_group_count):
-      vertex_count, helper_count, vertex_data_addr, vertex_data_end_addr = self.vif_parser.read_uint32_xyzw(
-          vif_addr + 0x2 + vtx_group_index * 0x2)
-      helper_count //= 2
-      local_bone_addresses = self.vif_parser.read_uint32_xyzw(
-          vif_addr + 0x3 + vtx_group_index * 0x2)[:helper_count + 1]
-      local_bone_indices = [
-          (addr - bone_matrix_start_addr) // 0x4 for addr in local_bone_addresses]
-
-      bone_indices = [bone_palette[local_bone_indices[0]]]
-      if bone_indices[0] not in vtx_group_dict:
-        vtx_group_dict[bone_indices[0]] = []
-      for i in range(helper_count):
-        helper_bone_index = helper_palette[local_bone_indices[i + 1] - len(
-            bone_palette)]
-        target_bone = self.helper_table[helper_bone_index][1]
-        bone_indices.append(target_bone)
-        if target_bone not in vtx_group_dict:
-          vtx_group_dict[target_bone] = []
-
-      start_vtx_index = (vertex_data_addr - vertex_data_start_addr) // 0x4
-      for vtx_index in range(vertex_count):
-        pos = self.vif_parser.read_int32_xyzw(
-            vertex_data_addr + vtx_index * 0x4)
-        pos = [v / 0x10 for v in pos[:3]]
-        pos_v = self.bone_matrices[bone_indices[0]
-                                   ] @ mathutils.Vector(pos + [1.0])
-        vtx.append(pos_v.to_3d().to_tuple())
-
-        primary_bone_list.append(bone_indices[0])
-
-        normal = self.vif_parser.read_int32_xyzw(
-            vertex_data_addr + 0x1 + vtx_index * 0x4)
-        normal = [-val / 0x1000 for val in normal[:3]]
-        normal_v = self.bone_matrices_it[bone_indices[0]
-                                         ] @ mathutils.Vector(normal + [0.0])
-        vn.append(normal_v.to_3d().to_tuple())
-
-        if morph_only:
-          # UV and and vertex group assignments will not be populated.
-          continue
-
-        if helper_count > 0:
-          weights = self.vif_parser.read_int32_xyzw(
-              vertex_data_addr + 0x2 + vtx_index * 0x4)[:helper_count + 1]
-          weights = [w / 0x1000 for w in weights]  # ITOF12
-          for i, w in enumerate(weights):
-            vtx_group_dict[bone_indices[i]].append(
-                (start_vtx_index + vtx_index, w))
-        else:
-          vtx_group_dict[bone_indices[0]].append(
-              (start_vtx_index + vtx_index, 1.0))
-
-        uv_xyzw = self.vif_parser.read_int32_xyzw(
-            vertex_data_addr + 0x3 + vtx_index * 0x4)
-        uv.append((uv_xyzw[0] / 0x1000, 1.0 - uv_xyzw[1] / 0x1000))
-
-    def get_vtx_index(tri_cmd):
-      return ((tri_cmd & 0x7FFF) - vertex_data_start_addr) // 0x4
-
-    tri = []
-    reverse = True
-    tri_xyzw_count = tristrip_end_addr - tristrip_addr
-    tri_xyzw_list = [self.vif_parser.read_uint32_xyzw(
-        tristrip_addr + i) for i in range(tri_xyzw_count)]
-    tri_cmds = [t for xyzw in tri_xyzw_list for t in xyzw]
-    for i, tri_cmd in enumerate(tri_cmds):
-      if i > 1 and (tri_cmd & 0x8000) == 0:
-        t1 = get_vtx_index(tri_cmd)
-        t2 = get_vtx_index(tri_cmds[i - 1])
-        t3 = get_vtx_index(tri_cmds[i - 2])
-        if t1 != t2 and t2 != t3 and t1 != t3:
-          if reverse:
-            tri.append((t3, t2, t1))
-          else:
-            tri.append((t1, t2, t3))
-      reverse = not reverse
-
-    return vtx, vn, uv, tri, vtx_group_dict, primary_bone_list
+        shape_key.data.foreach_set('co', vtx_morph.ravel())
+        # TODO: Sadly, Blender shape keys do not support custom split normals. Is there any other way?
+
+    # Normals should be set after creating the mesh object to prevent Blender from recalculating them.
+    mesh_data.polygons.foreach_set('use_smooth', [True] * len(mesh_data.polygons))
+    mesh_data.use_auto_smooth = True
+    mesh_data.normals_split_custom_set(submesh.vn[loop_vertex_indices].tolist())
+
+    for i, (v_list, weights) in submesh.vtx_groups.items():
+      group = obj.vertex_groups.new(name='Bone_%d' % i)
+      for v, weight in zip(v_list.tolist(), weights.tolist()):
+        group.add([v], weight, 'ADD')
+
+    # Attach geometry to armature
+    if self.armature:
+      obj.parent = self.armature
+      modifier = obj.modifiers.new(type='ARMATURE', name='Armature')
+      modifier.object = self.armature
+
+    bpy.context.scene.collection.objects.link(obj)
+    obj.select_set(state=True)
 
   def parse_textures(self, f, image_count, image_sector_offs, header):
     # {image index -> [(texture index, palette index)]}
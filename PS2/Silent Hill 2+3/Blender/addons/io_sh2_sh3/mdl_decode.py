@@ -0,0 +1,178 @@
+# Decodes MDL submeshes into arrays. This module must not depend on Blender so
+# that submeshes can be decoded in worker processes (see poolutil).
+
+import collections
+import numpy as np
+import struct
+
+from .striputil import striputil
+from . import vu
+
+SubmeshJob = collections.namedtuple('SubmeshJob', [
+    'index',
+    'offs',
+    'blend',
+    'vif_offs',
+    'vif_size',
+    'vif_addr',
+    'vif_state',  # VIF registers left by the packets of previous submeshes
+    'morph_refs',  # [(src index, dst addr, count)]
+    'bone_palette',
+    'helper_bones',  # Bone index of each helper palette entry
+    'texture_index',
+    'material_type',
+    'display_group',
+    'bone_matrices',  # (bone palette size, 4, 4) matrices of bone_palette
+    'bone_matrices_it',  # Inverse-transposed
+    # [(morph count, count, 3) int32] base vertices replaced by each
+    # morph_refs entry, or None
+    'morph_positions',
+])
+
+DecodedSubmesh = collections.namedtuple('DecodedSubmesh', [
+    'vtx',  # (N, 3) float32
+    'vn',  # (N, 3) float32
+    'uv',  # (N, 2) float32
+    'tri',  # (M, 3) int32
+    'vtx_groups',  # {bone index -> (vertex indices, weights)}
+    'primary_bone_list',  # (N,) int32
+    'morph_vtx',  # [(N, 3) float32] per morph target
+    'cache_stats',  # vifutil.CacheStats of decoding this submesh
+])
+
+
+# Submeshes are decoded on their own, from the VIF registers of the job and an
+# empty VU memory. Returns None if the submesh reads VU memory that its own
+# packets do not write, as it depends on the packets of previous submeshes.
+# Such models are decoded in order instead, with the parser shared by all
+# submeshes given as vif_parser.
+def decode_submesh(buf, job, vif_parser=None):
+  if vif_parser is not None:
+    return _decode_submesh(buf, job, vif_parser)
+  vif_parser = vu.VifParser(job.vif_state)
+  try:
+    submesh = _decode_submesh(buf, job, vif_parser)
+  except Exception:
+    # What was read in place of memory left by previous submeshes may not
+    # decode at all.
+    if vif_parser.read_unwritten:
+      return None
+    raise
+  if vif_parser.read_unwritten:
+    return None
+  return submesh
+
+
+def _decode_submesh(buf, job, vif_parser):
+  start_stats = vu.cache_stats()
+  vtx, vn, uv, tri, vtx_groups, primary_bone_list = run_vif_parser(
+      vif_parser, buf[job.vif_offs:job.vif_offs + job.vif_size], job)
+
+  # Replace vertex data in VU1 memory with each morph target and decode again.
+  morph_vtx = []
+  if job.morph_refs and job.morph_positions is not None:
+    for morph_index in range(len(job.morph_positions[0])):
+      morph_pos = [positions[morph_index] for positions in job.morph_positions]
+      vtx_morph, _, _, _, _, _ = run_vif_parser(
+          vif_parser, build_morph_packet(morph_pos, job.morph_refs), job,
+          morph_only=True)
+      morph_vtx.append(vtx_morph)
+
+  return DecodedSubmesh(vtx, vn, uv, tri, vtx_groups, primary_bone_list,
+                        morph_vtx, vu.cache_stats_since(start_stats))
+
+
+# morph_pos holds the vertices of one morph target for each morph_refs entry.
+def build_morph_packet(morph_pos, morph_refs):
+  packet = b''
+  for (_, dst_addr, count), positions in zip(morph_refs, morph_pos):
+    packet += struct.pack('<II', 0x01000104,
+                          0x69000000 | dst_addr | (count << 0x10))
+    packet += positions.astype('<i2').tobytes()
+    if len(packet) % 0x4 > 0:
+      packet += b'\x00' * (0x4 - len(packet) % 0x4)
+  return packet
+
+
+def run_vif_parser(vif_parser, vif_packet, job, morph_only=False):
+  vif_parser.parse(vif_packet)
+
+  vertex_group_count, _, vertex_data_start_addr, bone_matrix_start_addr = vif_parser.read_uint32_xyzw(
+      job.vif_addr)
+  _, _, tristrip_addr, tristrip_end_addr = vif_parser.read_uint32_xyzw(
+      job.vif_addr + 0x1)
+
+  # {bone index -> [(vertex indices, weights)]}
+  vtx_group_parts = dict()
+  vtx = []
+  vn = []
+  uv = []
+  primary_bone_list = []
+  for vtx_group_index in range(vertex_group_count):
+    vertex_count, helper_count, vertex_data_addr, vertex_data_end_addr = vif_parser.read_uint32_xyzw(
+        job.vif_addr + 0x2 + vtx_group_index * 0x2)
+    helper_count //= 2
+    local_bone_addresses = vif_parser.read_uint32_xyzw(
+        job.vif_addr + 0x3 + vtx_group_index * 0x2)[:helper_count + 1]
+    local_bone_indices = [
+        (addr - bone_matrix_start_addr) // 0x4 for addr in local_bone_addresses]
+
+    bone_indices = [job.bone_palette[local_bone_indices[0]]]
+    for i in range(helper_count):
+      bone_indices.append(job.helper_bones[local_bone_indices[i + 1] - len(
+          job.bone_palette)])
+    for bone_index in bone_indices:
+      vtx_group_parts.setdefault(bone_index, [])
+
+    # Each vertex is stored as four quadwords: position, normal, weights, UV.
+    data = np.frombuffer(vif_parser.read_bytes(vertex_data_addr, vertex_count * 0x4),
+                         dtype='<i4').reshape(vertex_count, 4, 4)
+
+    pos = np.ones((vertex_count, 4))
+    pos[:, :3] = data[:, 0, :3] / 0x10
+    vtx.append((pos @ job.bone_matrices[local_bone_indices[0]].T)[:, :3])
+
+    normal = np.zeros((vertex_count, 4))
+    normal[:, :3] = -data[:, 1, :3] / 0x1000
+    vn.append((normal @ job.bone_matrices_it[local_bone_indices[0]].T)[:, :3])
+
+    primary_bone_list.append(np.full(vertex_count, bone_indices[0]))
+
+    if morph_only:
+      # UV and and vertex group assignments will not be populated.
+      continue
+
+    start_vtx_index = (vertex_data_addr - vertex_data_start_addr) // 0x4
+    vtx_indices = np.arange(start_vtx_index, start_vtx_index + vertex_count)
+    if helper_count > 0:
+      weights = data[:, 2, :helper_count + 1] / 0x1000  # ITOF12
+      for i, bone_index in enumerate(bone_indices):
+        vtx_group_parts[bone_index].append((vtx_indices, weights[:, i]))
+    else:
+      vtx_group_parts[bone_indices[0]].append(
+          (vtx_indices, np.ones(vertex_count)))
+
+    uv.append(np.stack((data[:, 3, 0] / 0x1000, 1.0 - data[:, 3, 1] / 0x1000),
+                       axis=1))
+
+  vtx_groups = dict()
+  for bone_index, parts in vtx_group_parts.items():
+    vtx_groups[bone_index] = (_concat([p[0] for p in parts], np.int32),
+                              _concat([p[1] for p in parts], np.float32))
+
+  # Each strip command holds a vertex address and an ADC (restart) bit.
+  tri_xyzw_count = tristrip_end_addr - tristrip_addr
+  tri_cmds = np.frombuffer(vif_parser.read_bytes(tristrip_addr, tri_xyzw_count),
+                           dtype='<u4').astype(np.int64)
+  tri = striputil.triangulate_restart(
+      ((tri_cmds & 0x7FFF) - vertex_data_start_addr) // 0x4, tri_cmds & 0x8000)
+
+  return (_concat(vtx, np.float32, 3), _concat(vn, np.float32, 3),
+          _concat(uv, np.float32, 2), tri, vtx_groups,
+          _concat(primary_bone_list, np.int32))
+
+
+def _concat(parts, dtype, width=None):
+  if not parts:
+    return np.empty((0, width) if width else 0, dtype=dtype)
+  return np.concatenate(parts).astype(dtype)
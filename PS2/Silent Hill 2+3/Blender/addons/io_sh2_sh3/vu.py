@@ -1,5 +1,8 @@
+import collections
 import struct
 
+from .vifutil import vifutil
+
 
 class VuParseError(Exception):
   pass
@@ -7,9 +10,39 @@ class VuParseError(Exception):
 
 _DEF_WORD = b'\0\0\0\0'
 
+# A packet compiled into the VU memory writes it performs, as runs of
+# consecutive quadwords, and the VIF registers it leaves behind.
+VuProgram = collections.namedtuple(
+    'VuProgram', ['runs', 'cl', 'wl', 'mask', 'vif_r', 'vif_c'])
+
+_programs = vifutil.ProgramCache()
+
+
+# Returns hit/miss counters of the compiled packet cache of this process.
+def cache_stats():
+  return _programs.stats()
+
+
+# Returns how much the counters grew since cache_stats() returned start.
+def cache_stats_since(start):
+  return _programs.stats_since(start)
+
+
+# Byte width of the elements read by each UNPACK format (vn/vl bits).
+_UNPACK_WIDTHS = {
+    0b0000: 4,  # S-32
+    0b0100: 8,  # V2-32
+    0b0101: 4,  # V2-16
+    0b1000: 12,  # V3-32
+    0b1001: 6,  # V3-16
+    0b1100: 16,  # V4-32
+    0b1101: 8,  # V4-16
+}
+
 
 class VifParser:
-  def __init__(self):
+  # state is the VIF registers to start from, as returned by state().
+  def __init__(self, state=None):
     self.vumem = [[_DEF_WORD for _ in range(4)]
                   for _ in range(0x400)]  # VU1 memory is 16KB
     self.vif_r = [_DEF_WORD for _ in range(4)]
@@ -17,8 +50,78 @@ class VifParser:
     self.cl = 1
     self.wl = 1
     self.mask = [0 for _ in range(16)]
+    if state is not None:
+      self.cl, self.wl, mask, vif_r, vif_c = state
+      self.mask = list(mask)
+      self.vif_r = list(vif_r)
+      self.vif_c = list(vif_c)
+    # Quadwords written by the packets parsed so far. Reading others sets
+    # read_unwritten, as their contents would otherwise come from packets
+    # parsed by an earlier parser.
+    self.written = bytearray(len(self.vumem))
+    self.read_unwritten = False
+
+  # Returns the VIF registers that the next packet starts from.
+  def state(self):
+    return (self.cl, self.wl, tuple(self.mask), tuple(self.vif_r),
+            tuple(self.vif_c))
+
+  # Updates the VIF registers as parse(buf) would, without decoding the data
+  # that buf unpacks to VU memory.
+  def scan(self, buf):
+    offs = 0
+    while offs < len(buf):
+      imm, qwd, cmd = struct.unpack('<HBB', buf[offs:offs+4])
+      cmd &= 0x7F
+      offs += 4
+      if cmd == 0b00000000:  # NOP
+        continue
+      elif cmd == 0b00000001:  # STCYCLE
+        self.cl = imm & 0xFF
+        self.wl = (imm >> 8) & 0xFF
+      elif cmd == 0b00110000:  # STROW
+        self.vif_r = self._getnpacked32(buf, offs, 4)
+        offs += 0x10
+      elif cmd == 0b00110001:  # STCOL
+        self.vif_c = self._getnpacked32(buf, offs, 4)
+        offs += 0x10
+      elif cmd == 0b00100000:  # STMASK
+        m = self._getpacked32(buf, offs)
+        self.mask = [((m >> (i << 1)) & 0x3) for i in range(16)]
+        offs += 4
+      elif cmd >> 5 == 0b11:  # UNPACK
+        width = _UNPACK_WIDTHS.get(cmd & 0xF)
+        if width is None:
+          raise VuParseError(
+              f'Unsupported unpack vnvl {hex(cmd & 0xF)} at offset {hex(offs)}')
+        count = sum(1 for i in range(qwd)
+                    if self.cl >= self.wl or (i % self.wl) < self.cl)
+        offs += count * width
+        if (offs % 4) > 0:
+          offs += 4 - (offs % 4)
+      else:
+        raise VuParseError(
+            f'Unrecognized vifcmd {hex(cmd)} at offset {hex(offs)}')
 
   def parse(self, buf):
+    key = vifutil.packet_key(buf, self.cl, self.wl, tuple(self.mask),
+                             tuple(self.vif_r), tuple(self.vif_c))
+    self.run(_programs.get(key, lambda: self.compile(buf)))
+
+  def run(self, program):
+    for addr, rows in program.runs:
+      self.vumem[addr:addr + len(rows)] = rows
+      self.written[addr:addr + len(rows)] = b'\1' * len(rows)
+    self.cl = program.cl
+    self.wl = program.wl
+    self.mask = list(program.mask)
+    self.vif_r = list(program.vif_r)
+    self.vif_c = list(program.vif_c)
+
+  # Decodes buf starting from the current VIF registers. VU memory is left
+  # untouched, the writes are returned in a VuProgram instead.
+  def compile(self, buf):
+    writes = []
     offs = 0
     while offs < len(buf):
       imm, qwd, cmd = struct.unpack('<HBB', buf[offs:offs+4])
@@ -54,12 +157,12 @@ class VifParser:
               j += 1
             addroffs = self.cl * (i // self.wl) + (i %
                                                    self.wl) if self.cl >= self.wl else 0
-            self.vumem[addr + addroffs] = [
+            writes.append((addr + addroffs, (
                 self._maybe_mask_value(val, 0, i, m),
                 self._maybe_mask_value(val, 1, i, m),
                 self._maybe_mask_value(val, 2, i, m),
                 self._maybe_mask_value(val, 3, i, m),
-            ]
+            )))
         elif vnvl == 0b0100:  # V2-32
           width = 8
           for i in range(qwd):
@@ -69,12 +172,12 @@ class VifParser:
               j += 1
             addroffs = self.cl * (i // self.wl) + (i %
                                                    self.wl) if self.cl >= self.wl else 0
-            self.vumem[addr + addroffs] = [
+            writes.append((addr + addroffs, (
                 self._maybe_mask_value(val[0], 0, i, m),
                 self._maybe_mask_value(val[1], 1, i, m),
                 self._maybe_mask_value(_DEF_WORD, 2, i, m),
                 self._maybe_mask_value(_DEF_WORD, 3, i, m),
-            ]
+            )))
         elif vnvl == 0b0101:  # V2-16
           width = 4
           for i in range(qwd):
@@ -87,12 +190,12 @@ class VifParser:
               j += 1
             addroffs = self.cl * (i // self.wl) + (i %
                                                    self.wl) if self.cl >= self.wl else 0
-            self.vumem[addr + addroffs] = [
+            writes.append((addr + addroffs, (
                 self._maybe_mask_value(val[0], 0, i, m),
                 self._maybe_mask_value(val[1], 1, i, m),
                 self._maybe_mask_value(_DEF_WORD, 2, i, m),
                 self._maybe_mask_value(_DEF_WORD, 3, i, m),
-            ]
+            )))
         elif vnvl == 0b1000:  # V3-32
           width = 12
           for i in range(qwd):
@@ -102,12 +205,12 @@ class VifParser:
               j += 1
             addroffs = self.cl * (i // self.wl) + (i %
                                                    self.wl) if self.cl >= self.wl else 0
-            self.vumem[addr + addroffs] = [
+            writes.append((addr + addroffs, (
                 self._maybe_mask_value(val[0], 0, i, m),
                 self._maybe_mask_value(val[1], 1, i, m),
                 self._maybe_mask_value(val[2], 2, i, m),
                 self._maybe_mask_value(_DEF_WORD, 3, i, m),
-            ]
+            )))
         elif vnvl == 0b1001:  # V3-16
           width = 6
           for i in range(qwd):
@@ -120,12 +223,12 @@ class VifParser:
               j += 1
             addroffs = self.cl * (i // self.wl) + (i %
                                                    self.wl) if self.cl >= self.wl else 0
-            self.vumem[addr + addroffs] = [
+            writes.append((addr + addroffs, (
                 self._maybe_mask_value(val[0], 0, i, m),
                 self._maybe_mask_value(val[1], 1, i, m),
                 self._maybe_mask_value(val[2], 2, i, m),
                 self._maybe_mask_value(_DEF_WORD, 3, i, m),
-            ]
+            )))
         elif vnvl == 0b1100:  # V4-32
           width = 16
           for i in range(qwd):
@@ -135,12 +238,12 @@ class VifParser:
               j += 1
             addroffs = self.cl * (i // self.wl) + (i %
                                                    self.wl) if self.cl >= self.wl else 0
-            self.vumem[addr + addroffs] = [
+            writes.append((addr + addroffs, (
                 self._maybe_mask_value(val[0], 0, i, m),
                 self._maybe_mask_value(val[1], 1, i, m),
                 self._maybe_mask_value(val[2], 2, i, m),
                 self._maybe_mask_value(val[3], 3, i, m),
-            ]
+            )))
         elif vnvl == 0b1101:  # V4-16
           width = 8
           for i in range(qwd):
@@ -153,12 +256,12 @@ class VifParser:
               j += 1
             addroffs = self.cl * (i // self.wl) + (i %
                                                    self.wl) if self.cl >= self.wl else 0
-            self.vumem[addr + addroffs] = [
+            writes.append((addr + addroffs, (
                 self._maybe_mask_value(val[0], 0, i, m),
                 self._maybe_mask_value(val[1], 1, i, m),
                 self._maybe_mask_value(val[2], 2, i, m),
                 self._maybe_mask_value(val[3], 3, i, m),
-            ]
+            )))
         else:
           raise VuParseError(
               f'Unsupported unpack vnvl {hex(vnvl)} at offset {hex(offs)}')
@@ -169,18 +272,42 @@ class VifParser:
         raise VuParseError(
             f'Unrecognized vifcmd {hex(cmd)} at offset {hex(offs)}')
 
+    runs = []
+    for addr, row in writes:
+      if addr >= len(self.vumem):
+        raise VuParseError(f'Unpack address {hex(addr)} out of range')
+      if runs and addr == runs[-1][0] + len(runs[-1][1]):
+        runs[-1][1].append(row)
+      else:
+        runs.append((addr, [row]))
+    return VuProgram(runs, self.cl, self.wl, tuple(self.mask),
+                     tuple(self.vif_r), tuple(self.vif_c))
+
   def read_uint32(self, addr, elem):
+    self._check_written(addr, 1)
     return struct.unpack('<I', self.vumem[addr][elem])[0]
 
   def read_int32_xyzw(self, addr):
+    self._check_written(addr, 1)
     return [struct.unpack('<i', self.vumem[addr][i])[0] for i in range(4)]
 
   def read_uint32_xyzw(self, addr):
+    self._check_written(addr, 1)
     return [struct.unpack('<I', self.vumem[addr][i])[0] for i in range(4)]
 
   def read_float32_xyzw(self, addr):
+    self._check_written(addr, 1)
     return [struct.unpack('<f', self.vumem[addr][i])[0] for i in range(4)]
 
+  # Returns the raw contents of count quadwords starting at addr.
+  def read_bytes(self, addr, count):
+    self._check_written(addr, count)
+    return b''.join(w for xyzw in self.vumem[addr:addr + count] for w in xyzw)
+
+  def _check_written(self, addr, count):
+    if not all(self.written[addr:addr + count]):
+      self.read_unwritten = True
+
   def _getpacked32(self, b, offs):
     return b[offs:offs+4]
 
@@ -1,15 +1,17 @@
 # Extracts files from a Silent Hill 3 (PS2) AFS archive.
+#
+# Can also be imported to read archives from other scripts:
+#
+#   import afsextract
+#   afsextract.extract('BGM.AFS', ['bgm_001.bin'])
+#   async for name, data in afsextract.iter_members('BGM.AFS'):
+#     ...
 
 import argparse
 import os
 import sys
-import struct
 
-parser = argparse
-
-parser = argparse.ArgumentParser(description='''
-Script to extract files from a Silent Hill 3 (PS2) .AFS archive.
-''')
+from archiveutil import archiveutil
 
 
 def err(msg):
@@ -17,61 +19,75 @@ def err(msg):
   sys.exit(1)
 
 
-def getint32(b, offs=0):
-  return struct.unpack('<i', b[offs:offs+4])[0]
-
-
-def getuint32(b, offs=0):
-  return struct.unpack('<I', b[offs:offs+4])[0]
-
-
-def getstring(b, offs=0, maxsize=0x100):
-  startoffs = offs
-  maxoffs = startoffs + maxsize
-  while offs < len(b) and offs < maxoffs and b[offs] != 0:
-    offs += 1
-  return b[startoffs:offs].decode('ascii')
-
-
-parser.add_argument('afspath', help='Input path of .AFS file', nargs=1)
-args = parser.parse_args()
-
-if len(args.afspath[0]) == 0:
-  parser.print_usage()
-  sys.exit(1)
-if not os.path.exists(args.afspath[0]):
-  err("AFS path not found: {}".format(args.afspath[0]))
-# Drag-and-drop hack
-afspath = sys.argv[1] if sys.argv[1][0] != '-' else args.afspath[0]
-basename = os.path.splitext(os.path.basename(afspath))[0]
-
-outdir = os.path.join(os.path.dirname(afspath), f'{basename}_afs')
-if os.path.isfile(outdir):
-  outdir += '_out'
-if not os.path.exists(outdir):
-  os.makedirs(outdir)
-
-with open(afspath, 'rb') as f:
-  buf = f.read()
-
-num_files = getuint32(buf, 0x4)
-
-files = []
-for i in range(num_files):
-  offs = getuint32(buf, 0x8 + i * 0x8)
-  size = getuint32(buf, 0xC + i * 0x8)
-  files.append((offs, size))
-
-filename_table_offs = getuint32(buf, 0x7FFF8)
-filenames = []
-for i in range(num_files):
-  filename = getstring(buf, filename_table_offs + i * 0x30, 0x20)
-  filenames.append(filename)
-
-for (offs, size), filename in zip(files, filenames):
-  print(f'Extracting: {filename} ...')
-  outpath = os.path.join(outdir, filename)
-  if not os.path.exists(os.path.dirname(outpath)):
-    os.makedirs(os.path.dirname(outpath))
-  with open(outpath, 'wb+') as f:
-    f.write(buf[offs:offs + size])
+def open_archive(afspath, rebuild_index=False):
+  return archiveutil.AfsArchive(afspath, archiveutil.open_index(),
+                                rebuild_index)
+
+
+# Extracts members (by default, all of them) of the archive at afspath. Other
+# arguments are passed to Archive.extract_all. Returns the extracted members
+# and the number of skipped members.
+def extract(afspath, members=None, rebuild_index=False, **kwargs):
+  with open_archive(afspath, rebuild_index) as archive:
+    return archive.extract_all(members, **kwargs)
+
+
+# Yields (name, memoryview) of members (by default, all of them) of the
+# archive at afspath as they are read. See archiveutil.iter_members_async.
+async def iter_members(afspath, members=None, concurrency=4):
+  with open_archive(afspath) as archive:
+    async for item in archiveutil.iter_members_async(archive, members,
+                                                     concurrency):
+      yield item
+
+
+def main():
+  parser = argparse.ArgumentParser(description='''
+  Script to extract files from a Silent Hill 3 (PS2) .AFS archive.
+  ''')
+  parser.add_argument('afspath', help='Input path of .AFS file', nargs=1)
+  parser.add_argument('--rebuild-index', action='store_true',
+                      help='Parse the archive again instead of using the cached index')
+  parser.add_argument('-j', '--jobs', type=int,
+                      help='Number of files to extract concurrently')
+  parser.add_argument('--chunk-size', type=int,
+                      default=archiveutil.DEFAULT_CHUNK_SIZE,
+                      help='Size of the buffer used to copy files when the '
+                      'archive cannot be copied by the OS (default: %(default)s)')
+  parser.add_argument('--verify', action='store_true',
+                      help='Check the contents of previously extracted files '
+                      'even if they look unchanged')
+  archiveutil.add_selection_args(parser)
+  archiveutil.add_dedupe_args(parser)
+  args = parser.parse_args()
+
+  if len(args.afspath[0]) == 0:
+    parser.print_usage()
+    sys.exit(1)
+  if not os.path.exists(args.afspath[0]):
+    err("AFS path not found: {}".format(args.afspath[0]))
+  # Drag-and-drop hack
+  afspath = sys.argv[1] if sys.argv[1][0] != '-' else args.afspath[0]
+
+  try:
+    archive = open_archive(afspath, args.rebuild_index)
+  except archiveutil.ArchiveError as e:
+    err(e)
+
+  with archive:
+    members = archiveutil.select_from_args(archive, args)
+    if members is not None:
+      dedupe = archiveutil.open_dedupe_store(args)
+      archive.extract_all(
+          members,
+          max_workers=args.jobs,
+          on_extract=lambda member, _: print(f'Extracting: {member.name} ...'),
+          chunk_size=args.chunk_size,
+          verify=args.verify,
+          dedupe=dedupe)
+      if dedupe:
+        print(dedupe.report())
+
+
+if __name__ == '__main__':
+  main()